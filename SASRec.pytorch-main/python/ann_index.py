@@ -0,0 +1,216 @@
+"""
+Approximate nearest-neighbor (maximum inner product) item index for top-k retrieval.
+
+IVF: items are clustered with k-means into nlist inverted lists; a query scores the centroids,
+probes the nprobe best lists and scores only their items. With pq_m > 0 the residuals
+item - centroid are product-quantized into pq_m one-byte codes and candidates are scored from
+per-query lookup tables; the best `rerank` of them are then rescored exactly.
+
+Knobs, from fast to accurate: nprobe (lists probed), rerank (exact rescoring after PQ).
+The index is built from a trained model's item_emb.weight (row 0, the padding item, excluded)
+and is saved next to the checkpoint as <state_dict_path>.ivf.npz.
+
+usage:
+    python ann_index.py --dataset=MIND --state_dict_path=[YOUR_CKPT_PATH] --maxlen=200 --nlist=256 --pq_m=10
+"""
+
+import time
+import argparse
+import numpy as np
+
+
+def kmeans(x, k, niter=20, seed=0, max_points=256):
+    """Lloyd's k-means on at most k * max_points sampled rows, returns (k, C) centroids."""
+    rng = np.random.RandomState(seed)
+    if len(x) > k * max_points:
+        x = x[rng.choice(len(x), k * max_points, replace=False)]
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(niter):
+        assign = assign_nearest(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()))] # restart dead centroids
+    return centroids
+
+
+def assign_nearest(x, centroids, batch=65536):
+    c_sq = (centroids ** 2).sum(1)
+    out = np.empty(len(x), dtype=np.int64)
+    for b in range(0, len(x), batch):
+        out[b:b + batch] = np.argmin(c_sq[None, :] - 2 * x[b:b + batch] @ centroids.T, axis=1)
+    return out
+
+
+class IVFIndex(object):
+    def __init__(self, nlist=256, pq_m=0, nprobe=8, rerank=100, seed=0):
+        self.nlist, self.pq_m = nlist, pq_m
+        self.nprobe, self.rerank = nprobe, rerank
+        self.seed = seed
+
+    def build(self, vectors):
+        """Index vectors[0..N-1] as item ids 1..N (row 0 of item_emb.weight is not passed)."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.nlist = min(self.nlist, len(vectors))
+        self.centroids = kmeans(vectors, self.nlist, seed=self.seed)
+        assign = assign_nearest(vectors, self.centroids)
+        # vectors, ids and codes are stored grouped by list so a list is one contiguous block
+        order = np.argsort(assign, kind='stable')
+        self.vectors = vectors[order]
+        self.list_ids = (order + 1).astype(np.int64)
+        self.list_ptr = np.zeros(self.nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=self.nlist), out=self.list_ptr[1:])
+        self._index_positions()
+
+        if self.pq_m > 0:
+            C = vectors.shape[1]
+            self.sub_dim = -(-C // self.pq_m)
+            residual = self._pad(self.vectors - self.centroids[assign[order]])
+            self.codebooks = np.zeros((self.pq_m, 256, self.sub_dim), dtype=np.float32)
+            self.codes = np.zeros((len(vectors), self.pq_m), dtype=np.uint8)
+            for m in range(self.pq_m):
+                sub = np.ascontiguousarray(residual[:, m * self.sub_dim:(m + 1) * self.sub_dim])
+                ncode = min(256, len(sub))
+                self.codebooks[m, :ncode] = kmeans(sub, ncode, seed=self.seed + m + 1)
+                self.codes[:, m] = assign_nearest(sub, self.codebooks[m, :ncode])
+        return self
+
+    def _index_positions(self):
+        # row of every item id in the list-ordered arrays, id 0 (empty slot) maps to row 0
+        self.item_pos = np.zeros(len(self.list_ids) + 1, dtype=np.int64)
+        self.item_pos[self.list_ids] = np.arange(len(self.list_ids))
+
+    def _pad(self, x):
+        width = self.pq_m * self.sub_dim
+        if x.shape[1] == width:
+            return x
+        return np.concatenate([x, np.zeros((len(x), width - x.shape[1]), dtype=x.dtype)], axis=1)
+
+    def search(self, queries, k, nprobe=None, rerank=None, query_batch=64):
+        """Top-k (scores, item ids) by inner product for a (B, C) batch of queries."""
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        nprobe = min(self.nprobe if nprobe is None else nprobe, self.nlist)
+        rerank = self.rerank if rerank is None else rerank
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.zeros((len(queries), k), dtype=np.int64)
+        for b in range(0, len(queries), query_batch):
+            s, i = self._search_batch(queries[b:b + query_batch], k, nprobe, rerank)
+            scores[b:b + query_batch, :s.shape[1]], ids[b:b + query_batch, :i.shape[1]] = s, i
+        return scores, ids
+
+    def _search_batch(self, q, k, nprobe, rerank):
+        B = len(q)
+        coarse = q @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        # every query's candidates laid out list after list in one padded row
+        lens = self.list_ptr[probes + 1] - self.list_ptr[probes]
+        col_off = np.cumsum(lens, axis=1) - lens
+        width = max(int(lens.sum(1).max()), 1)
+        scores = np.full((B, width), -np.inf, dtype=np.float32)
+        ids = np.zeros((B, width), dtype=np.int64)
+        if self.pq_m > 0:
+            lut = np.einsum('bmd,mcd->bmc', self._pad(q).reshape(B, self.pq_m, self.sub_dim), self.codebooks)
+
+        # one gemm (or lookup-table pass) per probed list over the queries that probe it
+        for c in np.unique(probes):
+            rows, slots = np.nonzero(probes == c)
+            lo, hi = self.list_ptr[c], self.list_ptr[c + 1]
+            if hi == lo:
+                continue
+            cols = col_off[rows, slots][:, None] + np.arange(hi - lo)[None, :]
+            if self.pq_m > 0:
+                codes = self.codes[lo:hi]
+                part = lut[rows][:, np.arange(self.pq_m)[None, :], codes].sum(-1) + coarse[rows, c][:, None]
+            else:
+                part = q[rows] @ self.vectors[lo:hi].T
+            scores[rows[:, None], cols] = part
+            ids[rows[:, None], cols] = self.list_ids[lo:hi][None, :]
+
+        if self.pq_m > 0 and rerank > 0:
+            # rescore the best PQ candidates exactly
+            top = self._topk(scores, max(rerank, k))
+            ids = np.take_along_axis(ids, top, 1)
+            valid = np.take_along_axis(scores, top, 1) > -np.inf
+            exact = np.einsum('bkc,bc->bk', self.vectors[self.item_pos[ids]], q)
+            scores = np.where(valid, exact, -np.inf).astype(np.float32)
+
+        top = self._topk(scores, k)
+        top_scores = np.take_along_axis(scores, top, 1)
+        top_ids = np.where(top_scores > -np.inf, np.take_along_axis(ids, top, 1), 0)
+        return top_scores, top_ids
+
+    def _topk(self, scores, k):
+        # column indices of the k largest scores of every row, best first
+        k = min(k, scores.shape[1])
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        return np.take_along_axis(part, np.argsort(-np.take_along_axis(scores, part, 1), axis=1, kind='stable'), 1)
+
+    def save(self, path):
+        arrays = {'centroids': self.centroids, 'list_ids': self.list_ids, 'list_ptr': self.list_ptr,
+                  'vectors': self.vectors,
+                  'params': np.array([self.nlist, self.pq_m, self.nprobe, self.rerank, self.seed])}
+        if self.pq_m > 0:
+            arrays.update(codebooks=self.codebooks, codes=self.codes, sub_dim=np.array(self.sub_dim))
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        f = np.load(path)
+        nlist, pq_m, nprobe, rerank, seed = f['params'].tolist()
+        index = cls(nlist, pq_m, nprobe, rerank, seed)
+        for name in ['centroids', 'list_ids', 'list_ptr', 'vectors']:
+            setattr(index, name, f[name])
+        index._index_positions()
+        if pq_m > 0:
+            index.codebooks, index.codes, index.sub_dim = f['codebooks'], f['codes'], int(f['sub_dim'])
+        return index
+
+
+def index_path(state_dict_path):
+    return state_dict_path + '.ivf.npz'
+
+
+def build_from_model(model, nlist=256, pq_m=0, nprobe=8, rerank=100):
+    vectors = model.item_emb.weight.detach()[1:].float().cpu().numpy()
+    return IVFIndex(nlist, pq_m, nprobe, rerank).build(vectors)
+
+
+def recall_at_k(ann_ids, exact_ids):
+    """Mean fraction of the exact top-k ids that the approximate top-k recovered."""
+    hits = (ann_ids[:, :, None] == exact_ids[:, None, :]) & (exact_ids[:, None, :] > 0)
+    return float(hits.any(1).sum() / max((exact_ids > 0).sum(), 1))
+
+
+if __name__ == '__main__':
+    from model import add_model_args, load_model
+    from utils import data_partition, evaluate_full
+
+    parser = argparse.ArgumentParser(description='build an IVF(-PQ) item index next to a checkpoint and measure recall')
+    add_model_args(parser)
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--nlist', default=256, type=int)
+    parser.add_argument('--pq_m', default=0, type=int, help='PQ sub-quantizers, 0 for exact scoring inside lists')
+    parser.add_argument('--rerank', default=100, type=int, help='PQ candidates rescored exactly, 0 to disable')
+    parser.add_argument('--nprobe', default='1,4,16', type=str, help='comma separated nprobe values to measure')
+    parser.add_argument('--k', default=10, type=int)
+    parser.add_argument('--eval_batch_size', default=256, type=int)
+    parser.add_argument('--eval_item_chunk', default=65536, type=int)
+    args = parser.parse_args()
+
+    model = load_model(args)
+    t = time.time()
+    index = build_from_model(model, args.nlist, args.pq_m, rerank=args.rerank)
+    print('built IVF index: %d items, nlist=%d, pq_m=%d in %.2f(s)' % (len(index.vectors), index.nlist, index.pq_m, time.time() - t))
+    index.save(index_path(args.state_dict_path))
+    print('saved to %s' % index_path(args.state_dict_path))
+
+    dataset = data_partition(args.dataset)
+    for nprobe in [int(p) for p in args.nprobe.split(',')]:
+        index.nprobe = nprobe
+        t = time.time()
+        t_test = evaluate_full(model, dataset, args, split='test', ann_index=index, ann_k=args.k)
+        print('nprobe=%d recall@%d vs exact: %.4f, ann search %.2f(s), exact %.2f(s), eval total %.2f(s)'
+              % (nprobe, args.k, t_test['ANN_Recall@%d' % args.k], t_test['ann_time'], t_test['exact_time'], time.time() - t))
@@ -0,0 +1,669 @@
+"""
+CPU benchmark suite: sampler, log2feats forward / forward+backward, training step, predict and
+evaluation over a grid of maxlen x hidden_units x num_blocks x batch_size, on the bundled
+datasets and on synthetic ones, with results written as JSON and compared against a baseline.
+
+    sampler    WarpSampler.next_batch, ms per batch (--sampler, --num_workers)
+    forward    log2feats in eval mode under no_grad
+    fwd_bwd    log2feats in train mode + backward of its sum
+    train      forward, masked BCE + l2_emb loss, backward and optimizer step(s), as main.py (--sparse_emb)
+    predict    predict() of batch_size users x 101 items (final_feats path)
+    eval       evaluate_split on the test split (--eval_users users, 100 negatives, --eval_workers processes)
+    eval_full  evaluate_full on the test split (whole catalog), only with --full_rank
+    engine     per --engine_modes entry <engine>-<path>: forward, fwd_bwd and predict as above on the
+               legacy (MultiheadAttention, Conv1d FFN) or fast (fused SDPA, Linear FFN) engine,
+               and predict_all, predict with every position through the final block (before
+               final_feats); --engine does not apply
+    loss       train step per --losses entry (main.py --loss, losses.py): bce, sampled_softmax
+               (--num_neg shared negatives), full_softmax (chunked), naive_softmax (reference,
+               materialized logits, skipped above --naive_limit_mb), with peak RSS and the RSS
+               growth of the steps over the setup (loss_rss_mb)
+    memory     optimizer step over --effective_batch full-length random sequences as micro-batches
+               of batch_size (accum = effective_batch / batch_size), per --memory_modes entry:
+               plain, or checkpointed (main.py --checkpoint_activations, --accum_steps); peak RSS
+               and whether it fits --mem_budget_mb. A failed or over-budget config skips the later
+               (larger) maxlens of its row, so list --maxlens in ascending order
+    compile    --compile_steps training steps per --compile_modes entry (eager / torch.compile x
+               fp32 / bf16 autocast, main.py --compile --precision) from the same initialization on
+               the same batches, then the sampled evaluation: step ms, compile_s, final loss and
+               valid/test NDCG@10, HR@10
+    sparse_emb train step per --sparse_emb_modes entry: dense (Adam over the whole item table) or
+               sparse (main.py --sparse_emb: sparse item_emb gradient, SparseAdam on the touched rows),
+               with the item_emb gradient and optimizer state sizes after the steps and peak RSS
+
+Synthetic datasets are named synthetic:<users>:<items>:<dist>:<mean_len>[:<seed>] with dist one of
+uniform, lognormal, zipf (history lengths); item popularity is power law with --syn_item_alpha.
+They are generated once and cached as data/<name>.csr like the text datasets.
+
+Models are randomly initialized, timings do not depend on training. Every timing is the median
+of --reps runs after --warmup runs; ms values are per call (per batch for sampler/train/compile).
+Benchmarks with modes (loss, memory, compile, sparse_emb; not engine) run every mode in its own process (isolated), so thread settings,
+compilation caches and peak RSS do not leak from one mode into the next.
+
+usage:
+    python benchmark.py --datasets=MIND,synthetic:100000:1000000:lognormal:50 --maxlens=50,200 --out=bench.json
+    python benchmark.py --datasets=MIND --baseline=bench.json --out=bench_new.json   # run and compare
+    python benchmark.py --compare bench.json bench_new.json --threshold=0.1           # compare two files
+    python benchmark.py --benches=memory --maxlens=200,1000,2000,4000 --batch_sizes=128,32,8 --mem_budget_mb=16000
+    python benchmark.py --benches=engine --maxlens=50,200 --hidden=50,128
+    python benchmark.py --benches=compile --maxlens=200 --compile_modes=eager-fp32,compile-bf16
+    python benchmark.py --benches=loss --datasets=synthetic:20000:1000000:lognormal:30 --num_neg=1024
+    python benchmark.py --benches=sparse_emb --datasets=synthetic:20000:100000:lognormal:30,synthetic:20000:1000000:lognormal:30
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import argparse
+import platform
+import itertools
+import subprocess
+import multiprocessing
+import numpy as np
+import torch
+
+from dataset import cache_path, compile_arrays, csr_layout, history_keys, published_dir, write_compiled, CompiledDataset
+from model import build_model
+from losses import LOSSES, NegativeSampler, full_softmax_loss, sampled_softmax_loss
+from telemetry import peak_rss_mb
+from utils import (CompiledOrEager, WarpSampler, build_batch, build_optimizers, data_partition, evaluate, evaluate_full,
+                   evaluate_split, evaluate_valid, l2_emb_loss, masked_bce_loss, right_aligned)
+
+BENCHES = ['sampler', 'forward', 'fwd_bwd', 'train', 'predict', 'eval', 'eval_full', 'engine', 'loss', 'memory', 'compile', 'sparse_emb']
+COMPILE_MODES = ['eager-fp32', 'eager-bf16', 'compile-fp32', 'compile-bf16']
+ENGINE_MODES = ['%s-%s' % (e, p) for p in ['forward', 'fwd_bwd', 'predict_all', 'predict'] for e in ['legacy', 'fast']]
+LOSS_MODES = LOSSES + ['naive_softmax']
+MEMORY_MODES = ['plain', 'checkpointed']
+SPARSE_EMB_MODES = ['dense', 'sparse']
+
+
+def synthetic_dataset(spec, item_alpha=1.0):
+    """[train, valid, test, usernum, itemnum] for a 'synthetic:users:items:dist:mean_len[:seed]' spec."""
+    parts = spec.split(':')
+    usernum, itemnum, dist, mean_len = int(parts[1]), int(parts[2]), parts[3], float(parts[4])
+    seed = int(parts[5]) if len(parts) > 5 else 0
+    name = 'synthetic_u%d_i%d_%s%g_a%g_s%d' % (usernum, itemnum, dist, mean_len, item_alpha, seed)
+    path = cache_path(name)
+    if published_dir(path) is None:
+        rng = np.random.RandomState(seed)
+        if dist == 'uniform':
+            lens = rng.randint(3, int(2 * mean_len) - 2, size=usernum)
+        elif dist == 'lognormal': # long tail of heavy users, median below the mean
+            lens = rng.lognormal(np.log(mean_len) - 0.5, 1.0, size=usernum).astype(np.int64)
+        elif dist == 'zipf':
+            lens = np.minimum(rng.zipf(1.0 + 1.0 / max(mean_len - 1.0, 1e-3), size=usernum), 100 * int(mean_len))
+        else:
+            raise ValueError('unknown length distribution %s' % dist)
+        lens = np.maximum(lens, 3)
+        users = np.repeat(np.arange(1, usernum + 1), lens)
+        # power-law popularity over item ids, inverse CDF of p(i) ~ i^-alpha on [1, itemnum]
+        u = rng.random_sample(len(users))
+        if abs(item_alpha - 1.0) < 1e-6:
+            items = np.exp(u * np.log(itemnum + 1))
+        else:
+            a = 1.0 - item_alpha
+            items = (1 + u * ((itemnum + 1) ** a - 1)) ** (1.0 / a)
+        items = np.clip(items.astype(np.int64), 1, itemnum)
+        arrays, _, _ = compile_arrays(users, items, usernum, itemnum)
+        write_compiled(path, arrays, usernum, itemnum)
+    compiled = CompiledDataset(path)
+    return list(compiled.splits()) + [compiled.usernum, compiled.itemnum]
+
+
+def load_dataset(name, item_alpha):
+    return synthetic_dataset(name, item_alpha) if name.startswith('synthetic:') else data_partition(name)
+
+
+def timed(fn, reps, warmup, setup=None):
+    """Median / min / std ms of fn() over reps calls after warmup calls. With setup, every call is
+    fn(setup()) and setup (e.g. building the next batch) runs outside the timed region."""
+    times = []
+    for r in range(reps + warmup):
+        arg = () if setup is None else (setup(),)
+        t = time.perf_counter()
+        fn(*arg)
+        if r >= warmup:
+            times.append(time.perf_counter() - t)
+    times = np.array(times) * 1e3
+    return {'ms': float(np.median(times)), 'ms_min': float(times.min()), 'ms_std': float(times.std())}
+
+
+def _isolated_main(fn, fn_args, out):
+    try:
+        out.put(fn(*fn_args))
+    except Exception as e: # reported in the result, the parent keeps going
+        out.put({'error': repr(e)})
+
+
+def isolated(fn, *fn_args):
+    """fn(*fn_args) in a fresh spawned process, returns its result or {'error': ...} when fn
+    raised or the process died (e.g. killed by the OOM killer). fn must be a module-level function."""
+    ctx = multiprocessing.get_context('spawn')
+    out = ctx.Queue()
+    p = ctx.Process(target=_isolated_main, args=(fn, fn_args, out))
+    p.start()
+    while True: # read before join, a large result would block the child's exit
+        try:
+            result = out.get(timeout=1.0)
+            break
+        except queue.Empty:
+            if not p.is_alive():
+                try:
+                    result = out.get(timeout=1.0)
+                except queue.Empty:
+                    result = {'error': 'exit code %s' % p.exitcode}
+                break
+    p.join()
+    return result
+
+
+def model_args(args, maxlen, hidden, blocks, batch_size):
+    return argparse.Namespace(device='cpu', maxlen=maxlen, hidden_units=hidden, num_blocks=blocks,
+                              num_heads=args.num_heads, dropout_rate=0.2, norm_first=args.norm_first,
+                              engine=args.engine, sparse_emb=args.sparse_emb, lr=0.001, l2_emb=0.0,
+                              batch_size=batch_size, eval_batch_size=args.eval_batch_size,
+                              eval_item_chunk=args.eval_item_chunk, eval_users=args.eval_users, eval_workers=args.eval_workers)
+
+
+def bench_sampler(args, dataset, maxlen, batch_size):
+    [train, valid, test, usernum, itemnum] = dataset
+    sampler = WarpSampler(train, usernum, itemnum, batch_size=batch_size, maxlen=maxlen,
+                          n_workers=args.num_workers, sampler=args.sampler, bucket_pool=args.bucket_pool)
+    try:
+        for _ in range(args.num_workers * 10): # drain the prefilled ring, then measure the producer rate
+            sampler.next_batch()
+        out = timed(sampler.next_batch, args.reps * 20, 0)
+    finally:
+        sampler.close()
+    out['samples_per_s'] = batch_size * 1e3 / out['ms']
+    return out
+
+
+def history_batch(dataset, B, T, rng):
+    """(seq, pos, neg) of B random users' real histories, pos the next items, random negatives."""
+    [train, valid, test, usernum, itemnum] = dataset
+    users = rng.choice(train.keys_array(), size=B)
+    seq = right_aligned(train.data, train.starts, train.ends, users, T + 1)
+    seq, pos = seq[:, :-1], seq[:, 1:] # next-item targets of real histories
+    neg = np.where(pos > 0, rng.randint(1, itemnum + 1, size=pos.shape), 0)
+    return seq, pos, neg
+
+
+def bench_model(args, dataset, bench, m_args, rng):
+    [train, valid, test, usernum, itemnum] = dataset
+    B = m_args.batch_size
+    seq, pos, neg = history_batch(dataset, B, m_args.maxlen, rng)
+    torch.manual_seed(0)
+    model = build_model(usernum, itemnum, m_args)
+
+    if bench == 'forward':
+        model.eval()
+        def fn():
+            with torch.no_grad():
+                model.log2feats(seq)
+    elif bench == 'fwd_bwd':
+        model.train()
+        def fn():
+            model.log2feats(seq).sum().backward()
+            model.zero_grad(set_to_none=True)
+    elif bench == 'train':
+        model.train()
+        optimizers = build_optimizers(model, m_args)
+        mask = torch.as_tensor(pos != 0)
+        def fn():
+            pos_logits, neg_logits = model(None, seq, pos, neg)
+            for optimizer in optimizers: optimizer.zero_grad()
+            loss = masked_bce_loss(pos_logits, neg_logits, mask)
+            loss += l2_emb_loss(model, seq, pos, neg, m_args)
+            loss.backward()
+            for optimizer in optimizers: optimizer.step()
+    elif bench == 'predict':
+        model.eval()
+        items = rng.randint(1, itemnum + 1, size=(B, 101))
+        def fn():
+            with torch.no_grad():
+                model.predict(None, seq, items)
+    elif bench == 'predict_all': # predict before final_feats: every position through every block
+        model.eval()
+        items = torch.LongTensor(rng.randint(1, itemnum + 1, size=(B, 101)))
+        def fn():
+            with torch.no_grad():
+                feats = model.log2feats(seq)[:, -1, :]
+                model.item_emb(items).matmul(feats.unsqueeze(-1))
+    out = timed(fn, args.reps, args.warmup)
+    out['samples_per_s'] = B * 1e3 / out['ms']
+    out['tokens_per_s'] = np.count_nonzero(seq) * 1e3 / out['ms']
+    return out
+
+
+def bench_loss(args, name, m_args, mode):
+    """Train step (forward, loss, backward, Adam) with one loss mode and its memory. Run isolated."""
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    dataset = load_dataset(name, args.syn_item_alpha)
+    [train, valid, test, usernum, itemnum] = dataset
+    torch.manual_seed(0)
+    model = build_model(usernum, itemnum, m_args).train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=m_args.lr, betas=(0.9, 0.98))
+    neg_sampler = NegativeSampler(itemnum)
+    seq, pos, neg = [torch.from_numpy(a) for a in history_batch(dataset, m_args.batch_size, m_args.maxlen, np.random.RandomState(0))]
+    mask = pos != 0
+    base_rss = peak_rss_mb()
+
+    def step():
+        optimizer.zero_grad()
+        if mode == 'bce':
+            pos_logits, neg_logits = model(None, seq, pos, neg)
+            loss = masked_bce_loss(pos_logits, neg_logits, mask)
+        else:
+            feats = model(None, seq, None, None)[mask]
+            targets = pos[mask].long()
+            if mode == 'sampled_softmax':
+                loss = sampled_softmax_loss(feats, model.item_emb, targets, neg_sampler.sample(args.num_neg), neg_sampler.log_q)
+            elif mode == 'full_softmax':
+                loss = full_softmax_loss(feats, model.item_emb.weight, targets, args.softmax_item_chunk, args.softmax_row_chunk)
+            else:
+                loss = torch.nn.functional.cross_entropy(feats @ model.item_emb.weight[1:].t(), targets - 1)
+        loss.backward()
+        optimizer.step()
+    out = timed(step, args.reps, args.warmup)
+    peak = peak_rss_mb() # None without the resource module (Windows)
+    out.update(samples_per_s=m_args.batch_size * 1e3 / out['ms'], peak_rss_mb=peak,
+               loss_rss_mb=None if peak is None else peak - base_rss)
+    return out
+
+
+def bench_memory(args, name, m_args, mode):
+    """Optimizer steps over --effective_batch sequences in micro-batches, and peak RSS. Run isolated."""
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    itemnum = load_dataset(name, args.syn_item_alpha)[4]
+    m_args = argparse.Namespace(**dict(vars(m_args), checkpoint_activations=mode == 'checkpointed'))
+    B, T = m_args.batch_size, m_args.maxlen
+    torch.manual_seed(0)
+    model = build_model(0, itemnum, m_args).train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=m_args.lr, betas=(0.9, 0.98))
+    accum = max(1, args.effective_batch // B)
+    rng = np.random.RandomState(0)
+
+    def step():
+        optimizer.zero_grad()
+        for _ in range(accum): # full-length sequences, the worst case (no padding)
+            seq, pos, neg = [torch.from_numpy(rng.randint(1, itemnum + 1, size=(B, T))) for _ in range(3)]
+            pos_logits, neg_logits = model(None, seq, pos, neg)
+            (masked_bce_loss(pos_logits, neg_logits, pos != 0) / accum).backward()
+        optimizer.step()
+    out = timed(step, args.reps, args.warmup)
+    out.update(accum=accum, tokens_per_s=accum * B * T * 1e3 / out['ms'], peak_rss_mb=peak_rss_mb())
+    return out
+
+
+def bench_compile(args, name, m_args, mode):
+    """--compile_steps training steps of one compile mode, then the sampled evaluation. Run isolated."""
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    compile_, precision = mode.split('-')
+    dataset = load_dataset(name, args.syn_item_alpha)
+    [train, valid, test, usernum, itemnum] = dataset
+    torch.manual_seed(0)
+    model = build_model(usernum, itemnum, m_args)
+    for _, param in model.named_parameters(): # main.py's initialization, the metrics are compared
+        try:
+            torch.nn.init.xavier_normal_(param.data)
+        except ValueError:
+            pass
+    model.pos_emb.weight.data[0, :] = 0
+    model.item_emb.weight.data[0, :] = 0
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=m_args.lr, betas=(0.9, 0.98))
+    step_model = CompiledOrEager(model) if compile_ == 'compile' else model
+    autocast = torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+    data, starts, ends, present = csr_layout(train)
+    hist_keys = history_keys(data, starts, ends, itemnum)
+    users = np.flatnonzero(present & (ends - starts > 1))
+    np.random.seed(0) # the same batches for every mode
+    def next_batch():
+        return [torch.from_numpy(a) for a in build_batch(np.random.choice(users, m_args.batch_size), data, starts, ends,
+                                                         hist_keys, itemnum, m_args.maxlen)]
+    losses = []
+    def step(batch):
+        u, seq, pos, neg = batch
+        with autocast:
+            pos_logits, neg_logits = step_model(u, seq, pos, neg)
+        loss = masked_bce_loss(pos_logits, neg_logits, pos != 0)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    warmup = min(args.warmup, args.compile_steps - 1)
+    out = timed(step, args.compile_steps - warmup, warmup, setup=next_batch)
+
+    model.eval()
+    random.seed(0)
+    np.random.seed(0)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w') # evaluate_* print progress dots
+    try:
+        t_valid = evaluate_valid(model, dataset, m_args)
+        t_test = evaluate(model, dataset, m_args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    compiled = getattr(step_model, 'compiled', False)
+    out.update(compiled=compiled, compile_s=step_model.compile_time if compile_ == 'compile' else 0.0,
+               samples_per_s=m_args.batch_size * 1e3 / out['ms'], loss=float(np.mean(losses[-max(1, len(losses) // 10):])),
+               valid_ndcg=t_valid['NDCG@10'], valid_hr=t_valid['HR@10'], test_ndcg=t_test['NDCG@10'], test_hr=t_test['HR@10'])
+    return out
+
+
+def tensor_bytes(t):
+    if t.is_sparse:
+        t = t.coalesce()
+        return tensor_bytes(t.indices()) + tensor_bytes(t.values())
+    return t.element_size() * t.nelement()
+
+
+def bench_sparse_emb(args, name, m_args, mode):
+    """Train step with dense or sparse item embedding updates, the item_emb gradient and optimizer
+    state sizes after it, and peak RSS. Run isolated."""
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    dataset = load_dataset(name, args.syn_item_alpha)
+    itemnum = dataset[4]
+    m_args = argparse.Namespace(**dict(vars(m_args), sparse_emb=mode == 'sparse'))
+    torch.manual_seed(0)
+    model = build_model(0, itemnum, m_args).train()
+    optimizers = build_optimizers(model, m_args)
+    rng = np.random.RandomState(0)
+    def next_batch(): # a fresh batch per step, the sparse update touches different rows each time
+        return [torch.from_numpy(a) for a in history_batch(dataset, m_args.batch_size, m_args.maxlen, rng)]
+    def step(batch):
+        seq, pos, neg = batch
+        pos_logits, neg_logits = model(None, seq, pos, neg)
+        for optimizer in optimizers: optimizer.zero_grad()
+        loss = masked_bce_loss(pos_logits, neg_logits, pos != 0)
+        loss += l2_emb_loss(model, seq, pos, neg, m_args)
+        loss.backward()
+        for optimizer in optimizers: optimizer.step()
+    out = timed(step, args.reps, args.warmup, setup=next_batch)
+    state_bytes = sum(tensor_bytes(v) for optimizer in optimizers for s in optimizer.state.values()
+                      for v in s.values() if torch.is_tensor(v))
+    out.update(samples_per_s=m_args.batch_size * 1e3 / out['ms'], grad_mb=tensor_bytes(model.item_emb.weight.grad) / 2 ** 20,
+               optim_state_mb=state_bytes / 2 ** 20, peak_rss_mb=peak_rss_mb())
+    return out
+
+
+def bench_eval(args, dataset, bench, m_args):
+    [train, valid, test, usernum, itemnum] = dataset
+    torch.manual_seed(0)
+    model = build_model(usernum, itemnum, m_args).eval()
+    fn = evaluate_full if bench == 'eval_full' else evaluate_split
+    times = []
+    for r in range(max(args.eval_reps, 1)):
+        random.seed(r)
+        np.random.seed(r)
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w') # evaluate_* print progress dots
+        try:
+            t = time.perf_counter()
+            fn(model, dataset, m_args, split='test')
+            times.append(time.perf_counter() - t)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    times = np.array(times) * 1e3
+    return {'ms': float(np.median(times)), 'ms_min': float(times.min()), 'ms_std': float(times.std())}
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return {'torch': torch.__version__, 'numpy': np.__version__, 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'num_threads': torch.get_num_threads(), 'commit': commit, 'time': time.time()}
+
+
+def record_key(r):
+    return tuple(r.get(k) for k in ['dataset', 'bench', 'mode', 'engine', 'sampler', 'maxlen', 'hidden_units', 'num_blocks', 'batch_size'])
+
+
+def bench_label(r):
+    return r['bench'] if r.get('mode') is None else '%s/%s' % (r['bench'], r['mode'])
+
+
+def bench_modes(args, bench):
+    if bench == 'loss':
+        return args.losses.split(',')
+    if bench == 'memory':
+        return args.memory_modes.split(',')
+    if bench == 'compile':
+        return args.compile_modes.split(',')
+    if bench == 'sparse_emb':
+        return args.sparse_emb_modes.split(',')
+    if bench == 'engine':
+        return args.engine_modes.split(',')
+    return [None]
+
+
+def memory_budget_mb(args):
+    if args.mem_budget_mb is not None:
+        return args.mem_budget_mb
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 20
+    except (AttributeError, ValueError, OSError): # no sysconf (Windows), nothing is flagged
+        return None
+
+
+def extra_columns(r):
+    if r['bench'] == 'memory':
+        return '  accum %d, %.0f tokens/s, peak RSS %s MB, fits: %s' % (
+            r['accum'], r['tokens_per_s'], 'n/a' if r['peak_rss_mb'] is None else '%.1f' % r['peak_rss_mb'], r['fits'])
+    if r['bench'] == 'loss' and r['peak_rss_mb'] is not None:
+        return '  peak RSS %.1f MB, loss RSS %.1f MB' % (r['peak_rss_mb'], r['loss_rss_mb'])
+    if r['bench'] == 'compile':
+        return '  compile %.1fs%s, loss %.4f, valid NDCG@10 %.4f, test NDCG@10 %.4f' % (
+            r['compile_s'], '' if r['compiled'] or r['mode'].startswith('eager') else ' (eager fallback)',
+            r['loss'], r['valid_ndcg'], r['test_ndcg'])
+    if r['bench'] == 'sparse_emb':
+        return '  grad %.2f MB, optim state %.2f MB, peak RSS %s MB' % (
+            r['grad_mb'], r['optim_state_mb'], 'n/a' if r['peak_rss_mb'] is None else '%.1f' % r['peak_rss_mb'])
+    return ''
+
+
+def compile_summary(results):
+    """Speedup and metric deltas of every compile mode against eager-fp32 of the same config."""
+    base = {record_key(dict(r, mode=None)): r for r in results if r['bench'] == 'compile' and r['mode'] == 'eager-fp32'}
+    for r in results:
+        b = base.get(record_key(dict(r, mode=None))) if r['bench'] == 'compile' else None
+        if b is not None and r is not b:
+            print('  %-22s vs eager-fp32: %.2fx step, valid NDCG@10 %+.4f, test NDCG@10 %+.4f' % (
+                bench_label(r), b['ms'] / r['ms'], r['valid_ndcg'] - b['valid_ndcg'], r['test_ndcg'] - b['test_ndcg']))
+
+
+def engine_summary(results):
+    """Speedup of fast over legacy per path, and of last-position predict over predict_all per engine."""
+    by_mode = {(record_key(dict(r, mode=None)), r['mode']): r for r in results if r['bench'] == 'engine'}
+    for (key, mode), r in by_mode.items():
+        engine, path = mode.split('-')
+        b = by_mode.get((key, 'legacy-' + path)) if engine == 'fast' else None
+        if b is not None:
+            print('  %-22s maxlen=%-4d hidden=%-4s vs legacy: %.2fx' % (bench_label(r), r['maxlen'], r['hidden_units'], b['ms'] / r['ms']))
+        b = by_mode.get((key, engine + '-predict_all')) if path == 'predict' else None
+        if b is not None:
+            print('  %-22s maxlen=%-4d hidden=%-4s vs predict_all: %.2fx' % (bench_label(r), r['maxlen'], r['hidden_units'], b['ms'] / r['ms']))
+
+
+def sparse_emb_summary(results):
+    """Step speedup and optimizer state of sparse against dense item embedding updates of the same config."""
+    base = {record_key(dict(r, mode=None)): r for r in results if r['bench'] == 'sparse_emb' and r['mode'] == 'dense'}
+    for r in results:
+        b = base.get(record_key(dict(r, mode=None))) if r['bench'] == 'sparse_emb' else None
+        if b is not None and r is not b:
+            print('  %-22s vs dense: %.2fx step, optim state %.2f MB vs %.2f MB' % (
+                bench_label(r), b['ms'] / r['ms'], r['optim_state_mb'], b['optim_state_mb']))
+
+
+def run(args):
+    benches = [b for b in args.benches.split(',') if b != 'eval_full' or args.full_rank]
+    grid = list(itertools.product([int(x) for x in args.maxlens.split(',')], [int(x) for x in args.hidden.split(',')],
+                                  [int(x) for x in args.blocks.split(',')], [int(x) for x in args.batch_sizes.split(',')]))
+    budget = memory_budget_mb(args) if 'memory' in benches else None
+    results = []
+    for name in args.datasets.split(','):
+        t = time.time()
+        dataset = load_dataset(name, args.syn_item_alpha)
+        [train, valid, test, usernum, itemnum] = dataset
+        print('%s: %d users, %d items, %d train interactions (loaded in %.1fs)'
+              % (name, usernum, itemnum, int(train.lengths().sum()), time.time() - t))
+        done = set()
+        blocked = set() # memory rows whose smaller maxlen did not fit
+        for maxlen, hidden, blocks, batch_size in grid:
+            m_args = model_args(args, maxlen, hidden, blocks, batch_size)
+            for bench in benches:
+                for mode in bench_modes(args, bench):
+                    config = {'dataset': name, 'bench': bench, 'mode': mode, 'engine': args.engine, 'maxlen': maxlen,
+                              'hidden_units': hidden, 'num_blocks': blocks, 'batch_size': batch_size}
+                    # drop the grid axes a benchmark does not depend on so it runs once per distinct setting
+                    if bench == 'sampler':
+                        config.update(engine=None, hidden_units=None, num_blocks=None, sampler=args.sampler)
+                    if bench in ('eval', 'eval_full'):
+                        config.update(batch_size=None)
+                    if bench == 'engine': # the mode names the engine
+                        config.update(engine=None)
+                    if record_key(config) in done:
+                        continue
+                    done.add(record_key(config))
+                    row = record_key(dict(config, maxlen=None))
+                    if row in blocked:
+                        print('  %-22s maxlen=%-4d skipped, a smaller maxlen did not fit' % (bench_label(config), maxlen))
+                        continue
+                    if bench == 'sampler':
+                        out = bench_sampler(args, dataset, maxlen, batch_size)
+                    elif bench in ('eval', 'eval_full'):
+                        out = bench_eval(args, dataset, bench, m_args)
+                    elif bench == 'loss':
+                        # the (N, itemnum) fp32 logits and their gradient, at most every position real
+                        logits_mb = 2 * batch_size * maxlen * itemnum * 4 / 2 ** 20
+                        if mode == 'naive_softmax' and logits_mb > args.naive_limit_mb:
+                            print('  %-22s maxlen=%-4d skipped, up to %.0f MB of logits' % (bench_label(config), maxlen, logits_mb))
+                            continue
+                        out = isolated(bench_loss, args, name, m_args, mode)
+                    elif bench == 'memory':
+                        out = isolated(bench_memory, args, name, m_args, mode)
+                        if 'error' not in out:
+                            out['fits'] = budget is None or out['peak_rss_mb'] is None or out['peak_rss_mb'] <= budget
+                        if 'error' in out or not out['fits']:
+                            blocked.add(row)
+                    elif bench == 'compile':
+                        out = isolated(bench_compile, args, name, m_args, mode)
+                    elif bench == 'sparse_emb':
+                        out = isolated(bench_sparse_emb, args, name, m_args, mode)
+                    elif bench == 'engine':
+                        engine, path = mode.split('-')
+                        out = bench_model(args, dataset, path, argparse.Namespace(**dict(vars(m_args), engine=engine)),
+                                          np.random.RandomState(0))
+                    else:
+                        out = bench_model(args, dataset, bench, m_args, np.random.RandomState(0))
+                    if 'error' in out:
+                        print('  %-22s maxlen=%-4d failed: %s' % (bench_label(config), maxlen, out['error']))
+                        continue
+                    config.update(out)
+                    results.append(config)
+                    print('  %-22s maxlen=%-4d hidden=%-4s blocks=%-2s batch=%-5s %10.2f ms%s' % (
+                        bench_label(config), maxlen, config['hidden_units'], config['num_blocks'], config['batch_size'], out['ms'],
+                        extra_columns(config)))
+        compile_summary([r for r in results if r['dataset'] == name])
+        engine_summary([r for r in results if r['dataset'] == name])
+        sparse_emb_summary([r for r in results if r['dataset'] == name])
+    return results
+
+
+def compare(baseline, current, threshold):
+    """Print current vs baseline per benchmark, return the regressed records (slower by > threshold)."""
+    base = {record_key(r): r for r in baseline['results']}
+    regressions = []
+    print('%-34s %-22s %-22s %10s %10s %8s' % ('dataset', 'bench', 'maxlen/hidden/blocks/bs', 'base ms', 'new ms', 'ratio'))
+    for r in current['results']:
+        b = base.get(record_key(r))
+        if b is None:
+            continue
+        ratio = r['ms'] / b['ms']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(r)
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print('%-34s %-22s %-22s %10.2f %10.2f %7.2fx%s' % (r['dataset'][:34], bench_label(r), '%s/%s/%s/%s' % (
+            r['maxlen'], r['hidden_units'], r['num_blocks'], r['batch_size']), b['ms'], r['ms'], ratio, flag))
+    print('%d regression(s) beyond %.0f%% (baseline commit %s, current %s)'
+          % (len(regressions), 100 * threshold, baseline['environment'].get('commit'), current['environment'].get('commit')))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SASRec CPU benchmark suite')
+    parser.add_argument('--datasets', default='MIND', type=str,
+                        help='comma separated: bundled names (MIND, Video, wikipedia) or synthetic:users:items:dist:mean_len[:seed]')
+    parser.add_argument('--benches', default='sampler,forward,fwd_bwd,train,predict,eval', type=str, help=', '.join(BENCHES))
+    parser.add_argument('--maxlens', default='50,200', type=str)
+    parser.add_argument('--hidden', default='50', type=str)
+    parser.add_argument('--blocks', default='2', type=str)
+    parser.add_argument('--batch_sizes', default='128', type=str)
+    parser.add_argument('--num_heads', default=1, type=int)
+    parser.add_argument('--norm_first', action='store_true', default=False)
+    parser.add_argument('--engine', default='legacy', choices=['legacy', 'fast'])
+    parser.add_argument('--sparse_emb', default=False, action='store_true')
+    parser.add_argument('--sampler', default='vectorized', choices=['loop', 'vectorized', 'bucketed'])
+    parser.add_argument('--bucket_pool', default=32, type=int)
+    parser.add_argument('--num_workers', default=1, type=int)
+    parser.add_argument('--eval_batch_size', default=256, type=int)
+    parser.add_argument('--eval_item_chunk', default=65536, type=int)
+    parser.add_argument('--eval_users', default=10000, type=int, help='0: all users')
+    parser.add_argument('--eval_workers', default=1, type=int)
+    parser.add_argument('--full_rank', default=False, action='store_true', help='also run eval_full')
+    parser.add_argument('--engine_modes', default=','.join(ENGINE_MODES), type=str, help=', '.join(ENGINE_MODES))
+    parser.add_argument('--losses', default=','.join(LOSS_MODES), type=str, help=', '.join(LOSS_MODES))
+    parser.add_argument('--num_neg', default=1024, type=int, help='negatives per batch of sampled_softmax')
+    parser.add_argument('--softmax_item_chunk', default=8192, type=int)
+    parser.add_argument('--softmax_row_chunk', default=4096, type=int)
+    parser.add_argument('--naive_limit_mb', default=4096, type=float, help='skip naive_softmax when its logits may exceed this')
+    parser.add_argument('--memory_modes', default=','.join(MEMORY_MODES), type=str, help=', '.join(MEMORY_MODES))
+    parser.add_argument('--effective_batch', default=128, type=int, help='sequences per optimizer step of the memory bench')
+    parser.add_argument('--mem_budget_mb', default=None, type=float, help='memory bench budget, default: physical memory')
+    parser.add_argument('--compile_modes', default=','.join(COMPILE_MODES), type=str, help=', '.join(COMPILE_MODES))
+    parser.add_argument('--compile_steps', default=300, type=int, help='training steps per compile mode')
+    parser.add_argument('--sparse_emb_modes', default=','.join(SPARSE_EMB_MODES), type=str, help=', '.join(SPARSE_EMB_MODES))
+    parser.add_argument('--syn_item_alpha', default=1.0, type=float, help='power-law exponent of synthetic item popularity')
+    parser.add_argument('--reps', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--eval_reps', default=1, type=int)
+    parser.add_argument('--num_threads', default=None, type=int)
+    parser.add_argument('--out', default=None, type=str, help='write results to this JSON file')
+    parser.add_argument('--baseline', default=None, type=str, help='compare the run against this JSON file')
+    parser.add_argument('--compare', nargs=2, default=None, metavar=('BASELINE', 'CURRENT'), help='only compare two result files')
+    parser.add_argument('--threshold', default=0.1, type=float, help='relative slowdown flagged as a regression')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    current = {'environment': environment(), 'args': vars(args), 'results': run(args)}
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(current, f, indent=1)
+        print('results written to %s' % args.out)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
@@ -0,0 +1,194 @@
+"""
+Full-state training checkpoints, written atomically by a background thread with retention.
+
+A checkpoint holds everything needed to continue a run where it stopped:
+
+    model        model.state_dict()
+    optimizers   [optimizer.state_dict(), ...] (Adam moments, or SparseAdam + Adam)
+    epoch, step  last finished epoch and global optimizer step
+    micro_step   micro-batches trained (differs from step with --accum_steps > 1)
+    evals_since_best  evaluations without a better valid NDCG@10, for --early_stop_patience
+    best         best validation/test metrics so far
+    rng          python, numpy, torch (and CUDA) generator states of the training process
+    sampler_seed base seed of the WarpSampler workers, re-derived per resumed epoch
+    args         the run's arguments, for reference
+
+save() copies the tensors to CPU on the caller's thread (a memcpy) and returns; serialization and
+disk I/O happen on the writer thread. Files are written to a temporary name, fsynced and renamed,
+so a crash leaves either the old or the new checkpoint. checkpoints.json next to them lists the
+kept files, newest last; resume reads it instead of parsing file names.
+
+usage (main.py):
+    python main.py --dataset=MIND --train_dir=default --resume=true     # continue from the latest checkpoint
+"""
+
+import os
+import json
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+MANIFEST = 'checkpoints.json'
+
+
+def to_cpu(obj):
+    """Deep copy of nested dicts/lists of tensors with every tensor detached and copied to CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    # numpy's key array is stored as a tensor so checkpoints load with torch.load(weights_only=True)
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'python': random.getstate(), 'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'].cpu()) # map_location may have moved the states to the device
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def atomic_save(obj, path):
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def write_json(obj, path):
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def is_checkpoint(obj):
+    return isinstance(obj, dict) and 'model' in obj and 'optimizers' in obj
+
+
+class CheckpointManager(object):
+    """Background writer of training checkpoints in folder, keeping the newest keep_last."""
+
+    def __init__(self, folder, keep_last=3):
+        self.folder = folder
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=1) # at most one snapshot waiting, bounds the extra host memory
+        self.error = None
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            try:
+                job()
+            except Exception as e: # surfaced on the training thread by the next save/wait
+                self.error = e
+            self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint write failed: %s' % error)
+
+    def manifest(self):
+        path = os.path.join(self.folder, MANIFEST)
+        if not os.path.isfile(path):
+            return {'kept': []}
+        with open(path) as f:
+            return json.load(f)
+
+    def latest(self):
+        """Path of the newest complete checkpoint in folder, or None."""
+        kept = self.manifest()['kept']
+        for entry in reversed(kept):
+            path = os.path.join(self.folder, entry['file'])
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def save(self, model, optimizers, epoch, step, best=None, sampler_seed=None, args=None, **extra):
+        """Snapshot the training state now and write it in the background."""
+        self._raise()
+        state = {
+            'model': to_cpu(model.state_dict()),
+            'optimizers': [to_cpu(optimizer.state_dict()) for optimizer in optimizers],
+            'epoch': epoch,
+            'step': step,
+            'best': dict(best or {}),
+            'rng': rng_state(),
+            'sampler_seed': sampler_seed,
+            'args': dict(vars(args)) if args is not None else None, # a copy, args may change while the save runs
+        }
+        state.update(extra)
+        name = 'checkpoint_step%09d.pt' % step
+
+        def job():
+            atomic_save(state, os.path.join(self.folder, name))
+            manifest = self.manifest()
+            kept = [e for e in manifest['kept'] if e['file'] != name] + [{'file': name, 'epoch': epoch, 'step': step}]
+            for old in kept[:-self.keep_last] if self.keep_last > 0 else []:
+                path = os.path.join(self.folder, old['file'])
+                if os.path.isfile(path):
+                    os.remove(path)
+            manifest['kept'] = kept[-self.keep_last:] if self.keep_last > 0 else kept
+            manifest['latest'] = name
+            write_json(manifest, os.path.join(self.folder, MANIFEST)) # only now is the new file resumable
+
+        self.queue.put(job) # blocks while the previous snapshot is still queued
+        return os.path.join(self.folder, name)
+
+    def save_file(self, obj, path):
+        """Write any object (e.g. a weights-only state_dict) atomically in the background."""
+        self._raise()
+        obj = to_cpu(obj)
+        self.queue.put(lambda: atomic_save(obj, path))
+
+    def wait(self):
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+
+def load_checkpoint(path, map_location='cpu'):
+    return torch.load(path, map_location=map_location)
+
+
+def restore(state, model, optimizers=None, rng=True):
+    """Load a checkpoint's model, optimizer and RNG states in place, returns the checkpoint dict."""
+    model.load_state_dict(state['model'])
+    if optimizers is not None:
+        if len(optimizers) != len(state['optimizers']):
+            raise ValueError('checkpoint has %d optimizer states, the run has %d (was --sparse_emb changed?)'
+                             % (len(state['optimizers']), len(optimizers)))
+        for optimizer, optimizer_state in zip(optimizers, state['optimizers']):
+            optimizer.load_state_dict(optimizer_state)
+    if rng:
+        set_rng_state(state['rng'])
+    return state
@@ -0,0 +1,268 @@
+"""
+Streaming building blocks of the dataset converters (prepare_new_dataset.py, prepare_news_dataset.py).
+
+The input is read in byte blocks cut at line ends and parsed block by block, optionally by worker
+processes. Raw user/item keys are interned into ids as they appear (IdMap) and the interactions
+are spilled to a temporary file (InteractionSpill). The output is produced by an external sort:
+the spill is distributed into user-range partitions on disk, cut at cumulative per-user counts so
+each holds at most max_rows interactions however skewed user activity is, each partition is
+sorted in memory and written with bulk writes, as text (data/<name>.txt) and/or directly as the compiled cache
+(data/<name>.csr, see dataset.py). Memory is bounded by the id maps and one partition, not by
+the number of interactions.
+
+    spill = InteractionSpill(tmp_dir)
+    for users, items, times in parse_blocks(parse_fn, read_blocks(path), workers):
+        spill.append(user_map.encode(users), item_map.encode(items), times)
+    write_dataset(spill, user_map.final_ids(), item_map.final_ids(), 'data/x.txt', fmt='both')
+"""
+
+import os
+import multiprocessing
+import numpy as np
+
+from dataset import CompiledWriter
+
+RECORD = 4 # int64 columns of a spilled interaction: user, order key (time), sequence number, item
+
+
+def read_blocks(path, block_bytes=64 << 20, skip_header=False):
+    """Yield the file as byte blocks of about block_bytes that end at a line end."""
+    with open(path, 'rb') as f:
+        if skip_header:
+            f.readline()
+        rest = b''
+        while True:
+            data = f.read(block_bytes)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            if cut == 0: # a line longer than the block, keep reading
+                rest = data
+                continue
+            rest = data[cut:]
+            yield data[:cut]
+        if rest:
+            yield rest + b'\n'
+
+
+def parse_blocks(parse_fn, blocks, workers=1):
+    """parse_fn over the blocks in order, in worker processes when workers > 1."""
+    if workers <= 1:
+        for block in blocks:
+            yield parse_fn(block)
+        return
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        # imap keeps the block order, so ids and the output do not depend on the worker count
+        for out in pool.imap(parse_fn, blocks):
+            yield out
+
+
+def _int_or_none(keys):
+    try:
+        return np.array([int(k) for k in keys], dtype=np.int64)
+    except (TypeError, ValueError):
+        return None
+
+
+class IdMap(object):
+    """Raw key -> provisional id (1, 2, ... in order of appearance), built incrementally per block."""
+
+    def __init__(self):
+        self.ids = {}
+        self.keys = [None] # keys[id]
+
+    def __len__(self):
+        return len(self.keys) - 1
+
+    def encode(self, keys):
+        keys = np.asarray(keys)
+        if len(keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+        uniq, inverse = np.unique(keys, return_inverse=True) # one dict lookup per distinct key of the block
+        ids = np.empty(len(uniq), dtype=np.int64)
+        for j, key in enumerate(uniq.tolist()):
+            i = self.ids.get(key)
+            if i is None:
+                i = self.ids[key] = len(self.keys)
+                self.keys.append(key)
+            ids[j] = i
+        return ids[inverse.reshape(-1)]
+
+    def final_ids(self, mode='sorted'):
+        """int64 array provisional id -> output id (entry 0 stays 0).
+
+        sorted: 1..n in key order, numeric if every key is an integer, else as strings
+        str:    1..n in string order
+        int:    the key's own integer value; non-integer keys get ids after the largest one
+        """
+        keys = self.keys[1:]
+        final = np.zeros(len(self.keys), dtype=np.int64)
+        if mode == 'int':
+            top = 0
+            rest = []
+            for i, key in enumerate(keys, 1):
+                try:
+                    final[i] = int(key)
+                    top = max(top, final[i])
+                except ValueError:
+                    rest.append(i)
+            rest.sort(key=lambda i: str(self.keys[i]))
+            final[rest] = top + 1 + np.arange(len(rest))
+            return final
+        numeric = _int_or_none(keys) if mode == 'sorted' else None
+        if numeric is not None:
+            order = np.argsort(numeric, kind='stable')
+        else:
+            order = np.array(sorted(range(len(keys)), key=lambda i: str(keys[i])), dtype=np.int64)
+        final[1 + order] = np.arange(1, len(keys) + 1)
+        return final
+
+
+class InteractionSpill(object):
+    """Interactions with provisional ids appended to a binary temp file, plus per-id counts."""
+
+    def __init__(self, tmp_dir, buffer_bytes=16 << 20):
+        self.tmp_dir = tmp_dir
+        self.path = os.path.join(tmp_dir, 'spill.bin')
+        self.f = open(self.path, 'wb', buffering=buffer_bytes)
+        self.n = 0
+        self.user_counts = np.zeros(1, dtype=np.int64)
+        self.item_counts = np.zeros(1, dtype=np.int64)
+
+    def __len__(self):
+        return self.n
+
+    @staticmethod
+    def _count(counts, ids):
+        add = np.bincount(ids)
+        if len(add) > len(counts):
+            counts = np.concatenate([counts, np.zeros(len(add) - len(counts), dtype=np.int64)])
+        counts[:len(add)] += add
+        return counts
+
+    def append(self, users, items, order_keys=None):
+        n = len(users)
+        rec = np.empty((n, RECORD), dtype=np.int64)
+        rec[:, 0] = users
+        rec[:, 1] = 0 if order_keys is None else order_keys
+        rec[:, 2] = np.arange(self.n, self.n + n) # ties on the order key keep input order
+        rec[:, 3] = items
+        rec.tofile(self.f)
+        self.n += n
+        self.user_counts = self._count(self.user_counts, users)
+        self.item_counts = self._count(self.item_counts, items)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+    def chunks(self, path=None, rows=1 << 22):
+        """Stream a record file back in chunks of rows records."""
+        with open(path or self.path, 'rb') as f:
+            while True:
+                rec = np.fromfile(f, dtype=np.int64, count=rows * RECORD)
+                if len(rec) == 0:
+                    break
+                yield rec.reshape(-1, RECORD)
+
+    def partition_edges(self, user_final, max_rows):
+        """Output user ids e_0 = 1 < e_1 < ... < e_P = usernum + 1, partition p holds users
+        [e_p, e_p+1) and at most max_rows records unless it is a single user."""
+        usernum = int(user_final.max())
+        cum = np.cumsum(final_counts(self.user_counts, user_final, usernum)) # cum[u]: records of users <= u
+        edges = [1]
+        while edges[-1] <= usernum:
+            start = edges[-1]
+            end = int(np.searchsorted(cum, cum[start - 1] + max_rows, side='right'))
+            edges.append(max(end, start + 1))
+        return np.array(edges, dtype=np.int64)
+
+    def sorted_chunks(self, user_final, item_final, max_rows=1 << 26, presorted=False):
+        """Yield (users, items) with output ids, grouped by user (ascending) and ordered by
+        (order key, input order) inside each user.
+
+        The spill is distributed into user-id ranges of at most max_rows records each (a single
+        user with more records gets a range of its own); one range at a time is loaded and
+        sorted. presorted inputs (already grouped by user in time order) are streamed back in
+        input order without sorting.
+        """
+        self.close()
+        if presorted:
+            for rec in self.chunks():
+                yield user_final[rec[:, 0]], item_final[rec[:, 3]]
+            return
+
+        edges = self.partition_edges(user_final, max_rows)
+        parts = len(edges) - 1
+        paths = [self.path]
+        if parts > 1:
+            paths = [os.path.join(self.tmp_dir, 'part%05d.bin' % p) for p in range(parts)]
+            files = [open(p, 'wb', buffering=4 << 20) for p in paths]
+            try:
+                for rec in self.chunks():
+                    part = np.searchsorted(edges, user_final[rec[:, 0]], side='right') - 1
+                    order = np.argsort(part, kind='stable')
+                    bounds = np.searchsorted(part[order], np.arange(parts + 1))
+                    for p in range(parts):
+                        if bounds[p + 1] > bounds[p]:
+                            rec[order[bounds[p]:bounds[p + 1]]].tofile(files[p])
+            finally:
+                for f in files:
+                    f.close()
+            os.remove(self.path)
+
+        for path in paths:
+            rec = np.fromfile(path, dtype=np.int64).reshape(-1, RECORD)
+            users = user_final[rec[:, 0]]
+            order = np.lexsort((rec[:, 2], rec[:, 1], users))
+            yield users[order], item_final[rec[order, 3]]
+            del rec, users, order
+            os.remove(path)
+
+
+def format_pairs(users, items):
+    """'user item\\n' lines of two id arrays as one string, formatted in a single C-level call."""
+    pairs = np.empty(2 * len(users), dtype=np.int64)
+    pairs[0::2], pairs[1::2] = users, items
+    return ('%d %d\n' * len(users)) % tuple(pairs.tolist())
+
+
+def final_counts(counts, final, size):
+    out = np.zeros(size + 1, dtype=np.int64)
+    np.add.at(out, final[:len(counts)], counts)
+    out[0] = 0
+    return out
+
+
+def write_dataset(spill, user_final, item_final, output_file, fmt='txt', compiled_path=None,
+                  max_rows=1 << 26, presorted=False, write_rows=1 << 20):
+    """Sort the spill and write it as text (fmt txt), as the compiled cache (compiled) or both.
+
+    compiled_path defaults to the .csr directory next to output_file (dataset.cache_path layout).
+    Returns the number of interactions written.
+    """
+    usernum, itemnum = int(user_final.max()), int(item_final.max())
+    compiled = None
+    if fmt in ('compiled', 'both'):
+        compiled_path = compiled_path or os.path.splitext(output_file)[0] + '.csr'
+        compiled = CompiledWriter(compiled_path, final_counts(spill.user_counts, user_final, usernum),
+                                  final_counts(spill.item_counts, item_final, itemnum))
+    text = open(output_file, 'w', buffering=16 << 20) if fmt in ('txt', 'both') else None
+    written = 0
+    try:
+        for users, items in spill.sorted_chunks(user_final, item_final, max_rows, presorted):
+            if compiled is not None:
+                compiled.append(users, items)
+            if text is not None:
+                for b in range(0, len(users), write_rows):
+                    text.write(format_pairs(users[b:b + write_rows], items[b:b + write_rows]))
+            written += len(users)
+    finally:
+        if text is not None:
+            text.close()
+    if compiled is not None:
+        compiled.source = output_file if text is not None else None # the cache stays fresh next to its text file
+        compiled.close()
+    return written
+
@@ -0,0 +1,378 @@
+"""
+Compiled (binary, memory-mapped) dataset format for SASRec.
+
+data/<name>.txt is parsed once and stored next to it as data/<name>.csr/CURRENT, the name of
+the published version directory data/<name>.csr/v<stamp>/ holding:
+
+    user_ptr.npy    int64 (usernum + 2,)   CSR offsets into user_items, indexed by user id
+    user_items.npy  int32 (nnz,)           items of every user, in file order
+    train_end.npy   int64 (usernum + 1,)   end of the train part of each user in user_items
+    item_ptr.npy    int64 (itemnum + 2,)   CSR offsets into item_users, indexed by item id
+    item_users.npy  int32 (nnz,)           users of every item, in file order
+    meta.json       counts, format version and the size/mtime of the source text file
+
+A rebuild writes a new version directory and then replaces CURRENT, so readers always see one
+complete version; older versions are deleted after the switch (mappings already open stay valid).
+
+The converters (prepare_*_dataset.py --format compiled) can also write the cache directly with
+CompiledWriter, without a text file.
+
+train/valid/test follow data_partition: users with fewer than 4 interactions keep
+everything in train, otherwise the last two items are valid and test.
+"""
+
+import os
+import json
+import time
+import shutil
+import contextlib
+import numpy as np
+from collections.abc import Mapping
+
+try:
+    import fcntl
+except ImportError: # not on Windows, rebuilds are then not serialized across processes
+    fcntl = None
+
+CACHE_VERSION = 1
+
+
+def source_path(fname):
+    return 'data/%s.txt' % fname
+
+
+def cache_path(fname):
+    return 'data/%s.csr' % fname
+
+
+class CSRSequences(Mapping):
+    """Read-only {user: item array} view over a CSR item buffer, behaves like the old dict of lists."""
+
+    def __init__(self, data, starts, ends, present):
+        self.data = data
+        self.starts = starts
+        self.ends = ends
+        self.present = present # bool mask over user ids, True for users that are keys
+        self._keys = None
+
+    def keys_array(self):
+        if self._keys is None:
+            self._keys = np.flatnonzero(self.present)
+        return self._keys
+
+    def lengths(self):
+        keys = self.keys_array()
+        return self.ends[keys] - self.starts[keys]
+
+    def __getitem__(self, u):
+        if not (0 <= u < len(self.present)) or not self.present[u]:
+            raise KeyError(u)
+        return self.data[self.starts[u]:self.ends[u]]
+
+    def __contains__(self, u):
+        return 0 <= u < len(self.present) and bool(self.present[u])
+
+    def __iter__(self):
+        return iter(self.keys_array().tolist())
+
+    def __len__(self):
+        return len(self.keys_array())
+
+
+def _group(keys, values, n):
+    # stable counting sort of values by key, keeps file order inside every group
+    order = np.argsort(keys, kind='stable')
+    ptr = np.zeros(n + 2, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n + 1), out=ptr[1:])
+    return ptr, np.ascontiguousarray(values[order], dtype=np.int32)
+
+
+def compile_arrays(users, items, usernum=None, itemnum=None):
+    """Build the CSR arrays from parallel user/item id arrays (interaction order)."""
+    users = np.asarray(users, dtype=np.int64)
+    items = np.asarray(items, dtype=np.int64)
+    usernum = int(users.max()) if usernum is None else usernum
+    itemnum = int(items.max()) if itemnum is None else itemnum
+
+    user_ptr, user_items = _group(users, items, usernum)
+    item_ptr, item_users = _group(items, users, itemnum)
+
+    nfeedback = np.diff(user_ptr)[:usernum + 1]
+    train_end = user_ptr[1:] - np.where(nfeedback < 4, 0, 2)
+
+    arrays = {
+        'user_ptr': user_ptr,
+        'user_items': user_items,
+        'train_end': train_end,
+        'item_ptr': item_ptr,
+        'item_users': item_users,
+    }
+    return arrays, usernum, itemnum
+
+
+def _fresh_dir(path):
+    # a private directory inside the cache dir, renamed to a version by _publish
+    os.makedirs(path, exist_ok=True)
+    tmp = os.path.join(path, 'tmp%d_%d' % (os.getpid(), time.time_ns()))
+    os.makedirs(tmp)
+    return tmp
+
+
+def published_dir(path):
+    """The version directory CURRENT points at in the cache dir path, None if nothing is published."""
+    try:
+        with open(os.path.join(path, 'CURRENT')) as f:
+            return os.path.join(path, f.read().strip())
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def _publish(tmp, path, usernum, itemnum, interactions, source=None):
+    meta = {
+        'version': CACHE_VERSION,
+        'usernum': int(usernum),
+        'itemnum': int(itemnum),
+        'interactions': int(interactions),
+        'source': _source_stamp(source) if source is not None else None,
+    }
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    # serialized with other writers (a converter next to load_compiled), none deletes the version
+    # another one just published
+    with _dir_lock(path):
+        version = 'v%d_%d' % (time.time_ns(), os.getpid())
+        os.replace(tmp, os.path.join(path, version))
+        pointer = os.path.join(path, 'CURRENT.tmp%d' % os.getpid())
+        with open(pointer, 'w') as f:
+            f.write(version)
+        os.replace(pointer, os.path.join(path, 'CURRENT')) # the switch readers see
+        # older versions and the files of the flat layout before versions; in-progress tmp dirs of
+        # other writers stay. Where open mappings block the delete (Windows) the next publish retries
+        for name in os.listdir(path):
+            old = os.path.join(path, name)
+            if name.startswith('v') and name != version and os.path.isdir(old):
+                shutil.rmtree(old, ignore_errors=True)
+            elif name == 'meta.json' or name.endswith('.npy'):
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+
+def write_compiled(path, arrays, usernum, itemnum, source=None):
+    """Write the arrays as a new version of the cache at path; replacing CURRENT makes the update atomic for readers."""
+    tmp = _fresh_dir(path)
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), arr)
+    _publish(tmp, path, usernum, itemnum, len(arrays['user_items']), source)
+
+
+class CompiledWriter(object):
+    """write_compiled for interactions that arrive in chunks, without holding them in memory.
+
+    user_counts / item_counts (indexed by id, entry 0 unused) must be known up front. Chunks are
+    appended in interaction order; user_items and item_users are filled through memory-mapped
+    .npy files, each user's and item's interactions kept in arrival order as in compile_arrays.
+    """
+
+    def __init__(self, path, user_counts, item_counts, source=None):
+        self.path, self.source = path, source
+        self.usernum, self.itemnum = len(user_counts) - 1, len(item_counts) - 1
+        self.tmp = _fresh_dir(path)
+        self.user_ptr = np.zeros(self.usernum + 2, dtype=np.int64)
+        np.cumsum(user_counts, out=self.user_ptr[1:])
+        self.item_ptr = np.zeros(self.itemnum + 2, dtype=np.int64)
+        np.cumsum(item_counts, out=self.item_ptr[1:])
+        nnz = int(self.user_ptr[-1])
+        self.user_items = np.lib.format.open_memmap(os.path.join(self.tmp, 'user_items.npy'), 'w+', np.int32, (nnz,))
+        self.item_users = np.lib.format.open_memmap(os.path.join(self.tmp, 'item_users.npy'), 'w+', np.int32, (nnz,))
+        self.user_next = self.user_ptr[:-1].copy() # next free slot of every user / item
+        self.item_next = self.item_ptr[:-1].copy()
+        self.written = 0
+
+    @staticmethod
+    def _scatter(keys, values, next_slot, out):
+        # stable: the i-th interaction of a key in this chunk goes to next_slot[key] + i
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        uniq, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        rank = np.arange(len(keys)) - np.repeat(first, counts)
+        out[next_slot[keys] + rank] = values[order]
+        next_slot[uniq] += counts
+
+    def append(self, users, items):
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        self._scatter(users, items, self.user_next, self.user_items)
+        self._scatter(items, users, self.item_next, self.item_users)
+        self.written += len(users)
+
+    def close(self):
+        if self.written != self.user_ptr[-1]:
+            raise ValueError('%d interactions written, the counts promised %d' % (self.written, self.user_ptr[-1]))
+        self.user_items.flush()
+        self.item_users.flush()
+        del self.user_items, self.item_users
+        nfeedback = np.diff(self.user_ptr)[:self.usernum + 1]
+        np.save(os.path.join(self.tmp, 'user_ptr.npy'), self.user_ptr)
+        np.save(os.path.join(self.tmp, 'train_end.npy'), self.user_ptr[1:] - np.where(nfeedback < 4, 0, 2))
+        np.save(os.path.join(self.tmp, 'item_ptr.npy'), self.item_ptr)
+        _publish(self.tmp, self.path, self.usernum, self.itemnum, self.written, self.source)
+
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def is_stale(fname):
+    version, src = published_dir(cache_path(fname)), source_path(fname)
+    if version is None:
+        return True
+    meta_file = os.path.join(version, 'meta.json')
+    if not os.path.isfile(meta_file):
+        return True
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta.get('version') != CACHE_VERSION:
+        return True
+    # a cache written straight by a converter may have no text file next to it
+    if not os.path.isfile(src):
+        return False
+    return meta.get('source') != _source_stamp(src)
+
+
+def compile_dataset(fname):
+    src = source_path(fname)
+    ui_mat = np.loadtxt(src, dtype=np.int64, ndmin=2)
+    arrays, usernum, itemnum = compile_arrays(ui_mat[:, 0], ui_mat[:, 1])
+    write_compiled(cache_path(fname), arrays, usernum, itemnum, source=src)
+
+
+class CompiledDataset(object):
+    def __init__(self, path):
+        while True:
+            version = published_dir(path)
+            if version is None:
+                raise FileNotFoundError('no compiled dataset in %s' % path)
+            try:
+                self._load(version)
+                return
+            except FileNotFoundError:
+                if published_dir(path) == version:
+                    raise
+                # a newer version was published and this one deleted while loading, load that one
+
+    def _load(self, version):
+        with open(os.path.join(version, 'meta.json')) as f:
+            meta = json.load(f)
+        self.usernum = meta['usernum']
+        self.itemnum = meta['itemnum']
+        for name in ['user_ptr', 'user_items', 'train_end', 'item_ptr', 'item_users']:
+            setattr(self, name, np.load(os.path.join(version, name + '.npy'), mmap_mode='r'))
+
+    def u2i(self):
+        starts, ends = self.user_ptr[:-1], self.user_ptr[1:]
+        return CSRSequences(self.user_items, starts, ends, ends > starts)
+
+    def i2u(self):
+        starts, ends = self.item_ptr[:-1], self.item_ptr[1:]
+        return CSRSequences(self.item_users, starts, ends, ends > starts)
+
+    def splits(self):
+        starts, ends = self.user_ptr[:-1], self.user_ptr[1:]
+        present = ends > starts
+        train_end = np.asarray(self.train_end)
+        held_out = train_end < ends
+        valid_end = train_end + held_out
+        train = CSRSequences(self.user_items, starts, train_end, present)
+        valid = CSRSequences(self.user_items, train_end, valid_end, present)
+        test = CSRSequences(self.user_items, valid_end, ends, present)
+        return train, valid, test
+
+
+_held_locks = {} # lock file -> nesting depth in this process, flock would block on a second open
+
+
+@contextlib.contextmanager
+def _dir_lock(path):
+    """Exclusive lock on path.lock, re-entrant within a process."""
+    lock = path + '.lock'
+    if fcntl is None or lock in _held_locks:
+        _held_locks[lock] = _held_locks.get(lock, 0) + 1
+        try:
+            yield
+        finally:
+            _held_locks[lock] -= 1
+            if not _held_locks[lock]:
+                del _held_locks[lock]
+        return
+    with open(lock, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        _held_locks[lock] = 1
+        try:
+            yield
+        finally:
+            del _held_locks[lock]
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def cache_lock(fname):
+    """Exclusive lock on data/<fname>.csr.lock for (re)building the cache.
+
+    Every rank of a distributed run (and the evaluation/export workers) loads the dataset; without
+    the lock each of them would compile the same text file and publish its own version.
+    """
+    return _dir_lock(cache_path(fname))
+
+
+def load_compiled(fname):
+    """Load data/<fname>.csr, (re)building it first if it is missing or older than the text file."""
+    if is_stale(fname):
+        with cache_lock(fname):
+            if is_stale(fname): # not rebuilt by another process while this one waited
+                compile_dataset(fname)
+    return CompiledDataset(cache_path(fname))
+
+
+def csr_layout(user_seqs):
+    """(data, starts, ends, present) of a CSRSequences view or of a plain {user: list} dict."""
+    if isinstance(user_seqs, CSRSequences):
+        return user_seqs.data, user_seqs.starts, user_seqs.ends, user_seqs.present
+    n = max(user_seqs.keys()) + 1 if len(user_seqs) > 0 else 1
+    lens = np.zeros(n, dtype=np.int64)
+    present = np.zeros(n, dtype=bool)
+    for u, items in user_seqs.items():
+        lens[u] = len(items)
+        present[u] = True
+    ends = np.cumsum(lens)
+    starts = ends - lens
+    data = np.zeros(int(lens.sum()), dtype=np.int32)
+    for u, items in user_seqs.items():
+        data[starts[u]:ends[u]] = items
+    return data, starts, ends, present
+
+
+def gather_ranges(starts, ends):
+    """Flat indices of the concatenation of [starts[k], ends[k]) ranges."""
+    lens = ends - starts
+    prefix = np.cumsum(lens) - lens
+    return np.arange(int(lens.sum())) + np.repeat(starts - prefix, lens)
+
+
+def history_keys(data, starts, ends, itemnum):
+    """Sorted user * (itemnum + 1) + item keys of every user's items, for searchsorted membership tests."""
+    users = np.arange(len(starts))
+    lens = ends - starts
+    keys = np.repeat(users, lens) * (itemnum + 1) + data[gather_ranges(starts, ends)]
+    keys.sort()
+    return keys
+
+
+def in_history(keys, users, items, itemnum):
+    """Elementwise test whether items[k] is in the history of users[k]."""
+    q = users.astype(np.int64) * (itemnum + 1) + items
+    if len(keys) == 0:
+        return np.zeros(q.shape, dtype=bool)
+    idx = np.minimum(np.searchsorted(keys, q), len(keys) - 1)
+    return keys[idx] == q
@@ -0,0 +1,204 @@
+"""
+Evaluation of training snapshots, in the training process or overlapped in a background worker.
+
+evaluate_all runs the periodic evaluation of main.py (sampled valid/test metrics, optionally
+full-catalog ranking and ANN recall) and update_best applies main.py's best-checkpoint rule.
+
+BackgroundEvaluator (main.py --eval_background=true) hands the current weights to a separate
+worker process and training continues:
+
+    - the trainer copies the state_dict into one of --eval_snapshots preallocated shared-memory
+      slots (a memcpy, no pickling) and queues (epoch, slot); when every slot is taken submit()
+      waits, so snapshot memory and queue depth are bounded by the slot count
+    - the worker loads the slot into its own CPU model, frees the slot, evaluates with its own
+      torch thread budget (--eval_threads) and sends the results back
+    - the worker keeps the best metrics and writes the weights-only best checkpoint itself, since
+      by the time the results arrive the trainer's weights have moved on
+    - poll() returns finished results without blocking, drain() waits for all of them
+"""
+
+import os
+import sys
+import time
+import multiprocessing
+import numpy as np
+import torch
+
+from ann_index import build_from_model
+from checkpoint import atomic_save
+from model import build_model
+from utils import SharedArrays, data_partition, evaluate_full, evaluate_split, select_eval_users
+
+def evaluate_all(model, dataset, args):
+    """The periodic evaluation of main.py on an eval-mode model, returns a dict of results.
+
+    The sampled and full-rank metrics of a split are computed on the same sampled users.
+    """
+    results = {}
+    users = {split: select_eval_users(dataset, args, split) for split in ('test', 'valid')}
+    t_eval = time.time()
+    results['test'] = evaluate_split(model, dataset, args, split='test', users=users['test'])
+    results['valid'] = evaluate_split(model, dataset, args, split='valid', users=users['valid'])
+    results['eval_time'] = time.time() - t_eval
+    if args.eval_full_rank:
+        ann_index = None
+        if args.ann_nlist > 0: # the item embeddings move during training, cluster the current ones
+            ann_index = build_from_model(model, args.ann_nlist, args.ann_pq_m, args.ann_nprobe, args.ann_rerank)
+        t_eval_full = time.time()
+        results['test_full'] = evaluate_full(model, dataset, args, split='test', ann_index=ann_index, users=users['test'])
+        results['valid_full'] = evaluate_full(model, dataset, args, split='valid', users=users['valid'])
+        results['eval_full_time'] = time.time() - t_eval_full
+    return results
+
+
+def update_best(best, results):
+    """main.py's rule: a new best checkpoint when any of valid/test NDCG@10 or HR@10 improves.
+
+    Updates best in place; returns (improved, valid_improved), the latter on valid NDCG@10 only,
+    which is what early stopping watches.
+    """
+    t_valid, t_test = results['valid'], results['test']
+    valid_improved = t_valid['NDCG@10'] > best['val_ndcg']
+    improved = (t_valid['NDCG@10'] > best['val_ndcg'] or t_valid['HR@10'] > best['val_hr']
+                or t_test['NDCG@10'] > best['test_ndcg'] or t_test['HR@10'] > best['test_hr'])
+    if improved:
+        best['val_ndcg'] = max(t_valid['NDCG@10'], best['val_ndcg'])
+        best['val_hr'] = max(t_valid['HR@10'], best['val_hr'])
+        best['test_ndcg'] = max(t_test['NDCG@10'], best['test_ndcg'])
+        best['test_hr'] = max(t_test['HR@10'], best['test_hr'])
+        best['val_mrr'] = max(t_valid['MRR'], best['val_mrr'])
+        best['test_mrr'] = max(t_test['MRR'], best['test_mrr'])
+    return improved, valid_improved
+
+
+def print_results(epoch, T, results):
+    t_valid, t_test = results['valid'], results['test']
+    print('\nepoch:%d, time: %f(s)' % (epoch, T))
+    print('valid - NDCG@5: %.4f, NDCG@10: %.4f, HR@5: %.4f, HR@10: %.4f, MRR: %.4f'
+          % (t_valid['NDCG@5'], t_valid['NDCG@10'], t_valid['HR@5'], t_valid['HR@10'], t_valid['MRR']))
+    print('test  - NDCG@5: %.4f, NDCG@10: %.4f, HR@5: %.4f, HR@10: %.4f, MRR: %.4f'
+          % (t_test['NDCG@5'], t_test['NDCG@10'], t_test['HR@5'], t_test['HR@10'], t_test['MRR']))
+    if 'test_full' in results:
+        t_valid_full, t_test_full = results['valid_full'], results['test_full']
+        print('valid full-rank - NDCG@5: %.4f, NDCG@10: %.4f, HR@5: %.4f, HR@10: %.4f, MRR: %.4f'
+              % (t_valid_full['NDCG@5'], t_valid_full['NDCG@10'], t_valid_full['HR@5'], t_valid_full['HR@10'], t_valid_full['MRR']))
+        print('test  full-rank - NDCG@5: %.4f, NDCG@10: %.4f, HR@5: %.4f, HR@10: %.4f, MRR: %.4f'
+              % (t_test_full['NDCG@5'], t_test_full['NDCG@10'], t_test_full['HR@5'], t_test_full['HR@10'], t_test_full['MRR']))
+        print('eval time - sampled: %.2f(s), full-rank: %.2f(s)' % (results['eval_time'], results['eval_full_time']))
+        if 'ANN_Recall@10' in t_test_full:
+            print('ANN recall@10 vs exact: %.4f (ann %.2f(s), exact %.2f(s))' % (t_test_full['ANN_Recall@10'], t_test_full['ann_time'], t_test_full['exact_time']))
+
+
+def log_line(epoch, results):
+    t_valid, t_test = results['valid'], results['test']
+    line = f"{epoch} valid(NDCG@5={t_valid['NDCG@5']:.4f}, NDCG@10={t_valid['NDCG@10']:.4f}, HR@5={t_valid['HR@5']:.4f}, HR@10={t_valid['HR@10']:.4f}, MRR={t_valid['MRR']:.4f}) "
+    line += f"test(NDCG@5={t_test['NDCG@5']:.4f}, NDCG@10={t_test['NDCG@10']:.4f}, HR@5={t_test['HR@5']:.4f}, HR@10={t_test['HR@10']:.4f}, MRR={t_test['MRR']:.4f})"
+    if 'test_full' in results:
+        t_valid_full, t_test_full = results['valid_full'], results['test_full']
+        line += f" valid_full(NDCG@5={t_valid_full['NDCG@5']:.4f}, NDCG@10={t_valid_full['NDCG@10']:.4f}, HR@5={t_valid_full['HR@5']:.4f}, HR@10={t_valid_full['HR@10']:.4f}, MRR={t_valid_full['MRR']:.4f}) "
+        line += f"test_full(NDCG@5={t_test_full['NDCG@5']:.4f}, NDCG@10={t_test_full['NDCG@10']:.4f}, HR@5={t_test_full['HR@5']:.4f}, HR@10={t_test_full['HR@10']:.4f}, MRR={t_test_full['MRR']:.4f})"
+    return line + "\n"
+
+
+def best_fname(epoch, args):
+    fname = 'SASRec.epoch={}.lr={}.layer={}.head={}.hidden={}.maxlen={}.pth'
+    return fname.format(epoch, args.lr, args.num_blocks, args.num_heads, args.hidden_units, args.maxlen)
+
+
+def eval_worker(args, num_threads, snapshot_specs, jobs, free_slots, results, best):
+    # the worker evaluates on CPU with its own threads whatever the trainer's device; args is this
+    # process's own copy, the trainer keeps its device
+    args.device = 'cpu'
+    args.eval_workers = 1 # a daemonic process cannot fork the sharding pool, it scores in-process
+    torch.set_num_threads(num_threads)
+    sys.stdout = open(os.devnull, 'w') # evaluate_* print progress dots, the trainer prints the results
+    dataset = data_partition(args.dataset) # memory-mapped CSR cache, nothing is copied from the trainer
+    model = build_model(dataset[3], dataset[4], args).eval()
+    snapshots = [SharedArrays(spec=spec) for spec in snapshot_specs]
+    folder = args.dataset + '_' + args.train_dir
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, T, slot = job
+        state = {name: torch.from_numpy(np.array(arr)) for name, arr in snapshots[slot].arrays.items()}
+        free_slots.put(slot) # copied out, the trainer may reuse the slot
+        model.load_state_dict(state)
+        try:
+            out = evaluate_all(model, dataset, args)
+            out['improved'], out['valid_improved'] = update_best(best, out)
+            if out['improved']:
+                atomic_save(model.state_dict(), os.path.join(folder, best_fname(epoch, args)))
+            out.update(epoch=epoch, T=T, best=dict(best))
+        except Exception as e: # report instead of dying silently
+            out = {'epoch': epoch, 'error': repr(e)}
+        results.put(out)
+
+    for snapshot in snapshots:
+        snapshot.close()
+
+
+class BackgroundEvaluator(object):
+    def __init__(self, model, args, best, num_threads=1, num_snapshots=2):
+        state = model.state_dict()
+        template = {name: np.zeros(t.shape, dtype=t.detach().cpu().numpy().dtype) for name, t in state.items()}
+        self.snapshots = [SharedArrays(template) for _ in range(num_snapshots)]
+        ctx = multiprocessing.get_context('spawn') # the trainer may hold a CUDA context, which does not survive fork
+        self.jobs, self.free_slots, self.results = ctx.Queue(), ctx.Queue(), ctx.Queue()
+        for slot in range(num_snapshots):
+            self.free_slots.put(slot)
+        self.pending = 0
+        self.closed = False
+        self.process = ctx.Process(target=eval_worker, args=(args, num_threads, [s.spec for s in self.snapshots],
+                                                             self.jobs, self.free_slots, self.results, dict(best)))
+        self.process.daemon = True
+        self.process.start()
+
+    def submit(self, epoch, T, model):
+        """Snapshot model's weights for evaluation; waits only when every snapshot slot is in use."""
+        slot = self.free_slots.get()
+        arrays = self.snapshots[slot].arrays
+        with torch.no_grad():
+            for name, t in model.state_dict().items():
+                arrays[name][...] = t.detach().cpu().numpy()
+        self.jobs.put((epoch, T, slot))
+        self.pending += 1
+
+    def poll(self):
+        """Finished results, without waiting."""
+        out = []
+        while self.pending > 0 and not self.results.empty():
+            out.append(self._get())
+        return out
+
+    def drain(self):
+        """Wait for every submitted evaluation."""
+        return [self._get() for _ in range(self.pending)]
+
+    def _get(self):
+        while True:
+            try:
+                r = self.results.get(timeout=5.0)
+                break
+            except Exception:
+                if not self.process.is_alive():
+                    self.close()
+                    raise RuntimeError('background evaluation worker exited (code %s)' % self.process.exitcode)
+        self.pending -= 1
+        if 'error' in r:
+            self.close() # do not leave the worker and the shared-memory snapshots behind
+            raise RuntimeError('background evaluation of epoch %d failed: %s' % (r['epoch'], r['error']))
+        return r
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.jobs.put(None)
+        self.process.join(timeout=60.0)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        for snapshot in self.snapshots:
+            snapshot.close(unlink=True)
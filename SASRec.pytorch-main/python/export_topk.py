@@ -0,0 +1,140 @@
+"""
+Offline top-k recommendations for every user of a dataset, from a checkpoint saved by main.py.
+
+Each user's last --maxlen items of their whole history (train, valid and test) go through
+final_feats. The catalog is then scored in --item_chunk chunks by utils.full_catalog_topk, with
+every item the user has seen masked (--filter_seen). Output in --output_dir:
+
+    users.npy      int64 (n,)               user ids, the row order of the other arrays
+    items.npy      int32 (n, k)             top-k item ids, best first (0: fewer than k unseen items left)
+    scores.npy     float32/float16 (n, k)   their scores (-inf where the item is 0)
+    manifest.json  export settings and the shards that are complete
+
+Rows are cut into shards of --shard_users users. --workers forked processes score the shards and
+write them straight into the memory-mapped .npy files. A shard is listed in manifest.json only after
+its rows are flushed to disk, so rerunning after a crash with the same settings skips the listed
+shards and redoes the rest.
+
+usage:
+    python export_topk.py --dataset=MIND --state_dict_path=[YOUR_CKPT_PATH] --maxlen=200 --k=100 --output_dir=MIND_topk --workers=4
+    items, scores = load_export('MIND_topk')[1:]                          # memory-mapped results
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import torch
+
+from checkpoint import write_json
+from dataset import csr_layout, gather_ranges, load_compiled
+from model import add_model_args
+from quantize import PRECISIONS, load_inference_model
+from utils import fork_workers, forked_blocks, full_catalog_topk, item_table, right_aligned, str2bool
+
+MANIFEST = 'manifest.json'
+SCORE_DTYPES = {'float32': np.float32, 'float16': np.float16}
+
+def export_settings(args, compiled):
+    """What the rows depend on; a resumed export must match it."""
+    st = os.stat(args.state_dict_path)
+    return {'dataset': args.dataset, 'usernum': compiled.usernum, 'itemnum': compiled.itemnum,
+            'interactions': len(compiled.user_items), 'state_dict_path': os.path.abspath(args.state_dict_path),
+            'state_dict_stamp': [st.st_size, st.st_mtime_ns], 'maxlen': args.maxlen, 'k': args.k,
+            'filter_seen': args.filter_seen, 'precision': args.precision, 'score_dtype': args.score_dtype,
+            'shard_users': args.shard_users}
+
+
+def export_shard(model, csr, users, args, shard):
+    """Score the users of one shard into items.npy / scores.npy and flush them, returns the user count."""
+    data, starts, ends = csr
+    lo = shard * args.shard_users
+    hi = min(lo + args.shard_users, len(users))
+    items = np.load(os.path.join(args.output_dir, 'items.npy'), mmap_mode='r+')
+    scores = np.load(os.path.join(args.output_dir, 'scores.npy'), mmap_mode='r+')
+    with torch.no_grad():
+        for b in range(lo, hi, args.batch_size):
+            batch = users[b:min(b + args.batch_size, hi)]
+            feats = model.final_feats(right_aligned(data, starts, ends, batch, args.maxlen))
+            if args.filter_seen:
+                seen_rows = np.repeat(np.arange(len(batch)), ends[batch] - starts[batch])
+                seen_items = data[gather_ranges(starts[batch], ends[batch])].astype(np.int64)
+            else:
+                seen_rows = seen_items = np.zeros(0, dtype=np.int64)
+            top_scores, top_ids = full_catalog_topk(feats, item_table(model.item_emb), seen_rows, seen_items, args.k, args.item_chunk)
+            top_scores, top_ids = top_scores.float().cpu().numpy(), top_ids.cpu().numpy()
+            top_ids[np.isneginf(top_scores)] = 0 # masked items that only filled up the top-k
+            items[b:b + len(batch)] = top_ids
+            scores[b:b + len(batch)] = top_scores
+    items.flush()
+    scores.flush()
+    del items, scores
+    return hi - lo
+
+
+def load_export(output_dir, mmap_mode='r'):
+    """(users, items, scores) of a complete export, memory-mapped."""
+    with open(os.path.join(output_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    if len(manifest['done']) != manifest['n_shards']:
+        raise ValueError('%s is incomplete: %d of %d shards' % (output_dir, len(manifest['done']), manifest['n_shards']))
+    return tuple(np.load(os.path.join(output_dir, name + '.npy'), mmap_mode=mmap_mode) for name in ('users', 'items', 'scores'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export top-k recommendations of every user to memory-mapped .npy files')
+    add_model_args(parser)
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--k', default=100, type=int)
+    parser.add_argument('--filter_seen', default=True, type=str2bool, help='mask every item already in the user\'s history')
+    parser.add_argument('--batch_size', default=1024, type=int, help='users per forward pass')
+    parser.add_argument('--item_chunk', default=65536, type=int, help='items scored per chunk')
+    parser.add_argument('--shard_users', default=100000, type=int, help='users per shard, the unit of resume')
+    parser.add_argument('--workers', default=1, type=int, help='forked scoring processes (CPU)')
+    parser.add_argument('--num_threads', default=None, type=int, help='torch threads in total, split over the workers')
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS, help='see quantize.py')
+    parser.add_argument('--score_dtype', default='float32', choices=list(SCORE_DTYPES))
+    parser.add_argument('--resume', default=True, type=str2bool, help='keep the shards of an earlier run with the same settings')
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    compiled = load_compiled(args.dataset) # memory-mapped, shared with the workers through fork
+    data, starts, ends, present = csr_layout(compiled.u2i())
+    users = np.flatnonzero(present)
+    args.k = min(args.k, compiled.itemnum)
+    settings = export_settings(args, compiled)
+    n_shards = (len(users) - 1) // args.shard_users + 1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = os.path.join(args.output_dir, MANIFEST)
+    manifest = None
+    if args.resume and os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['settings'] != settings:
+            sys.exit('%s holds an export with other settings, rerun with --resume=false to overwrite it' % args.output_dir)
+        print('resuming: %d of %d shards already exported' % (len(manifest['done']), n_shards))
+    if manifest is None:
+        np.save(os.path.join(args.output_dir, 'users.npy'), users)
+        np.lib.format.open_memmap(os.path.join(args.output_dir, 'items.npy'), 'w+', np.int32, (len(users), args.k)).flush()
+        np.lib.format.open_memmap(os.path.join(args.output_dir, 'scores.npy'), 'w+', SCORE_DTYPES[args.score_dtype], (len(users), args.k)).flush()
+        manifest = {'settings': settings, 'n_users': len(users), 'n_shards': n_shards, 'done': []}
+        write_json(manifest, manifest_path) # the arrays exist before any shard is listed
+
+    model = load_inference_model(args, args.precision)
+    pending = [s for s in range(n_shards) if s not in set(manifest['done'])]
+    # forked workers inherit the model and the memory-mapped histories, see utils.forked_blocks
+    workers = fork_workers(args.workers, args.device)
+    t0, exported = time.time(), 0
+    # one shard per task, so each finished shard is listed in the manifest right away
+    with forked_blocks(export_shard, (model, (data, starts, ends), users, args), pending, workers, ordered=False, chunksize=1) as results:
+        for shard, n in results:
+            manifest['done'] = sorted(manifest['done'] + [shard])
+            write_json(manifest, manifest_path)
+            exported += n
+            print('shard %d done, %d of %d shards, %.0f users/s' % (shard, len(manifest['done']), n_shards, exported / (time.time() - t0)))
+    print('exported top-%d of %d users to %s' % (args.k, len(users), args.output_dir))
@@ -0,0 +1,247 @@
+"""
+Incremental next-item inference for SASRec with a per-user key/value cache.
+
+The model is causal, so when a user's history grows by one item only the new position has to
+go through the blocks: its query attends over the cached keys/values of all earlier positions.
+
+Position layout: absolute position embeddings are anchored on the right of the maxlen window,
+so appending to a full right-aligned window would shift every position. A session therefore
+lays its history out right-aligned to column maxlen - 1 - headroom and fills the `headroom`
+free columns with new items, each one a single cached step (stats['cached']). When the window
+is full the session resets: the last maxlen - headroom items are recomputed in one pass and
+laid out the same way again (stats['resets']). Features always equal a full recompute of
+log2feats over that layout (see window_feat and layout()); the default headroom is maxlen // 4.
+
+Between resets the newest item sits left of column maxlen - 1, at a position training never put
+a last item on, so those features only approximate predict() (see predict_feat); full windows
+match it. Running the module reports that drift for a given checkpoint.
+
+headroom=0 is not a cache: every append recomputes the last maxlen items through final_feats,
+exactly what predict() scores with, and no keys/values are kept or charged to max_bytes.
+
+usage:
+    python incremental.py --dataset=MIND --state_dict_path=[YOUR_CKPT_PATH] --maxlen=200
+"""
+
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from collections import OrderedDict, deque
+
+from model import add_model_args, load_model
+
+
+class Session(object):
+    def __init__(self, maxlen):
+        self.history = deque(maxlen=maxlen)
+        self.kv = [] # per layer (k, v), each (1, heads, maxlen, head_dim), filled up to col + 1
+        self.col = -1 # window column of the last item
+        self.feat = None
+
+    def nbytes(self):
+        n = sum(k.element_size() * k.nelement() + v.element_size() * v.nelement() for k, v in self.kv)
+        return n + self.feat.element_size() * self.feat.nelement() + 8 * len(self.history)
+
+
+class IncrementalSASRec(object):
+    """LRU-bounded cache of per-user sessions over an eval-mode SASRec."""
+
+    def __init__(self, model, headroom=None, max_sessions=10000, max_bytes=None):
+        assert not model.training, 'call model.eval() first, dropout would break the cache'
+        self.model = model
+        self.maxlen = model.maxlen
+        self.headroom = self.maxlen // 4 if headroom is None else headroom # 0: recompute every append
+        assert 0 <= self.headroom < self.maxlen
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sessions = OrderedDict()
+        self.bytes = 0
+        self.stats = {'starts': 0, 'appends': 0, 'cached': 0, 'resets': 0, 'evictions': 0}
+
+    def _split_heads(self, x, layer):
+        B, T, C = x.shape
+        return x.view(B, T, layer.num_heads, C // layer.num_heads).transpose(1, 2)
+
+    def _block(self, i, x, session, lo, hi):
+        # one block over window columns [lo, hi) given everything before lo already cached
+        model = self.model
+        layer = model.attention_layers[i]
+        xin = model.attention_layernorms[i](x) if model.norm_first else x
+        q, k, v = F.linear(xin, layer.in_proj_weight, layer.in_proj_bias).chunk(3, dim=-1)
+        cache_k, cache_v = session.kv[i]
+        cache_k[:, :, lo:hi] = self._split_heads(k, layer)
+        cache_v[:, :, lo:hi] = self._split_heads(v, layer)
+        # new queries see all cached columns plus themselves causally; a single query needs no mask
+        attn = F.scaled_dot_product_attention(self._split_heads(q, layer), cache_k[:, :, :hi], cache_v[:, :, :hi],
+                                              is_causal=(hi - lo > 1 and lo == 0))
+        attn = layer.out_proj(attn.transpose(1, 2).reshape(x.shape))
+        if model.norm_first:
+            x = x + attn
+            x = x + model.forward_layers[i](model.forward_layernorms[i](x))
+        else:
+            x = model.attention_layernorms[i](x + attn)
+            x = model.forward_layernorms[i](x + model.forward_layers[i](x))
+        return x
+
+    def _embed(self, items, cols):
+        model = self.model
+        items = torch.as_tensor(items, dtype=torch.long, device=model.dev)[None, :]
+        poss = torch.as_tensor(cols, dtype=torch.long, device=model.dev)[None, :] + 1
+        x = model.item_emb(items) * model.item_emb.embedding_dim ** 0.5
+        return x + model.pos_emb(poss * (items != 0))
+
+    def _run(self, session, items, lo):
+        cols = np.arange(lo, lo + len(items))
+        x = self._embed(items, cols)
+        for i in range(len(self.model.attention_layers)):
+            x = self._block(i, x, session, lo, lo + len(items))
+        session.col = lo + len(items) - 1
+        session.feat = self.model.last_layernorm(x[0, -1])
+
+    def _reset(self, session):
+        # lay the most recent maxlen - headroom items out right-aligned at column maxlen - 1 - headroom
+        width = self.maxlen - self.headroom
+        items = list(session.history)[-width:]
+        window = [0] * (width - len(items)) + items
+        if self.headroom == 0: # recompute wrapper: the predict() feature, nothing to cache
+            session.col = self.maxlen - 1
+            session.feat = self.model.final_feats(np.asarray(window, dtype=np.int32)[None, :])[0]
+            return
+        if not session.kv:
+            C, dev = self.model.item_emb.embedding_dim, self.model.pos_emb.weight.device
+            for layer in self.model.attention_layers:
+                shape = (1, layer.num_heads, self.maxlen, C // layer.num_heads)
+                session.kv.append((torch.zeros(shape, device=dev), torch.zeros(shape, device=dev)))
+        self._run(session, window, 0)
+
+    def _touch(self, user, session, old_bytes=0):
+        self.sessions[user] = session
+        self.sessions.move_to_end(user)
+        self.bytes += session.nbytes() - old_bytes
+        while len(self.sessions) > self.max_sessions or (self.max_bytes is not None and self.bytes > self.max_bytes and len(self.sessions) > 1):
+            _, evicted = self.sessions.popitem(last=False)
+            self.bytes -= evicted.nbytes()
+            self.stats['evictions'] += 1
+
+    def start(self, user, history):
+        """(Re)start user's session from its item history, returns the (C,) feature after the last item."""
+        with torch.no_grad():
+            old = self.sessions.pop(user, None)
+            if old is not None:
+                self.bytes -= old.nbytes()
+            session = Session(self.maxlen)
+            session.history.extend(int(i) for i in history)
+            self._reset(session)
+            self.stats['starts'] += 1
+            self._touch(user, session)
+            return session.feat
+
+    def append(self, user, item):
+        """Feed one new item of an active session, returns the updated feature. KeyError if evicted."""
+        with torch.no_grad():
+            session = self.sessions[user]
+            old_bytes = session.nbytes()
+            session.history.append(int(item))
+            if session.col + 1 >= self.maxlen:
+                self._reset(session)
+                self.stats['resets'] += 1
+            else:
+                self._run(session, [int(item)], session.col + 1)
+                self.stats['cached'] += 1
+            self.stats['appends'] += 1
+            self._touch(user, session, old_bytes)
+            return session.feat
+
+    def layout(self, user):
+        """(window, col): the maxlen window the cached feature corresponds to, for window_feat."""
+        session = self.sessions[user]
+        items = list(session.history)[-(session.col + 1):]
+        window = np.zeros(self.maxlen, dtype=np.int32)
+        window[session.col + 1 - len(items):session.col + 1] = items
+        return window, session.col
+
+    def score(self, user, item_indices):
+        with torch.no_grad():
+            session = self.sessions[user]
+            self.sessions.move_to_end(user)
+            item_embs = self.model.item_emb(torch.as_tensor(item_indices, dtype=torch.long, device=self.model.dev))
+            return item_embs.matmul(session.feat)
+
+    def memory_summary(self):
+        return dict(self.stats, sessions=len(self.sessions), bytes=self.bytes,
+                    bytes_per_session=self.bytes / max(len(self.sessions), 1))
+
+
+def window_feat(model, window, col):
+    """Full recompute reference: log2feats over the whole window, feature at column col."""
+    with torch.no_grad():
+        return model.log2feats(np.asarray(window)[None, :])[0, col]
+
+
+def predict_feat(model, history):
+    """The feature predict() scores with: the last maxlen items right-aligned, newest at column maxlen - 1."""
+    items = list(history)[-model.maxlen:]
+    window = np.zeros(model.maxlen, dtype=np.int32)
+    if items:
+        window[model.maxlen - len(items):] = items
+    return window_feat(model, window, model.maxlen - 1)
+
+
+def topk_overlap(model, a, b, k=10):
+    """Share of the catalog top-k of feature a that is also in the top-k of feature b."""
+    with torch.no_grad():
+        table = model.item_emb.weight[1:]
+        top_a = set(torch.topk(table.matmul(a), k).indices.tolist())
+        top_b = set(torch.topk(table.matmul(b), k).indices.tolist())
+    return len(top_a & top_b) / float(k)
+
+
+if __name__ == '__main__':
+    from utils import data_partition
+
+    parser = argparse.ArgumentParser(description='replay user histories through the KV cache and check it against full recompute')
+    add_model_args(parser)
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--headroom', default=None, type=int, help='free window columns after a reset (default maxlen // 4, 0: recompute every append)')
+    parser.add_argument('--num_users', default=200, type=int)
+    parser.add_argument('--max_sessions', default=10000, type=int)
+    parser.add_argument('--max_mb', default=None, type=float)
+    parser.add_argument('--atol', default=1e-4, type=float)
+    args = parser.parse_args()
+
+    model = load_model(args)
+    [user_train, user_valid, user_test, usernum, itemnum] = data_partition(args.dataset)
+    cache = IncrementalSASRec(model, args.headroom, args.max_sessions,
+                              None if args.max_mb is None else int(args.max_mb * 2 ** 20))
+
+    users = [u for u in user_train if len(user_train[u]) > 1][:args.num_users]
+    max_diff, t_inc, t_full, n = 0.0, 0.0, 0.0, 0
+    cosines, overlaps = [], [] # against predict(), appends whose window is not full
+    for u in users:
+        items = list(user_train[u])
+        cut = max(1, len(items) // 2)
+        cache.start(u, items[:cut])
+        for i in range(cut, len(items)):
+            t = time.time()
+            feat = cache.append(u, items[i])
+            t_inc += time.time() - t
+            window, col = cache.layout(u)
+            t = time.time()
+            ref = window_feat(model, window, col)
+            t_full += time.time() - t
+            max_diff = max(max_diff, (feat - ref).abs().max().item())
+            n += 1
+            if col < args.maxlen - 1:
+                aligned = predict_feat(model, items[:i + 1])
+                cosines.append(F.cosine_similarity(feat, aligned, dim=0).item())
+                overlaps.append(topk_overlap(model, feat, aligned))
+
+    print('appends: %d, max |incremental - full recompute of the same layout|: %.2e (%s at atol %.0e)'
+          % (n, max_diff, 'ok' if max_diff <= args.atol else 'MISMATCH', args.atol))
+    if cosines:
+        print('drift vs predict() on the %d appends with a non-full window: cosine mean %.4f / min %.4f, top-10 overlap %.3f'
+              % (len(cosines), np.mean(cosines), np.min(cosines), np.mean(overlaps)))
+    print('per item: incremental %.3f ms, full recompute %.3f ms' % (1e3 * t_inc / max(n, 1), 1e3 * t_full / max(n, 1)))
+    print('cache: %s' % cache.memory_summary())
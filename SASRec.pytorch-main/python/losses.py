@@ -0,0 +1,121 @@
+"""
+Training losses over the item catalog for main.py --loss, besides the default one-negative BCE.
+
+    bce              one sampled negative per position (WarpSampler's neg), utils.masked_bce_loss
+    sampled_softmax  softmax over the target and a pool of --num_neg negatives shared by the whole
+                     batch, drawn from a uniform or popularity^alpha proposal Q; every logit is
+                     corrected by -log Q(item) (logQ correction) and negatives equal to the target
+                     are masked out
+    full_softmax     cross-entropy against the whole catalog, streamed over item chunks: neither
+                     forward nor backward materializes the (N, itemnum) logits, peak extra memory
+                     is O(softmax_row_chunk * softmax_item_chunk)
+
+Both softmax losses take the features of the real (non-padded) positions only, (N, C), and the
+target item of each, (N,).
+"""
+
+import numpy as np
+import torch
+
+from dataset import csr_layout, gather_ranges
+
+LOSSES = ['bce', 'sampled_softmax', 'full_softmax']
+
+
+def item_counts(user_train, itemnum):
+    """Interactions per item id in the train split, (itemnum + 1,) int64."""
+    data, starts, ends, present = csr_layout(user_train)
+    users = np.flatnonzero(present)
+    return np.bincount(data[gather_ranges(starts[users], ends[users])], minlength=itemnum + 1).astype(np.int64)
+
+
+class ChunkedSoftmaxCE(torch.autograd.Function):
+    """mean(logsumexp(feats @ weight[1:].T) - <feats, weight[targets]>) in item x row chunks.
+
+    forward keeps a running max and sum per row (online logsumexp) and saves only the (N,) lse;
+    backward recomputes each chunk's logits, turns them into probabilities with the saved lse and
+    accumulates both gradients chunk by chunk. Row 0 of weight (padding) is not a class.
+    """
+
+    @staticmethod
+    def forward(ctx, feats, weight, targets, item_chunk, row_chunk):
+        N, V = feats.shape[0], weight.shape[0]
+        lse = torch.empty(N, dtype=feats.dtype, device=feats.device)
+        for r0 in range(0, N, row_chunk):
+            f = feats[r0:r0 + row_chunk]
+            m = torch.full((f.shape[0],), -float('inf'), dtype=feats.dtype, device=feats.device)
+            s = torch.zeros_like(m)
+            for lo in range(1, V, item_chunk):
+                logits = f @ weight[lo:lo + item_chunk].t()
+                new_m = torch.maximum(m, logits.max(dim=1).values)
+                s = s * torch.exp(m - new_m) + torch.exp(logits - new_m[:, None]).sum(dim=1)
+                m = new_m
+            lse[r0:r0 + row_chunk] = m + torch.log(s)
+        target_logits = (feats * weight[targets]).sum(dim=1)
+        ctx.save_for_backward(feats, weight, targets, lse)
+        ctx.item_chunk, ctx.row_chunk = item_chunk, row_chunk
+        return (lse - target_logits).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        feats, weight, targets, lse = ctx.saved_tensors
+        N, V = feats.shape[0], weight.shape[0]
+        scale = grad_output / N
+        grad_feats = torch.zeros_like(feats)
+        grad_weight = torch.zeros_like(weight)
+        for r0 in range(0, N, ctx.row_chunk):
+            f = feats[r0:r0 + ctx.row_chunk]
+            for lo in range(1, V, ctx.item_chunk):
+                w = weight[lo:lo + ctx.item_chunk]
+                p = torch.exp(f @ w.t() - lse[r0:r0 + ctx.row_chunk, None]) * scale # d loss / d logits
+                grad_feats[r0:r0 + ctx.row_chunk] += p @ w
+                grad_weight[lo:lo + ctx.item_chunk] += p.t() @ f
+        grad_feats -= scale * weight[targets]
+        grad_weight.index_add_(0, targets, -scale * feats)
+        return grad_feats, grad_weight, None, None, None
+
+
+def full_softmax_loss(feats, item_weight, targets, item_chunk=8192, row_chunk=4096):
+    return ChunkedSoftmaxCE.apply(feats.to(item_weight.dtype), item_weight, targets.long(), item_chunk, row_chunk)
+
+
+class NegativeSampler(object):
+    """Pools of negatives for sampled_softmax, drawn with replacement from Q, with log Q per item."""
+
+    def __init__(self, itemnum, counts=None, alpha=0.75, device='cpu'):
+        self.itemnum, self.device = itemnum, device
+        if counts is None: # uniform: the correction is a constant and cancels, kept for uniformity
+            self.cdf = None
+            self.log_q = torch.full((itemnum + 1,), -float(np.log(itemnum)), device=device)
+        else:
+            q = np.asarray(counts[1:itemnum + 1], dtype=np.float64) ** alpha + 1e-12 # items never seen keep a tiny mass
+            q /= q.sum()
+            self.cdf = torch.as_tensor(np.cumsum(q), device=device)
+            self.log_q = torch.as_tensor(np.concatenate([[-np.inf], np.log(q)]), dtype=torch.float32, device=device)
+
+    def sample(self, k):
+        if self.cdf is None:
+            return torch.randint(1, self.itemnum + 1, (k,), device=self.device)
+        # inverse-CDF sampling, torch.multinomial is limited to 2^24 categories
+        u = torch.rand(k, dtype=self.cdf.dtype, device=self.device) * self.cdf[-1]
+        return torch.searchsorted(self.cdf, u).clamp(max=self.itemnum - 1) + 1
+
+
+def sampled_softmax_loss(feats, item_emb, targets, neg_ids, log_q):
+    """Softmax over [target, shared negatives] with logQ-corrected logits, (N, C) feats."""
+    feats, targets = feats.float(), targets.long()
+    pos_logits = (feats * item_emb(targets).float()).sum(dim=-1) - log_q[targets]
+    neg_logits = feats @ item_emb(neg_ids).float().t() - log_q[neg_ids][None, :] # (N, K)
+    neg_logits = neg_logits.masked_fill(neg_ids[None, :] == targets[:, None], -float('inf')) # accidental hits
+    logits = torch.cat([pos_logits[:, None], neg_logits], dim=1)
+    return (torch.logsumexp(logits, dim=1) - pos_logits).mean()
+
+
+def softmax_loss(model, log_feats, pos, mask, args, neg_sampler=None):
+    """args.loss over the real positions of (B, T, C) log_feats, targets pos."""
+    feats = log_feats[mask]
+    targets = pos[mask].long()
+    if args.loss == 'full_softmax':
+        return full_softmax_loss(feats, model.item_emb.weight, targets, args.softmax_item_chunk, args.softmax_row_chunk)
+    neg_ids = neg_sampler.sample(args.num_neg)
+    return sampled_softmax_loss(feats, model.item_emb, targets, neg_ids, neg_sampler.log_q)
@@ -1,16 +1,17 @@
 import os
 import time
+import contextlib
 import torch
 import argparse
 
-from model import SASRec
+from model import build_model
+from ann_index import IVFIndex
+from telemetry import ProfileWindow, TrainTelemetry
+from checkpoint import CheckpointManager, is_checkpoint, load_checkpoint, restore
+from losses import LOSSES, NegativeSampler, item_counts, softmax_loss
+from eval_worker import BackgroundEvaluator, best_fname, evaluate_all, log_line, print_results, update_best
 from utils import *
 
-def str2bool(s):
-    if s not in {'false', 'true'}:
-        raise ValueError('Not a valid boolean string')
-    return s == 'true'
-
 parser = argparse.ArgumentParser()
 parser.add_argument('--dataset', required=True)
 parser.add_argument('--train_dir', required=True)
@@ -23,50 +24,148 @@ parser.add_argument('--num_epochs', default=1000, type=int)
 parser.add_argument('--num_heads', default=1, type=int)
 parser.add_argument('--dropout_rate', default=0.2, type=float)
 parser.add_argument('--l2_emb', default=0.0, type=float)
+parser.add_argument('--sparse_emb', default=False, type=str2bool,
+                    help='sparse item embedding gradients with SparseAdam (dense Adam for the rest), l2_emb on touched rows only')
 parser.add_argument('--device', default='cuda', type=str, 
                     help='Device to use: "cuda", "cuda:0", "cuda:1", or "cpu"')
 parser.add_argument('--gpu', type=int, default=None,
                     help='GPU device ID to use (e.g., 0, 1, 2). If specified, overrides --device')
 parser.add_argument('--inference_only', default=False, type=str2bool)
-parser.add_argument('--state_dict_path', default=None, type=str)
+parser.add_argument('--state_dict_path', default=None, type=str,
+                    help='full checkpoint (resumes model, optimizer, epoch, RNG) or weights-only state_dict')
+parser.add_argument('--resume', default=False, type=str2bool, help='continue from the latest checkpoint in the train dir')
+parser.add_argument('--ckpt_every', default=20, type=int, help='epochs between full-state checkpoints (written in the background)')
+parser.add_argument('--keep_last', default=3, type=int, help='full-state checkpoints kept on disk')
 parser.add_argument('--norm_first', action='store_true', default=False)
+parser.add_argument('--engine', default='legacy', choices=['legacy', 'fast'],
+                    help='legacy: MultiheadAttention + Conv1d FFN, fast: fused causal SDPA + Linear FFN (checkpoints interchangeable)')
+parser.add_argument('--eval_batch_size', default=256, type=int, help='users scored per predict call in evaluation')
+parser.add_argument('--eval_users', default=10000, type=int, help='users sampled per evaluation, 0 evaluates all of them')
+parser.add_argument('--eval_workers', default=1, type=int,
+                    help='forked processes evaluation users are sharded over (CPU; metrics do not depend on the count)')
+parser.add_argument('--eval_full_rank', default=False, type=str2bool,
+                    help='also rank the held-out item against the whole catalog (seen items masked)')
+parser.add_argument('--eval_item_chunk', default=65536, type=int, help='items scored per chunk in full-catalog ranking')
+parser.add_argument('--ann_index_path', default=None, type=str,
+                    help='with --inference_only and --eval_full_rank: IVF index built by ann_index.py, searched and its recall@10 against exact search reported')
+parser.add_argument('--ann_nlist', default=0, type=int,
+                    help='with --eval_full_rank during training: IVF lists of an index built from the current item embeddings at each evaluation, its recall@10 is reported (0: off)')
+parser.add_argument('--ann_pq_m', default=0, type=int, help='PQ sub-quantizers of the training-time index, 0 for exact scoring inside lists')
+parser.add_argument('--ann_nprobe', default=8, type=int, help='lists probed per query by the training-time index')
+parser.add_argument('--ann_rerank', default=100, type=int, help='PQ candidates of the training-time index rescored exactly, 0 to disable')
+parser.add_argument('--eval_background', default=False, type=str2bool,
+                    help='evaluate weight snapshots in a background process while training continues (results are logged when ready)')
+parser.add_argument('--eval_threads', default=1, type=int, help='torch threads of the background evaluation process')
+parser.add_argument('--eval_snapshots', default=2, type=int,
+                    help='shared-memory weight snapshots of background evaluation; training waits when all are pending')
+parser.add_argument('--early_stop_patience', default=0, type=int,
+                    help='stop after this many evaluations without a better valid NDCG@10 (0: never)')
+parser.add_argument('--num_workers', default=3, type=int, help='number of sampler worker processes')
+parser.add_argument('--sampler', default='loop', choices=['loop', 'vectorized', 'bucketed'],
+                    help='loop: per-user python sampler, vectorized: numpy batch builder (same distribution), '
+                         'bucketed: vectorized with users grouped by history length and batches trimmed to their longest sequence')
+parser.add_argument('--prefetch', default=True, type=str2bool,
+                    help='stage the next batch as (pinned) tensors and start its device copy while the current step runs')
+parser.add_argument('--bucket_pool', default=32, type=int, help='batches per length-sorted pool in the bucketed sampler')
+parser.add_argument('--bucket_widths', default=None, type=int,
+                    help='round bucketed batch widths up to this many multiples of maxlen / bucket_widths, 0 trims to the '
+                         'longest sequence (default 4 with --compile, which recompiles for every new width, else 0)')
+parser.add_argument('--dist_backend', default='gloo', type=str,
+                    help='torch.distributed backend when launched with torchrun (WORLD_SIZE > 1), e.g. '
+                         'torchrun --nproc_per_node=4 main.py --device=cpu ...')
+parser.add_argument('--num_threads', default=None, type=int,
+                    help='torch intra-op threads per process (distributed default: cores / local ranks)')
+parser.add_argument('--log_every', default=100, type=int,
+                    help='steps per telemetry record (loss, phase times, throughput, peak memory) in telemetry.jsonl')
+parser.add_argument('--telemetry_sync', default=False, type=str2bool,
+                    help='synchronize CUDA at phase boundaries so phase times include kernel time')
+parser.add_argument('--profile_steps', default='', type=str,
+                    help='a:b captures global steps a..b-1 with torch.profiler into profile_trace.json')
+parser.add_argument('--loss', default='bce', choices=LOSSES,
+                    help='bce: one sampled negative per position, sampled_softmax: shared pool of --num_neg negatives '
+                         'with logQ correction, full_softmax: exact softmax over the catalog in chunks (see losses.py)')
+parser.add_argument('--num_neg', default=1024, type=int, help='negatives per batch of sampled_softmax')
+parser.add_argument('--neg_sampler', default='uniform', choices=['uniform', 'popularity'],
+                    help='sampled_softmax proposal: uniform or train item count ^ --neg_alpha')
+parser.add_argument('--neg_alpha', default=0.75, type=float)
+parser.add_argument('--softmax_item_chunk', default=8192, type=int, help='items per chunk of full_softmax')
+parser.add_argument('--softmax_row_chunk', default=4096, type=int, help='positions per chunk of full_softmax')
+parser.add_argument('--checkpoint_activations', default=False, type=str2bool,
+                    help='recompute every block in backward instead of storing its activations (long --maxlen, ~1/3 more compute)')
+parser.add_argument('--accum_steps', default=1, type=int,
+                    help='micro-batches of --batch_size per optimizer step, effective batch = batch_size * accum_steps * ranks; '
+                         'telemetry steps are micro-batches')
+parser.add_argument('--compile', default=False, type=str2bool,
+                    help='torch.compile the training forward (falls back to eager if compilation fails)')
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                    help='bf16: autocast the training forward to bfloat16 (CPU or CUDA), the loss stays fp32')
+parser.add_argument('--scaling_baseline', default=None, type=float,
+                    help='samples/sec of a single-process run, to report the scaling efficiency of a distributed run')
 
-args = parser.parse_args()
-
-# GPU 번호가 지정된 경우 device 설정
-if args.gpu is not None:
-    args.device = f'cuda:{args.gpu}'
-    print(f'Using GPU: {args.device}')
-elif args.device == 'cuda' and torch.cuda.is_available():
-    # GPU 번호가 지정되지 않고 기본 'cuda'인 경우, 첫 번째 GPU 사용
-    args.device = 'cuda:0'
-    print(f'Using default GPU: {args.device}')
-if not os.path.isdir(args.dataset + '_' + args.train_dir):
-    os.makedirs(args.dataset + '_' + args.train_dir)
-with open(os.path.join(args.dataset + '_' + args.train_dir, 'args.txt'), 'w') as f:
-    f.write('\n'.join([str(k) + ',' + str(v) for k, v in sorted(vars(args).items(), key=lambda x: x[0])]))
-f.close()
-
+# parsed under the guard: the background evaluation process (spawn) imports this file as __mp_main__
 if __name__ == '__main__':
+    args = parser.parse_args()
+
+    # set by torchrun; with more than one rank every process trains on its own user shard and
+    # gradients are all-reduced, evaluation, logging and checkpoints stay on rank 0
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.distributed = args.world_size > 1
+    is_main = args.rank == 0
+    if args.bucket_widths is None:
+        args.bucket_widths = 4 if args.compile else 0
+
+    # GPU 번호가 지정된 경우 device 설정
+    if args.gpu is not None:
+        args.device = f'cuda:{args.gpu}'
+        print(f'Using GPU: {args.device}')
+    elif args.device == 'cuda' and torch.cuda.is_available():
+        # GPU 번호가 지정되지 않고 기본 'cuda'인 경우, 첫 번째 GPU 사용
+        args.device = 'cuda:0'
+        print(f'Using default GPU: {args.device}')
+    if args.distributed and args.device.startswith('cuda'):
+        args.device = 'cuda:%s' % os.environ.get('LOCAL_RANK', 0)
+    if is_main:
+        if not os.path.isdir(args.dataset + '_' + args.train_dir):
+            os.makedirs(args.dataset + '_' + args.train_dir)
+        with open(os.path.join(args.dataset + '_' + args.train_dir, 'args.txt'), 'w') as f:
+            f.write('\n'.join([str(k) + ',' + str(v) for k, v in sorted(vars(args).items(), key=lambda x: x[0])]))
+        f.close()
+
+    if args.distributed:
+        import datetime
+        # MASTER_ADDR / MASTER_PORT / RANK / WORLD_SIZE come from torchrun; the long timeout
+        # covers the other ranks waiting in all-reduce while rank 0 evaluates
+        torch.distributed.init_process_group(args.dist_backend, timeout=datetime.timedelta(hours=2))
+        if args.num_threads is None: # torchrun pins every rank to 1 thread otherwise
+            args.num_threads = max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+    if args.num_threads is None and args.eval_background and is_main: # leave the evaluation worker its cores
+        args.num_threads = max(1, torch.get_num_threads() - args.eval_threads)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
 
-    u2i_index, i2u_index = build_index(args.dataset)
-    
     # global dataset
     dataset = data_partition(args.dataset)
 
     [user_train, user_valid, user_test, usernum, itemnum] = dataset
     # num_batch = len(user_train) // args.batch_size # tail? + ((len(user_train) % args.batch_size) != 0)
-    num_batch = (len(user_train) - 1) // args.batch_size + 1
-    cc = 0.0
-    for u in user_train:
-        cc += len(user_train[u])
-    print('average sequence length: %.2f' % (cc / len(user_train)))
+    # an epoch still covers the users once in total, split over the ranks
+    num_batch = (len(user_train) - 1) // (args.batch_size * args.world_size) + 1
+    cc = float(user_train.lengths().sum())
+    if is_main:
+        print('average sequence length: %.2f' % (cc / len(user_train)))
     
-    f = open(os.path.join(args.dataset + '_' + args.train_dir, 'log.txt'), 'w')
-    f.write('epoch valid(NDCG@5, NDCG@10, HR@5, HR@10, MRR) test(NDCG@5, NDCG@10, HR@5, HR@10, MRR)\n')
-    
-    sampler = WarpSampler(user_train, usernum, itemnum, batch_size=args.batch_size, maxlen=args.maxlen, n_workers=3)
-    model = SASRec(usernum, itemnum, args).to(args.device) # no ReLU activation in original SASRec implementation?
+    if args.eval_background and args.eval_workers > 1:
+        raise ValueError('--eval_workers > 1 shards evaluation over forked processes, which the background evaluation '
+                         'process cannot start; give it more --eval_threads instead')
+    if args.ann_index_path is not None and not args.inference_only:
+        raise ValueError('--ann_index_path is searched with --inference_only; during training the index is rebuilt from the '
+                         'current item embeddings at each evaluation, configure it with --ann_nlist/--ann_pq_m/--ann_nprobe/--ann_rerank')
+    if args.accum_steps < 1:
+        raise ValueError('--accum_steps must be >= 1')
+    if args.loss == 'full_softmax' and args.sparse_emb:
+        raise ValueError('--loss=full_softmax updates every item row, use it without --sparse_emb')
+    model = build_model(usernum, itemnum, args).to(args.device) # no ReLU activation in original SASRec implementation?
     
     for name, param in model.named_parameters():
         try:
@@ -81,95 +180,219 @@ if __name__ == '__main__':
     # model.apply(torch.nn.init.xavier_uniform_)
     
     model.train() # enable model training
+
+    optimizers = build_optimizers(model, args) # [Adam], or [SparseAdam(item_emb), Adam(rest)] with --sparse_emb
+
+    folder = args.dataset + '_' + args.train_dir
+    ckpt_manager = CheckpointManager(folder, args.keep_last)
+    epoch_start_idx, global_step, micro_step, T = 1, 0, 0, 0.0 # optimizer steps, micro-batches (telemetry)
+    evals_since_best = 0 # early stopping patience used so far
+    best = {'val_ndcg': 0.0, 'val_hr': 0.0, 'test_ndcg': 0.0, 'test_hr': 0.0, 'val_mrr': 0.0, 'test_mrr': 0.0}
+    sampler_seed = None
+    resume_path = args.state_dict_path
+    if args.resume and ckpt_manager.latest() is not None:
+        resume_path = ckpt_manager.latest()
+    if resume_path is not None:
+        state = load_checkpoint(resume_path, map_location=torch.device(args.device))
+        if is_checkpoint(state): # model, optimizers, epoch/step, best metrics, RNG and sampler seed
+            restore(state, model, optimizers)
+            epoch_start_idx, global_step = state['epoch'] + 1, state['step']
+            micro_step = state.get('micro_step', global_step)
+            evals_since_best = state.get('evals_since_best', 0)
+            best.update(state['best'])
+            T = state.get('train_time', 0.0)
+            sampler_seed = state['sampler_seed']
+            if is_main:
+                print('resumed from %s: epoch %d, step %d' % (resume_path, state['epoch'], state['step']))
+        else: # weights-only state_dict, e.g. the SASRec.epoch=*.pth files; training restarts at epoch 1
+            model.load_state_dict(state)
+            if is_main:
+                print('loaded weights from %s' % resume_path)
+                if not args.inference_only:
+                    print('warning: %s holds weights only, optimizer state, epoch/step counters, best metrics and '
+                          'early-stopping patience are NOT restored; training restarts at epoch 1 with fresh Adam state' % resume_path)
+        del state
+    if sampler_seed is None:
+        sampler_seed = np.random.randint(2 ** 31 - 1)
+
+    # a resumed run draws a fresh, reproducible sample stream for the epochs it has left
+    sampler = WarpSampler(user_train, usernum, itemnum, batch_size=args.batch_size, maxlen=args.maxlen, n_workers=args.num_workers, sampler=args.sampler, bucket_pool=args.bucket_pool,
+                          rank=args.rank, world_size=args.world_size, seed=(sampler_seed + 1000003 * epoch_start_idx + 7919 * args.rank) % (2 ** 31 - 1),
+                          bucket_widths=args.bucket_widths)
+
+    if is_main:
+        resuming = epoch_start_idx > 1 and os.path.isfile(os.path.join(folder, 'log.txt'))
+        f = open(os.path.join(folder, 'log.txt'), 'a' if resuming else 'w')
+        if not resuming:
+            f.write('epoch valid(NDCG@5, NDCG@10, HR@5, HR@10, MRR) test(NDCG@5, NDCG@10, HR@5, HR@10, MRR)\n')
+
+    # int32 tensors with the next batch copied (and sent to the device) during the current step
+    prefetcher = BatchPrefetcher(sampler, args.device, background=args.prefetch)
+
+    # DDP broadcasts rank 0's parameters on construction and all-reduces gradients in backward;
+    # evaluation and saving keep using the plain module
+    train_model = torch.nn.parallel.DistributedDataParallel(model) if args.distributed else model
     
-    epoch_start_idx = 1
-    if args.state_dict_path is not None:
-        try:
-            model.load_state_dict(torch.load(args.state_dict_path, map_location=torch.device(args.device)))
-            tail = args.state_dict_path[args.state_dict_path.find('epoch=') + 6:]
-            epoch_start_idx = int(tail[:tail.find('.')]) + 1
-        except: # in case your pytorch version is not 1.6 etc., pls debug by pdb if load weights failed
-            print('failed loading state_dicts, pls check file path: ', end="")
-            print(args.state_dict_path)
-            print('pdb enabled for your quick check, pls type exit() if you do not need it')
-            import pdb; pdb.set_trace()
-            
-    
-    if args.inference_only:
+    if args.inference_only and is_main:
         model.eval()
-        t_test = evaluate(model, dataset, args)
+        test_users = select_eval_users(dataset, args, 'test') # the same users for sampled and full-rank metrics
+        t_test = evaluate_split(model, dataset, args, split='test', users=test_users)
         print('test (NDCG@5: %.4f, NDCG@10: %.4f, HR@5: %.4f, HR@10: %.4f, MRR: %.4f)' 
               % (t_test['NDCG@5'], t_test['NDCG@10'], t_test['HR@5'], t_test['HR@10'], t_test['MRR']))
+        if args.eval_full_rank:
+            ann_index = IVFIndex.load(args.ann_index_path) if args.ann_index_path is not None else None
+            t_test_full = evaluate_full(model, dataset, args, split='test', ann_index=ann_index, users=test_users)
+            print('test full-rank (NDCG@5: %.4f, NDCG@10: %.4f, HR@5: %.4f, HR@10: %.4f, MRR: %.4f)' 
+                  % (t_test_full['NDCG@5'], t_test_full['NDCG@10'], t_test_full['HR@5'], t_test_full['HR@10'], t_test_full['MRR']))
+            if ann_index is not None:
+                print('ANN recall@10 vs exact: %.4f (ann %.2f(s), exact %.2f(s))' % (t_test_full['ANN_Recall@10'], t_test_full['ann_time'], t_test_full['exact_time']))
     
     # ce_criterion = torch.nn.CrossEntropyLoss()
     # https://github.com/NVIDIA/pix2pixHD/issues/9 how could an old bug appear again...
-    bce_criterion = torch.nn.BCEWithLogitsLoss() # torch.nn.BCELoss()
-    adam_optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, betas=(0.9, 0.98))
+    # bce_criterion = torch.nn.BCEWithLogitsLoss() on pos/neg_logits[indices], now one masked sum in masked_bce_loss
+    neg_sampler = None
+    if args.loss == 'sampled_softmax':
+        neg_sampler = NegativeSampler(itemnum, item_counts(user_train, itemnum) if args.neg_sampler == 'popularity' else None,
+                                      args.neg_alpha, args.device)
+    autocast = torch.autocast(torch.device(args.device).type, dtype=torch.bfloat16, enabled=args.precision == 'bf16')
+
+    def log_results(results):
+        print_results(results['epoch'], results['T'], results)
+        f.write(log_line(results['epoch'], results))
+        f.flush()
+
+    # background evaluation: rank 0 hands weight snapshots to a worker process with its own threads
+    evaluator = None
+    if args.eval_background and is_main and not args.inference_only:
+        evaluator = BackgroundEvaluator(model, args, best, num_threads=args.eval_threads, num_snapshots=args.eval_snapshots)
 
-    best_val_ndcg, best_val_hr = 0.0, 0.0
-    best_test_ndcg, best_test_hr = 0.0, 0.0
-    best_val_mrr, best_test_mrr = 0.0, 0.0
-    T = 0.0
     t0 = time.time()
+    padding_stats = PaddingStats(args.maxlen)
+    telemetry = TrainTelemetry(os.path.join(folder, 'telemetry.jsonl') if is_main and not args.inference_only else None,
+                               args.log_every, args.device, sync=args.telemetry_sync, verbose=is_main,
+                               profile=ProfileWindow.parse(args.profile_steps, os.path.join(folder, 'profile_trace.json')) if is_main else None)
+    telemetry.global_step = micro_step # continues across resumes
+    step_model = train_model # evaluation keeps the eager model
+    if args.compile: # static graphs, one per bucket width (see --bucket_widths)
+        step_model = CompiledOrEager(train_model, dynamic=False, log=lambda message: telemetry.event('compile_fallback', message))
     for epoch in range(epoch_start_idx, args.num_epochs + 1):
         if args.inference_only: break # just to decrease identition
+        t_epoch = time.time()
         for step in range(num_batch): # tqdm(range(num_batch), total=num_batch, ncols=70, leave=False, unit='b'):
-            u, seq, pos, neg = sampler.next_batch() # tuples to ndarray
-            u, seq, pos, neg = np.array(u), np.array(seq), np.array(pos), np.array(neg)
-            pos_logits, neg_logits = model(u, seq, pos, neg)
-            pos_labels, neg_labels = torch.ones(pos_logits.shape, device=args.device), torch.zeros(neg_logits.shape, device=args.device)
+            with telemetry.phase('sampler'):
+                u, seq, pos, neg = prefetcher.next() # host tensors, staged while the previous step ran
+            padding_stats.update(seq)
+            with telemetry.phase('h2d'): # ids were copied by the prefetcher, the loss mask is built on the device
+                u, seq, pos, neg = prefetcher.to_device()
+                indices = pos != 0
+            # gradient accumulation: windows of accum_steps micro-batches, the last one of the epoch may be shorter
+            window_start = step - step % args.accum_steps
+            window = min(args.accum_steps, num_batch - window_start)
+            last_micro = step == window_start + window - 1
+            # DDP all-reduces once per window: forwards under no_sync skip the all-reduce of their backward
+            sync = train_model.no_sync() if args.distributed and not last_micro else contextlib.nullcontext()
+            with telemetry.phase('forward'), sync:
+                with autocast:
+                    if args.loss == 'bce':
+                        pos_logits, neg_logits = step_model(u, seq, pos, neg)
+                    else: # the softmax losses score the catalog themselves, neg is not used
+                        log_feats = step_model(u, seq, None, None)
+            if args.compile and epoch == epoch_start_idx and step == 0:
+                telemetry.event('compile', 'torch.compile: first step %.1fs (%s)' % (step_model.compile_time, 'compiled' if step_model.compiled else 'eager fallback'),
+                                compile_time=step_model.compile_time, compiled=step_model.compiled)
             # print("\neye ball check raw_logits:"); print(pos_logits); print(neg_logits) # check pos_logits > 0, neg_logits < 0
-            adam_optimizer.zero_grad()
-            indices = np.where(pos != 0)
-            loss = bce_criterion(pos_logits[indices], pos_labels[indices])
-            loss += bce_criterion(neg_logits[indices], neg_labels[indices])
-            # torch.norm(param) returns the square root of the sum of squared weights (‖w‖₂), 
-            # should be torch.norm(param)**2 or the way below which is faster.
-            for param in model.item_emb.parameters(): loss += args.l2_emb * torch.sum(param ** 2)    
-            loss.backward()
-            adam_optimizer.step()
-            print("loss in epoch {} iteration {}: {}".format(epoch, step, loss.item())) # expected 0.4~0.6 after init few epochs
-
-        if epoch % 20 == 0:
-            model.eval()
+            with telemetry.phase('loss'):
+                if step == window_start:
+                    for optimizer in optimizers: optimizer.zero_grad()
+                if args.loss == 'bce':
+                    loss = masked_bce_loss(pos_logits, neg_logits, indices)
+                else:
+                    loss = softmax_loss(model, log_feats, pos, indices, args, neg_sampler)
+                # torch.norm(param) returns the square root of the sum of squared weights (‖w‖₂), 
+                # should be torch.norm(param)**2 or the way below which is faster.
+                loss += l2_emb_loss(model, seq, pos, neg, args)
+            with telemetry.phase('backward'):
+                # mean over the window's micro-batches; the reported loss stays the micro-batch's own
+                (loss / window if window > 1 else loss).backward()
+            if last_micro:
+                with telemetry.phase('optimizer'):
+                    for optimizer in optimizers: optimizer.step()
+                global_step += 1
+            # no loss.item() here, the loss is read back once per telemetry record (expected 0.4~0.6 after init few epochs)
+            telemetry.end_step(loss, samples=len(seq), tokens=padding_stats.last_real, epoch=epoch, step=step)
+        telemetry.flush(epoch=epoch, step=step) # close the window before evaluation
+
+        samples_per_sec = num_batch * args.batch_size / (time.time() - t_epoch)
+        rates = [samples_per_sec]
+        if args.distributed:
+            rates = [None] * args.world_size
+            torch.distributed.all_gather_object(rates, samples_per_sec)
+        if is_main:
+            print('epoch {} {}'.format(epoch, padding_stats.summary()))
+            line = 'epoch %d throughput: %.1f samples/s total, per rank %s' % (epoch, sum(rates), ' '.join('%.1f' % r for r in rates))
+            if args.scaling_baseline:
+                line += ', scaling efficiency %.1f%% of %d x %.1f' % (100 * sum(rates) / (len(rates) * args.scaling_baseline), len(rates), args.scaling_baseline)
+            print(line)
+        padding_stats.reset()
+
+        finished = [] # evaluation results that are ready this epoch
+        if epoch % 20 == 0 and is_main:
             t1 = time.time() - t0
             T += t1
-            print('Evaluating', end='')
-            t_test = evaluate(model, dataset, args)
-            t_valid = evaluate_valid(model, dataset, args)
-            print('\nepoch:%d, time: %f(s)' % (epoch, T))
-            print('valid - NDCG@5: %.4f, NDCG@10: %.4f, HR@5: %.4f, HR@10: %.4f, MRR: %.4f' 
-                  % (t_valid['NDCG@5'], t_valid['NDCG@10'], t_valid['HR@5'], t_valid['HR@10'], t_valid['MRR']))
-            print('test  - NDCG@5: %.4f, NDCG@10: %.4f, HR@5: %.4f, HR@10: %.4f, MRR: %.4f' 
-                  % (t_test['NDCG@5'], t_test['NDCG@10'], t_test['HR@5'], t_test['HR@10'], t_test['MRR']))
-
-            # Update best metrics (using NDCG@10 and HR@10 for model saving)
-            if t_valid['NDCG@10'] > best_val_ndcg or t_valid['HR@10'] > best_val_hr or t_test['NDCG@10'] > best_test_ndcg or t_test['HR@10'] > best_test_hr:
-                best_val_ndcg = max(t_valid['NDCG@10'], best_val_ndcg)
-                best_val_hr = max(t_valid['HR@10'], best_val_hr)
-                best_test_ndcg = max(t_test['NDCG@10'], best_test_ndcg)
-                best_test_hr = max(t_test['HR@10'], best_test_hr)
-                best_val_mrr = max(t_valid['MRR'], best_val_mrr)
-                best_test_mrr = max(t_test['MRR'], best_test_mrr)
-                folder = args.dataset + '_' + args.train_dir
-                fname = 'SASRec.epoch={}.lr={}.layer={}.head={}.hidden={}.maxlen={}.pth'
-                fname = fname.format(epoch, args.lr, args.num_blocks, args.num_heads, args.hidden_units, args.maxlen)
-                torch.save(model.state_dict(), os.path.join(folder, fname))
-
-            # Write metrics to log file
-            log_line = f"{epoch} valid(NDCG@5={t_valid['NDCG@5']:.4f}, NDCG@10={t_valid['NDCG@10']:.4f}, HR@5={t_valid['HR@5']:.4f}, HR@10={t_valid['HR@10']:.4f}, MRR={t_valid['MRR']:.4f}) "
-            log_line += f"test(NDCG@5={t_test['NDCG@5']:.4f}, NDCG@10={t_test['NDCG@10']:.4f}, HR@5={t_test['HR@5']:.4f}, HR@10={t_test['HR@10']:.4f}, MRR={t_test['MRR']:.4f})\n"
-            f.write(log_line)
-            f.flush()
+            if evaluator is not None: # snapshot and keep training, the results come back in a later epoch
+                evaluator.submit(epoch, T, model)
+            else:
+                model.eval()
+                print('Evaluating', end='')
+                results = evaluate_all(model, dataset, args)
+                results['improved'], results['valid_improved'] = update_best(best, results)
+                if results['improved']:
+                    ckpt_manager.save_file(model.state_dict(), os.path.join(folder, best_fname(epoch, args))) # weights only, for inference tools
+                results.update(epoch=epoch, T=T)
+                finished.append(results)
+                model.train()
             t0 = time.time()
-            model.train()
+        if evaluator is not None:
+            # the last epoch waits for the outstanding snapshots so its checkpoint has the final best metrics
+            finished += evaluator.drain() if epoch == args.num_epochs else evaluator.poll()
+        for results in finished:
+            if evaluator is not None:
+                best.update(results['best']) # the worker already saved the weights of an improved snapshot
+            log_results(results)
+            evals_since_best = 0 if results['valid_improved'] else evals_since_best + 1
+
+        stop = False
+        if args.early_stop_patience > 0:
+            stop = torch.tensor([int(is_main and evals_since_best >= args.early_stop_patience)])
+            if args.distributed: # every rank leaves the loop at the same epoch
+                torch.distributed.broadcast(stop, 0)
+            stop = bool(stop.item())
+            if stop and is_main:
+                print('early stopping at epoch %d: valid NDCG@10 did not improve in the last %d evaluations' % (epoch, evals_since_best))
     
-        if epoch == args.num_epochs:
-            folder = args.dataset + '_' + args.train_dir
+        if epoch == args.num_epochs and is_main:
             fname = 'SASRec.epoch={}.lr={}.layer={}.head={}.hidden={}.maxlen={}.pth'
             fname = fname.format(args.num_epochs, args.lr, args.num_blocks, args.num_heads, args.hidden_units, args.maxlen)
-            torch.save(model.state_dict(), os.path.join(folder, fname))
-    
-    f.close()
+            ckpt_manager.save_file(model.state_dict(), os.path.join(folder, fname))
+
+        if is_main and (epoch % args.ckpt_every == 0 or epoch == args.num_epochs or stop):
+            # snapshot on this thread, serialized and written by the checkpoint thread while training goes on
+            ckpt_manager.save(model, optimizers, epoch, global_step, best, sampler_seed, args,
+                              train_time=T + time.time() - t0, micro_step=telemetry.global_step, evals_since_best=evals_since_best)
+        if stop:
+            break
+
+    if evaluator is not None: # snapshots still in flight after an early stop
+        for results in evaluator.drain():
+            best.update(results['best'])
+            log_results(results)
+        evaluator.close()
+    telemetry.close()
+    ckpt_manager.close() # waits for pending writes
+    if is_main:
+        f.close()
+    prefetcher.close()
     sampler.close()
+    if args.distributed:
+        torch.distributed.destroy_process_group()
     print("Done")
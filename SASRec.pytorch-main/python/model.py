@@ -1,5 +1,7 @@
 import numpy as np
 import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 class PointWiseFeedForward(torch.nn.Module):
@@ -18,10 +20,104 @@ class PointWiseFeedForward(torch.nn.Module):
         outputs = outputs.transpose(-1, -2) # as Conv1D requires (N, C, Length)
         return outputs
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        convert_ffn_state(state_dict, prefix, to_linear=False) # accept checkpoints of the fast engine
+        super(PointWiseFeedForward, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+class LinearFeedForward(torch.nn.Module):
+    """PointWiseFeedForward with Linear layers on (N, Length, C), no transposes; kernel-size-1 Conv1d == Linear."""
+
+    def __init__(self, hidden_units, dropout_rate):
+
+        super(LinearFeedForward, self).__init__()
+
+        self.linear1 = torch.nn.Linear(hidden_units, hidden_units)
+        self.dropout1 = torch.nn.Dropout(p=dropout_rate)
+        self.relu = torch.nn.ReLU()
+        self.linear2 = torch.nn.Linear(hidden_units, hidden_units)
+        self.dropout2 = torch.nn.Dropout(p=dropout_rate)
+
+    def forward(self, inputs):
+        return self.dropout2(self.linear2(self.relu(self.dropout1(self.linear1(inputs)))))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        convert_ffn_state(state_dict, prefix, to_linear=True) # accept checkpoints saved by main.py
+        super(LinearFeedForward, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @classmethod
+    def from_conv(cls, ffn):
+        new = cls(ffn.conv1.in_channels, ffn.dropout1.p)
+        with torch.no_grad():
+            for conv, linear in [(ffn.conv1, new.linear1), (ffn.conv2, new.linear2)]:
+                linear.weight.copy_(conv.weight.squeeze(-1))
+                linear.bias.copy_(conv.bias)
+        return new.to(ffn.conv1.weight.device)
+
+def convert_ffn_state(state_dict, prefix, to_linear):
+    """Rename/reshape one FFN's entries in place: convN.weight (C, C, 1) <-> linearN.weight (C, C)."""
+    for n in ['1', '2']:
+        src, dst = (prefix + 'conv' + n + '.', prefix + 'linear' + n + '.')
+        if not to_linear:
+            src, dst = dst, src
+        if src + 'weight' in state_dict:
+            w = state_dict.pop(src + 'weight')
+            state_dict[dst + 'weight'] = w.squeeze(-1) if to_linear else w.unsqueeze(-1)
+            state_dict[dst + 'bias'] = state_dict.pop(src + 'bias')
+
+
+def convert_state_dict(state_dict, engine):
+    """Copy of a SASRec state_dict in the FFN layout of engine ('legacy' Conv1d or 'fast' Linear)."""
+    state_dict = dict(state_dict)
+    prefixes = set(k[:k.index('.', len('forward_layers.')) + 1] for k in state_dict if k.startswith('forward_layers.'))
+    for prefix in prefixes:
+        convert_ffn_state(state_dict, prefix, to_linear=(engine == 'fast'))
+    return state_dict
+
+
+class CausalSelfAttention(torch.nn.Module):
+    """Batch-first causal self-attention on the fused scaled_dot_product_attention kernel.
+
+    Parameters are named like torch.nn.MultiheadAttention's (in_proj_weight, in_proj_bias,
+    out_proj), so checkpoints load without conversion. No mask is materialized, causality
+    comes from is_causal.
+    """
+
+    def __init__(self, embed_dim, num_heads, dropout):
+        super(CausalSelfAttention, self).__init__()
+        self.embed_dim, self.num_heads, self.dropout = embed_dim, num_heads, dropout
+        self.in_proj_weight = torch.nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = torch.nn.Parameter(torch.zeros(3 * embed_dim))
+        self.out_proj = torch.nn.Linear(embed_dim, embed_dim)
+        torch.nn.init.xavier_uniform_(self.in_proj_weight)
+        torch.nn.init.zeros_(self.out_proj.bias)
+
+    def _heads(self, x):
+        B, T, C = x.shape
+        return x.view(B, T, self.num_heads, C // self.num_heads).transpose(1, 2)
+
+    def forward(self, x, last_only=False):
+        if last_only: # only the last position queries, it sees every key so no causal mask is needed
+            C = self.embed_dim
+            q = F.linear(x[:, -1:], self.in_proj_weight[:C], self.in_proj_bias[:C])
+            k, v = F.linear(x, self.in_proj_weight[C:], self.in_proj_bias[C:]).chunk(2, dim=-1)
+        else:
+            q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        outputs = F.scaled_dot_product_attention(self._heads(q), self._heads(k), self._heads(v),
+                                                 dropout_p=self.dropout if self.training else 0.0, is_causal=not last_only)
+        return self.out_proj(outputs.transpose(1, 2).reshape(q.shape))
+
 # pls use the following self-made multihead attention layer
 # in case your pytorch version is below 1.16 or for other reasons
 # https://github.com/pmixer/TiSASRec.pytorch/blob/master/model.py
 
+def as_ids(ids, device):
+    """Item/user ids as an int32 or int64 tensor on device; tensors are used as they are (no copy when
+    already there), NumPy arrays and lists are wrapped without a dtype conversion."""
+    if not torch.is_tensor(ids):
+        ids = torch.as_tensor(np.asarray(ids))
+    return ids.to(device, non_blocking=True)
+
+
 class SASRec(torch.nn.Module):
     def __init__(self, user_num, item_num, args):
         super(SASRec, self).__init__()
@@ -30,10 +126,14 @@ class SASRec(torch.nn.Module):
         self.item_num = item_num
         self.dev = args.device
         self.norm_first = args.norm_first
+        self.maxlen = args.maxlen
+        # recompute each block's activations in backward instead of keeping them (attention is O(T^2) per block)
+        self.checkpoint_activations = getattr(args, 'checkpoint_activations', False)
 
         # TODO: loss += args.l2_emb for regularizing embedding vectors during training
         # https://stackoverflow.com/questions/42704283/adding-l1-l2-regularization-in-pytorch
-        self.item_emb = torch.nn.Embedding(self.item_num+1, args.hidden_units, padding_idx=0)
+        # sparse_emb: row-sparse gradients for the item table, see utils.build_optimizers
+        self.item_emb = torch.nn.Embedding(self.item_num+1, args.hidden_units, padding_idx=0, sparse=getattr(args, 'sparse_emb', False))
         self.pos_emb = torch.nn.Embedding(args.maxlen+1, args.hidden_units, padding_idx=0)
         self.emb_dropout = torch.nn.Dropout(p=args.dropout_rate)
 
@@ -62,43 +162,71 @@ class SASRec(torch.nn.Module):
             # self.pos_sigmoid = torch.nn.Sigmoid()
             # self.neg_sigmoid = torch.nn.Sigmoid()
 
-    def log2feats(self, log_seqs): # TODO: fp64 and int64 as default in python, trim?
-        seqs = self.item_emb(torch.LongTensor(log_seqs).to(self.dev))
-        seqs *= self.item_emb.embedding_dim ** 0.5
-        poss = np.tile(np.arange(1, log_seqs.shape[1] + 1), [log_seqs.shape[0], 1])
-        # TODO: directly do tensor = torch.arange(1, xxx, device='cuda') to save extra overheads
-        poss *= (log_seqs != 0)
-        seqs += self.pos_emb(torch.LongTensor(poss).to(self.dev))
-        seqs = self.emb_dropout(seqs)
+    def log2feats(self, log_seqs, last_only=False):
+        # last_only: the last block runs its query, FFN and last_layernorm on the last position only
+        # (keys/values still see every position), returns (U, 1, C) == log2feats(log_seqs)[:, -1:, :]
+        seqs = self.embed(log_seqs)
 
         tl = seqs.shape[1] # time dim len for enforce causality
         attention_mask = ~torch.tril(torch.ones((tl, tl), dtype=torch.bool, device=self.dev))
 
         for i in range(len(self.attention_layers)):
-            seqs = torch.transpose(seqs, 0, 1)
-            if self.norm_first:
-                x = self.attention_layernorms[i](seqs)
-                mha_outputs, _ = self.attention_layers[i](x, x, x,
-                                                attn_mask=attention_mask)
-                seqs = seqs + mha_outputs
-                seqs = torch.transpose(seqs, 0, 1)
-                seqs = seqs + self.forward_layers[i](self.forward_layernorms[i](seqs))
-            else:
-                mha_outputs, _ = self.attention_layers[i](seqs, seqs, seqs,
-                                                attn_mask=attention_mask)
-                seqs = self.attention_layernorms[i](seqs + mha_outputs)
-                seqs = torch.transpose(seqs, 0, 1)
-                seqs = self.forward_layernorms[i](seqs + self.forward_layers[i](seqs))
+            narrow = last_only and i == len(self.attention_layers) - 1
+            mask = None if narrow else attention_mask # the last query sees every key anyway
+            seqs = self.run_block(i, seqs, narrow, mask)
 
         log_feats = self.last_layernorm(seqs) # (U, T, C) -> (U, -1, C)
 
         return log_feats
 
+    def run_block(self, i, seqs, narrow=False, mask=None):
+        if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+            # dropout masks are replayed from the saved RNG state, the recomputation is exact
+            return checkpoint(self.block, i, seqs, narrow, mask, use_reentrant=False)
+        return self.block(i, seqs, narrow, mask)
+
+    def block(self, i, seqs, narrow=False, mask=None):
+        # (U, T, C) -> (U, T, C), or (U, 1, C) when narrow
+        seqs = torch.transpose(seqs, 0, 1)
+        if self.norm_first:
+            x = self.attention_layernorms[i](seqs)
+            q = x[-1:] if narrow else x
+            mha_outputs, _ = self.attention_layers[i](q, x, x,
+                                            attn_mask=mask)
+            seqs = (seqs[-1:] if narrow else seqs) + mha_outputs
+            seqs = torch.transpose(seqs, 0, 1)
+            seqs = seqs + self.forward_layers[i](self.forward_layernorms[i](seqs))
+        else:
+            q = seqs[-1:] if narrow else seqs
+            mha_outputs, _ = self.attention_layers[i](q, seqs, seqs,
+                                            attn_mask=mask)
+            seqs = self.attention_layernorms[i](q + mha_outputs)
+            seqs = torch.transpose(seqs, 0, 1)
+            seqs = self.forward_layernorms[i](seqs + self.forward_layers[i](seqs))
+        return seqs
+
+    def final_feats(self, log_seqs): # for inference
+        return self.log2feats(log_seqs, last_only=True)[:, -1, :] # (U, C)
+
+    def embed(self, log_seqs):
+        log_seqs = as_ids(log_seqs, self.dev)
+        seqs = self.item_emb(log_seqs)
+        seqs *= self.item_emb.embedding_dim ** 0.5
+        # batches may be trimmed to T < maxlen columns, positions stay anchored at maxlen on the right
+        # so every real item gets the same position embedding as in a full maxlen window
+        poss = torch.arange(self.maxlen - log_seqs.shape[1] + 1, self.maxlen + 1, device=log_seqs.device)
+        poss = poss * (log_seqs != 0) # built on the device, broadcast over the batch
+        seqs += self.pos_emb(poss)
+        seqs = self.emb_dropout(seqs)
+        return seqs
+
     def forward(self, user_ids, log_seqs, pos_seqs, neg_seqs): # for training        
         log_feats = self.log2feats(log_seqs) # user_ids hasn't been used yet
+        if pos_seqs is None: # (U, T, C) features for the softmax losses (losses.py), still through forward for DDP
+            return log_feats
 
-        pos_embs = self.item_emb(torch.LongTensor(pos_seqs).to(self.dev))
-        neg_embs = self.item_emb(torch.LongTensor(neg_seqs).to(self.dev))
+        pos_embs = self.item_emb(as_ids(pos_seqs, self.dev))
+        neg_embs = self.item_emb(as_ids(neg_seqs, self.dev))
 
         pos_logits = (log_feats * pos_embs).sum(dim=-1)
         neg_logits = (log_feats * neg_embs).sum(dim=-1)
@@ -109,14 +237,79 @@ class SASRec(torch.nn.Module):
         return pos_logits, neg_logits # pos_pred, neg_pred
 
     def predict(self, user_ids, log_seqs, item_indices): # for inference
-        log_feats = self.log2feats(log_seqs) # user_ids hasn't been used yet
+        final_feat = self.final_feats(log_seqs) # user_ids hasn't been used yet, only the last position is computed
 
-        final_feat = log_feats[:, -1, :] # only use last QKV classifier, a waste
-
-        item_embs = self.item_emb(torch.LongTensor(item_indices).to(self.dev)) # (U, I, C)
+        item_embs = self.item_emb(as_ids(item_indices, self.dev)) # (U, I, C)
 
         logits = item_embs.matmul(final_feat.unsqueeze(-1)).squeeze(-1)
 
         # preds = self.pos_sigmoid(logits) # rank same item list for different users
 
         return logits # preds # (U, I)
+
+
+class SASRecFast(SASRec):
+    """SASRec on batch-first fused causal attention and a Linear feed-forward, same math and checkpoints.
+
+    No (T, B, C) transposes, no materialized causal mask, no Conv1d transposes in the FFN.
+    Checkpoints of either engine load into the other through convert_ffn_state.
+    """
+
+    def __init__(self, user_num, item_num, args):
+        super(SASRecFast, self).__init__(user_num, item_num, args)
+        for i in range(len(self.attention_layers)):
+            self.attention_layers[i] = CausalSelfAttention(args.hidden_units, args.num_heads, args.dropout_rate)
+            self.forward_layers[i] = LinearFeedForward(args.hidden_units, args.dropout_rate)
+
+    def log2feats(self, log_seqs, last_only=False):
+        seqs = self.embed(log_seqs)
+
+        for i in range(len(self.attention_layers)):
+            seqs = self.run_block(i, seqs, narrow=last_only and i == len(self.attention_layers) - 1)
+
+        return self.last_layernorm(seqs)
+
+    def block(self, i, seqs, narrow=False, mask=None):
+        # causality comes from the fused kernel, mask is unused
+        if self.norm_first:
+            attn = self.attention_layers[i](self.attention_layernorms[i](seqs), last_only=narrow)
+            seqs = (seqs[:, -1:] if narrow else seqs) + attn
+            seqs = seqs + self.forward_layers[i](self.forward_layernorms[i](seqs))
+        else:
+            attn = self.attention_layers[i](seqs, last_only=narrow)
+            seqs = self.attention_layernorms[i]((seqs[:, -1:] if narrow else seqs) + attn)
+            seqs = self.forward_layernorms[i](seqs + self.forward_layers[i](seqs))
+        return seqs
+
+
+ENGINES = {'legacy': SASRec, 'fast': SASRecFast}
+
+
+def build_model(user_num, item_num, args):
+    return ENGINES[getattr(args, 'engine', 'legacy')](user_num, item_num, args)
+
+
+def add_model_args(parser):
+    """Model flags of main.py, for the entry points that load a checkpoint saved by it."""
+    parser.add_argument('--state_dict_path', required=True, type=str)
+    parser.add_argument('--maxlen', default=200, type=int)
+    parser.add_argument('--hidden_units', default=50, type=int)
+    parser.add_argument('--num_blocks', default=2, type=int)
+    parser.add_argument('--num_heads', default=1, type=int)
+    parser.add_argument('--dropout_rate', default=0.2, type=float)
+    parser.add_argument('--norm_first', action='store_true', default=False)
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--engine', default='legacy', choices=list(ENGINES), help='legacy: MultiheadAttention + Conv1d FFN, fast: fused SDPA + Linear FFN')
+
+
+def load_model(args, state_dict=None):
+    """SASRec in eval mode from args.state_dict_path, item_num is read off the item embedding table."""
+    if state_dict is None:
+        state_dict = torch.load(args.state_dict_path, map_location=torch.device(args.device))
+    if 'model' in state_dict and 'item_emb.weight' not in state_dict: # full training checkpoint, see checkpoint.py
+        state_dict = state_dict['model']
+    item_num = state_dict['item_emb.weight'].shape[0] - 1
+    model = build_model(0, item_num, args).to(args.device)
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
@@ -3,6 +3,7 @@
 
 사용법:
     python prepare_new_dataset.py --input your_data.csv --output data/my_dataset.txt
+    python prepare_new_dataset.py --input big.csv --output data/big.txt --format both --workers 8
 
 입력 형식 예시 (CSV):
     user_id,item_id,timestamp
@@ -10,15 +11,75 @@
     1,200,2023-01-01 11:00:00
     ...
 
+시간 컬럼은 날짜 문자열 또는 숫자 타임스탬프 (Unix epoch 등) 모두 가능합니다.
+
 또는 다른 형식에 맞게 수정하여 사용하세요.
+
+입력은 블록 단위로 스트리밍하여 파싱하고 (--workers 프로세스 병렬 가능), 사용자/아이템 ID 매핑은
+점진적으로 생성합니다. 시간 정렬은 디스크 기반 외부 정렬로 수행하므로 메모리 사용량은 상호작용
+수가 아니라 ID 매핑과 정렬 파티션 하나(--sort_rows)에 비례합니다. 출력 ID는 기존과 같이
+정렬된 원본 ID 순서로 1부터 부여됩니다. 자세한 구조는 convert_utils.py 참고.
 """
 
+import io
+import os
 import argparse
+import tempfile
+import functools
+import numpy as np
 import pandas as pd
-from collections import defaultdict
+
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError: # pandas < 2.2
+    from pandas.core.tools.datetimes import guess_datetime_format
+
+from convert_utils import IdMap, InteractionSpill, parse_blocks, read_blocks, write_dataset
+
+
+def _read_block(block, names, delimiter, cols):
+    return pd.read_csv(io.BytesIO(block), sep=delimiter, header=None, names=names, dtype=str,
+                       keep_default_na=False, usecols=[c for c in cols if c is not None])
+
+
+def _time_format(input_file, names, delimiter, time_col):
+    # 시간 컬럼 해석 방식을 첫 블록에서 한 번만 결정해 모든 블록에 동일하게 적용
+    # 'int' / 'float': 숫자 타임스탬프 (Unix epoch 등), 그 외: 날짜 문자열 포맷 (None이면 pandas 추론)
+    block = next(read_blocks(input_file, 1 << 20, skip_header=True), None)
+    if block is None: # 빈 입력
+        return None
+    sample = _read_block(block, names, delimiter, [time_col])[time_col]
+    if pd.to_numeric(sample, errors='coerce').notna().all():
+        return 'int' if sample.str.fullmatch(r'\s*[-+]?\d+\s*').all() else 'float'
+    for dayfirst in (False, True): # 첫 블록 전체가 파싱되는 포맷 (01/02 같은 모호한 값 대비)
+        fmt = guess_datetime_format(sample.iloc[0], dayfirst=dayfirst)
+        if fmt is not None and pd.to_datetime(sample, format=fmt, errors='coerce').notna().all():
+            return fmt
+    return None
+
+
+def _parse_times(values, time_format):
+    # 정렬 키 (int64)
+    if time_format == 'int':
+        return values.astype(np.int64).to_numpy()
+    if time_format == 'float': # 순서를 보존하는 float64 -> int64 비트 변환
+        bits = values.astype(np.float64).to_numpy().view(np.int64)
+        return bits ^ ((bits >> 63) & np.int64(0x7fffffffffffffff))
+    return pd.to_datetime(values, format=time_format).to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+def _parse_block(block, names, delimiter, user_col, item_col, time_col, time_format=None):
+    # 한 블록(헤더 없는 CSV 라인들)을 (user, item, time) 배열로 파싱
+    df = _read_block(block, names, delimiter, (user_col, item_col, time_col))
+    times = None
+    if time_col is not None:
+        times = _parse_times(df[time_col], time_format)
+    return df[user_col].to_numpy(dtype=str), df[item_col].to_numpy(dtype=str), times
+
 
 def convert_to_sasrec_format(input_file, output_file, user_col='user_id', item_col='item_id', 
-                             time_col='timestamp', delimiter=','):
+                             time_col='timestamp', delimiter=',', block_mb=64, workers=1,
+                             sort_rows=1 << 26, fmt='txt', presorted=False, tmp_dir=None):
     """
     데이터를 SASRec 형식으로 변환
     
@@ -29,51 +90,46 @@ def convert_to_sasrec_format(input_file, output_file, user_col='user_id', item_c
         item_col: 아이템 ID 컬럼명
         time_col: 시간 컬럼명 (정렬용)
         delimiter: 구분자 (CSV면 ',', TSV면 '\t')
+        block_mb: 한 번에 읽어 파싱하는 블록 크기 (MB)
+        workers: 블록을 파싱하는 프로세스 수
+        sort_rows: 외부 정렬에서 한 번에 메모리에 올리는 상호작용 수
+        fmt: 'txt' (data/<name>.txt), 'compiled' (data/<name>.csr 바이너리), 'both'
+        presorted: 입력이 이미 사용자별 시간순으로 묶여 있으면 정렬을 생략 (입력 순서대로 출력)
+        tmp_dir: 외부 정렬 임시 파일 위치 (기본: 출력 폴더)
     """
-    # 데이터 읽기
+    # 구분자 결정
     if input_file.endswith('.csv'):
-        df = pd.read_csv(input_file)
+        delimiter = ','
     elif input_file.endswith('.tsv'):
-        df = pd.read_csv(input_file, delimiter='\t')
-    else:
-        # 일반 텍스트 파일 처리
-        df = pd.read_csv(input_file, delimiter=delimiter)
-    
-    # 시간 순서로 정렬
-    if time_col in df.columns:
-        df[time_col] = pd.to_datetime(df[time_col])
-        df = df.sort_values([user_col, time_col])
-    
-    # 사용자별로 그룹화하여 시퀀스 생성
-    user_sequences = defaultdict(list)
-    for _, row in df.iterrows():
-        user_id = row[user_col]
-        item_id = row[item_col]
-        user_sequences[user_id].append(item_id)
-    
-    # 사용자 ID와 아이템 ID를 1부터 시작하는 연속된 정수로 매핑
-    unique_users = sorted(user_sequences.keys())
-    unique_items = set()
-    for items in user_sequences.values():
-        unique_items.update(items)
-    unique_items = sorted(unique_items)
-    
-    user_map = {old_id: new_id for new_id, old_id in enumerate(unique_users, start=1)}
-    item_map = {old_id: new_id for new_id, old_id in enumerate(unique_items, start=1)}
-    
-    # 변환된 데이터 쓰기
-    with open(output_file, 'w') as f:
-        for old_user_id in unique_users:
-            new_user_id = user_map[old_user_id]
-            for old_item_id in user_sequences[old_user_id]:
-                new_item_id = item_map[old_item_id]
-                f.write(f"{new_user_id} {new_item_id}\n")
+        delimiter = '\t'
+    elif delimiter == '\\t':
+        delimiter = '\t'
+    with open(input_file, 'r') as f:
+        names = pd.read_csv(io.StringIO(f.readline()), sep=delimiter).columns.tolist()
+    if time_col not in names:
+        time_col = None # 시간 컬럼이 없으면 파일 순서 유지
+    time_format = _time_format(input_file, names, delimiter, time_col) if time_col is not None else None
+
+    user_map, item_map = IdMap(), IdMap()
+    parse = functools.partial(_parse_block, names=names, delimiter=delimiter, user_col=user_col,
+                              item_col=item_col, time_col=time_col, time_format=time_format)
+    with tempfile.TemporaryDirectory(prefix='sasrec_convert_', dir=tmp_dir or (os.path.dirname(output_file) or '.')) as tmp:
+        # 블록 단위 스트리밍 파싱 + ID 매핑, 상호작용은 디스크에 기록
+        spill = InteractionSpill(tmp)
+        blocks = read_blocks(input_file, block_mb << 20, skip_header=True)
+        for users, items, times in parse_blocks(parse, blocks, workers):
+            spill.append(user_map.encode(users), item_map.encode(items), times)
+
+        # 사용자 ID와 아이템 ID를 1부터 시작하는 연속된 정수로 매핑 (원본 ID 정렬 순서)
+        # 변환된 데이터 쓰기: 사용자별, 시간 순서로 외부 정렬
+        total = write_dataset(spill, user_map.final_ids(), item_map.final_ids(), output_file, fmt=fmt,
+                              max_rows=sort_rows, presorted=presorted)
     
     print(f"변환 완료!")
-    print(f"  - 총 사용자 수: {len(unique_users)}")
-    print(f"  - 총 아이템 수: {len(unique_items)}")
-    print(f"  - 총 상호작용 수: {len(df)}")
-    print(f"  - 출력 파일: {output_file}")
+    print(f"  - 총 사용자 수: {len(user_map)}")
+    print(f"  - 총 아이템 수: {len(item_map)}")
+    print(f"  - 총 상호작용 수: {total}")
+    print(f"  - 출력 파일: {output_file}" + (" (+ .csr)" if fmt == 'both' else " (.csr)" if fmt == 'compiled' else ""))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='데이터셋을 SASRec 형식으로 변환')
@@ -83,6 +139,14 @@ if __name__ == '__main__':
     parser.add_argument('--item_col', default='item_id', help='아이템 ID 컬럼명')
     parser.add_argument('--time_col', default='timestamp', help='시간 컬럼명')
     parser.add_argument('--delimiter', default=',', help='구분자 (CSV: ",", TSV: "\\t")')
+    parser.add_argument('--format', default='txt', choices=['txt', 'compiled', 'both'],
+                        help='txt: data/<name>.txt, compiled: 학습용 바이너리 data/<name>.csr 직접 생성, both: 둘 다')
+    parser.add_argument('--workers', default=1, type=int, help='블록 파싱 프로세스 수')
+    parser.add_argument('--block_mb', default=64, type=int, help='파싱 블록 크기 (MB)')
+    parser.add_argument('--sort_rows', default=1 << 26, type=int, help='외부 정렬 파티션당 최대 상호작용 수 (메모리 한도)')
+    parser.add_argument('--presorted', action='store_true', default=False,
+                        help='입력이 이미 사용자별 시간순으로 묶여 있음 (정렬 생략)')
+    parser.add_argument('--tmp_dir', default=None, help='외부 정렬 임시 파일 폴더 (기본: 출력 폴더)')
     
     args = parser.parse_args()
     
@@ -92,6 +156,11 @@ if __name__ == '__main__':
         args.user_col,
         args.item_col,
         args.time_col,
-        args.delimiter
+        args.delimiter,
+        block_mb=args.block_mb,
+        workers=args.workers,
+        sort_rows=args.sort_rows,
+        fmt=args.format,
+        presorted=args.presorted,
+        tmp_dir=args.tmp_dir,
     )
-
@@ -14,12 +14,59 @@
 
 사용법:
     python prepare_news_dataset.py --input your_data.tsv --output data/my_dataset.txt
+    python prepare_news_dataset.py --input big.tsv --output data/big.txt --format both --workers 8
+
+입력은 블록 단위로 스트리밍하여 파싱하고 (--workers 프로세스 병렬 가능), ID 매핑은 점진적으로
+생성하며, 사용자별 묶음은 디스크 기반 외부 정렬로 만듭니다 (convert_utils.py 참고).
 """
 
+import os
 import argparse
-from collections import defaultdict, OrderedDict
+import tempfile
+import functools
+import numpy as np
+
+from convert_utils import IdMap, InteractionSpill, parse_blocks, read_blocks, write_dataset
+
+
+def _parse_block(block, remove_n_prefix=False):
+    # 한 블록의 라인들을 (user, item) 배열로 파싱, 경고는 (블록 내 라인 번호, 메시지)로 반환
+    users, items, warnings = [], [], []
+    lines = block.decode('utf-8').split('\n')
+    for line_num, line in enumerate(lines[:-1], 1):
+        line = line.strip()
+        if not line:  # 빈 라인 건너뛰기
+            continue
+        
+        # 탭으로 분리
+        parts = line.split('\t')
+        if len(parts) < 2:
+            warnings.append((line_num, f"형식 오류 (탭으로 구분되지 않음): {line[:50]}..."))
+            continue
+        
+        # 사용자 ID 확인
+        user_id_str = parts[0].strip()
+        try:
+            user_id = int(user_id_str)
+        except ValueError:
+            warnings.append((line_num, f"사용자 ID를 정수로 변환할 수 없음: {user_id_str}"))
+            continue
+        
+        # 아이템 리스트 파싱 (공백으로 구분, 중복 제거하지 않고 순서 유지)
+        line_items = parts[1].split()
+        if not line_items:
+            warnings.append((line_num, "아이템이 없음"))
+            continue
+        if remove_n_prefix:
+            # "N" 접두사 제거: N39011 → 39011 (숫자로 변환 실패 시 원본 유지)
+            line_items = [str(int(item[1:])) if item.startswith('N') and item[1:].isdigit() else item for item in line_items]
+        users.extend([user_id] * len(line_items))
+        items.extend(line_items)
+    return np.array(users, dtype=np.int64), np.array(items, dtype=str), warnings, len(lines) - 1
 
-def convert_news_to_sasrec(input_file, output_file, keep_original_user_ids=False, remove_n_prefix=False):
+
+def convert_news_to_sasrec(input_file, output_file, keep_original_user_ids=False, remove_n_prefix=False,
+                           block_mb=64, workers=1, sort_rows=1 << 26, fmt='txt', tmp_dir=None):
     """
     뉴스 히스토리 데이터를 SASRec 형식으로 변환
     
@@ -28,130 +75,73 @@ def convert_news_to_sasrec(input_file, output_file, keep_original_user_ids=False
         output_file: 출력 파일 경로 (data/ 폴더에 저장)
         keep_original_user_ids: True면 원본 사용자 ID 유지, False면 1부터 시작하는 새 ID로 매핑
         remove_n_prefix: True면 아이템 ID에서 "N" 접두사 제거 (예: N39011 → 39011)
+        block_mb: 한 번에 읽어 파싱하는 블록 크기 (MB)
+        workers: 블록을 파싱하는 프로세스 수
+        sort_rows: 외부 정렬에서 한 번에 메모리에 올리는 상호작용 수
+        fmt: 'txt' (data/<name>.txt), 'compiled' (data/<name>.csr 바이너리), 'both'
+        tmp_dir: 외부 정렬 임시 파일 위치 (기본: 출력 폴더)
     """
     print(f"입력 파일 읽는 중: {input_file}")
     
-    # 사용자별 아이템 시퀀스 저장
-    user_sequences = defaultdict(list)
-    all_items = set()
-    
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line_num, line in enumerate(f, 1):
-            line = line.strip()
-            if not line:  # 빈 라인 건너뛰기
-                continue
-            
-            # 탭으로 분리
-            parts = line.split('\t')
-            if len(parts) < 2:
-                print(f"경고: 라인 {line_num}에서 형식 오류 (탭으로 구분되지 않음): {line[:50]}...")
-                continue
-            
-            user_id_str = parts[0].strip()
-            items_str = parts[1].strip()
-            
-            # 사용자 ID 확인
-            try:
-                user_id = int(user_id_str)
-            except ValueError:
-                print(f"경고: 라인 {line_num}에서 사용자 ID를 정수로 변환할 수 없음: {user_id_str}")
-                continue
-            
-            # 아이템 리스트 파싱 (공백으로 구분)
-            items = items_str.split()
-            if not items:
-                print(f"경고: 라인 {line_num}에서 아이템이 없음")
-                continue
-            
-            # 아이템 저장 (중복 제거하지 않고 순서 유지)
-            for item in items:
-                item = item.strip()
-                if item:  # 빈 문자열이 아닌 경우만
-                    # "N" 접두사 제거 옵션
-                    if remove_n_prefix and item.startswith('N'):
-                        # N39011 → 39011
-                        try:
-                            item_id = int(item[1:])  # 첫 글자 제거 후 정수 변환
-                            processed_item = str(item_id)
-                        except ValueError:
-                            # 숫자로 변환 실패 시 원본 유지
-                            processed_item = item
-                    else:
-                        processed_item = item
-                    
-                    user_sequences[user_id].append(processed_item)
-                    all_items.add(processed_item)
-    
-    print(f"  - 총 사용자 수: {len(user_sequences)}")
-    print(f"  - 총 고유 아이템 수: {len(all_items)}")
+    user_map, item_map = IdMap(), IdMap()
+    parse = functools.partial(_parse_block, remove_n_prefix=remove_n_prefix)
+    with tempfile.TemporaryDirectory(prefix='sasrec_convert_', dir=tmp_dir or (os.path.dirname(output_file) or '.')) as tmp:
+        # 블록 단위 스트리밍 파싱 + ID 매핑, 상호작용은 디스크에 기록 (사용자별 순서 = 파일 순서)
+        spill = InteractionSpill(tmp)
+        line_offset = 0
+        for users, items, warnings, n_lines in parse_blocks(parse, read_blocks(input_file, block_mb << 20), workers):
+            for line_num, message in warnings:
+                print(f"경고: 라인 {line_offset + line_num}에서 {message}")
+            spill.append(user_map.encode(users), item_map.encode(items))
+            line_offset += n_lines
     
-    # 아이템 ID 처리
-    unique_items = sorted(all_items)  # 정렬하여 일관된 매핑 보장
+        print(f"  - 총 사용자 수: {len(user_map)}")
+        print(f"  - 총 고유 아이템 수: {len(item_map)}")
     
-    if remove_n_prefix:
-        # "N" 접두사가 제거된 경우, 숫자 ID를 그대로 사용
-        # 단, 1부터 시작하지 않을 수 있으므로 확인 필요
-        item_map = {}
-        numeric_items = []
-        for item in unique_items:
-            try:
-                item_id = int(item)
-                item_map[item] = item_id  # 원본 숫자 ID 그대로 사용
-                numeric_items.append(item_id)
-            except ValueError:
-                # 숫자가 아닌 경우 기존 방식으로 매핑
-                item_map[item] = len(item_map) + 1
-        
-        print(f"  - 아이템 ID에서 'N' 접두사 제거됨")
-        if numeric_items:
-            print(f"  - 아이템 ID 범위: {min(numeric_items)} ~ {max(numeric_items)}")
-    else:
-        # 아이템 ID를 1부터 시작하는 연속된 정수로 매핑
-        item_map = {item: idx + 1 for idx, item in enumerate(unique_items)}
-    
-    # 사용자 ID 처리
-    unique_users = sorted(user_sequences.keys())
-    if keep_original_user_ids:
-        # 원본 사용자 ID 유지 (그대로 사용)
-        user_map = {old_id: old_id for old_id in unique_users}
-        print(f"  - 원본 사용자 ID 유지 (총 {len(user_map)}명)")
-        print(f"  - 사용자 ID 범위: {min(unique_users)} ~ {max(unique_users)}")
-    else:
-        # 사용자 ID를 1부터 시작하는 연속된 정수로 매핑
-        user_map = {old_id: new_id for new_id, old_id in enumerate(unique_users, start=1)}
-        print(f"  - 매핑된 사용자 수: {len(user_map)}")
+        # 아이템 ID 처리
+        if remove_n_prefix:
+            # "N" 접두사가 제거된 경우 숫자 ID를 그대로 사용, 숫자가 아닌 아이템은 그 뒤에 매핑
+            item_final = item_map.final_ids('int')
+            print(f"  - 아이템 ID에서 'N' 접두사 제거됨")
+            print(f"  - 아이템 ID 범위: {item_final[1:].min()} ~ {item_final[1:].max()}")
+        else:
+            # 아이템 ID를 1부터 시작하는 연속된 정수로 매핑 (문자열 정렬 순서)
+            item_final = item_map.final_ids('str')
     
-    print(f"  - 매핑된 아이템 수: {len(item_map)}")
+        # 사용자 ID 처리
+        if keep_original_user_ids:
+            # 원본 사용자 ID 유지 (그대로 사용)
+            user_final = user_map.final_ids('int')
+            print(f"  - 원본 사용자 ID 유지 (총 {len(user_map)}명)")
+            print(f"  - 사용자 ID 범위: {user_final[1:].min()} ~ {user_final[1:].max()}")
+        else:
+            # 사용자 ID를 1부터 시작하는 연속된 정수로 매핑
+            user_final = user_map.final_ids('sorted')
+            print(f"  - 매핑된 사용자 수: {len(user_map)}")
     
-    # 변환된 데이터 쓰기
-    print(f"출력 파일 작성 중: {output_file}")
-    total_interactions = 0
+        print(f"  - 매핑된 아이템 수: {len(item_map)}")
     
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for old_user_id in unique_users:
-            new_user_id = user_map[old_user_id]
-            for item in user_sequences[old_user_id]:
-                new_item_id = item_map[item]
-                f.write(f"{new_user_id} {new_item_id}\n")
-                total_interactions += 1
+        # 변환된 데이터 쓰기
+        print(f"출력 파일 작성 중: {output_file}")
+        total_interactions = write_dataset(spill, user_final, item_final, output_file, fmt=fmt, max_rows=sort_rows)
     
     print(f"변환 완료!")
     print(f"  - 총 상호작용 수: {total_interactions}")
-    print(f"  - 출력 파일: {output_file}")
+    print(f"  - 출력 파일: {output_file}" + (" (+ .csr)" if fmt == 'both' else " (.csr)" if fmt == 'compiled' else ""))
     
     # 매핑 정보 저장 (선택사항)
     mapping_file = output_file.replace('.txt', '_mapping.txt')
-    with open(mapping_file, 'w', encoding='utf-8') as f:
+    with open(mapping_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
         f.write("# 사용자 ID 매핑\n")
         f.write("# 원본_ID -> 새_ID\n")
-        for old_id, new_id in sorted(user_map.items()):
-            f.write(f"USER: {old_id} -> {new_id}\n")
+        order = np.argsort(np.array(user_map.keys[1:], dtype=np.int64), kind='stable') + 1
+        f.write(''.join(f"USER: {user_map.keys[i]} -> {user_final[i]}\n" for i in order.tolist()))
         
         f.write("\n# 아이템 ID 매핑 (처음 10개만 표시)\n")
         f.write("# 원본_ID -> 새_ID\n")
-        for i, (old_id, new_id) in enumerate(sorted(item_map.items(), key=lambda x: x[1])):
+        for i, new_id in enumerate(np.argsort(item_final[1:], kind='stable')[:11] + 1):
             if i < 10:
-                f.write(f"ITEM: {old_id} -> {new_id}\n")
+                f.write(f"ITEM: {item_map.keys[new_id]} -> {item_final[new_id]}\n")
             elif i == 10:
                 f.write(f"... (총 {len(item_map)}개 아이템)\n")
                 break
@@ -165,6 +155,7 @@ if __name__ == '__main__':
         epilog="""
 예시:
     python prepare_news_dataset.py --input data.tsv --output data/my_dataset.txt
+    python prepare_news_dataset.py --input data.tsv --output data/my_dataset.txt --format both --workers 8
         """
     )
     parser.add_argument('--input', required=True, 
@@ -175,8 +166,15 @@ if __name__ == '__main__':
                        help='원본 사용자 ID를 그대로 유지 (기본값: False, 1부터 시작하는 새 ID로 매핑)')
     parser.add_argument('--remove_n_prefix', action='store_true', default=False,
                        help='아이템 ID에서 "N" 접두사 제거 (예: N39011 → 39011)')
+    parser.add_argument('--format', default='txt', choices=['txt', 'compiled', 'both'],
+                       help='txt: data/<name>.txt, compiled: 학습용 바이너리 data/<name>.csr 직접 생성, both: 둘 다')
+    parser.add_argument('--workers', default=1, type=int, help='블록 파싱 프로세스 수')
+    parser.add_argument('--block_mb', default=64, type=int, help='파싱 블록 크기 (MB)')
+    parser.add_argument('--sort_rows', default=1 << 26, type=int, help='외부 정렬 파티션당 최대 상호작용 수 (메모리 한도)')
+    parser.add_argument('--tmp_dir', default=None, help='외부 정렬 임시 파일 폴더 (기본: 출력 폴더)')
     
     args = parser.parse_args()
     
-    convert_news_to_sasrec(args.input, args.output, args.keep_original_user_ids, args.remove_n_prefix)
-
+    convert_news_to_sasrec(args.input, args.output, args.keep_original_user_ids, args.remove_n_prefix,
+                           block_mb=args.block_mb, workers=args.workers, sort_rows=args.sort_rows,
+                           fmt=args.format, tmp_dir=args.tmp_dir)
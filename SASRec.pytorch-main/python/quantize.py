@@ -0,0 +1,166 @@
+"""
+Reduced-precision CPU inference for SASRec: bf16 autocast or int8 dynamic quantization.
+
+    fp32  the model as saved by main.py
+    bf16  log2feats / predict run under torch.autocast('cpu', dtype=torch.bfloat16)
+    int8  FFN Conv1d(k=1) layers become Linear and are dynamically quantized to int8
+          (int8 weights, activations quantized per batch); the item embedding table is stored as
+          int8 rows with a per-row fp32 scale and dequantized on lookup, and one item chunk at a
+          time when the catalog is scored (utils.full_catalog_topk). Attention in_proj stays
+          fp32 since MultiheadAttention keeps it as a raw parameter.
+
+Running the module evaluates every precision in its own process on the same users and
+negatives and reports accuracy deltas against fp32, throughput, predict latency, model size
+and peak resident memory.
+
+usage:
+    python quantize.py --dataset=MIND --state_dict_path=[YOUR_CKPT_PATH] --maxlen=200 --precisions=fp32,bf16,int8
+"""
+
+import io
+import time
+import random
+import argparse
+import functools
+import multiprocessing
+import numpy as np
+import torch
+
+from model import LinearFeedForward, add_model_args, load_model
+from telemetry import peak_rss_mb
+
+PRECISIONS = ['fp32', 'bf16', 'int8']
+
+
+class QuantizedEmbedding(torch.nn.Module):
+    """Embedding table as int8 rows with a per-row symmetric fp32 scale, dequantized on lookup."""
+
+    def __init__(self, embedding):
+        super(QuantizedEmbedding, self).__init__()
+        w = embedding.weight.detach().float()
+        scale = w.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / 127.0
+        self.register_buffer('qweight', torch.round(w / scale).to(torch.int8))
+        self.register_buffer('scale', scale)
+        self.num_embeddings = embedding.num_embeddings
+        self.embedding_dim = embedding.embedding_dim
+        self.padding_idx = embedding.padding_idx
+
+    @property
+    def weight(self):
+        # the whole table in fp32, catalog scoring goes through rows() instead
+        return self.qweight.float() * self.scale
+
+    def rows(self, lo, hi):
+        """Dequantized rows lo..hi-1, one catalog chunk."""
+        return self.qweight[lo:hi].float() * self.scale[lo:hi]
+
+    def forward(self, indices):
+        return self.qweight[indices].float() * self.scale[indices]
+
+
+def _autocast_bf16(fn):
+    @functools.wraps(fn)
+    def wrapped(*args, **kwargs):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            return fn(*args, **kwargs).float()
+    return wrapped
+
+
+def _quantize_linear(model):
+    try:
+        from torch.ao.quantization import quantize_dynamic
+    except ImportError as e: # an fp32 fallback would be measured and reported as int8
+        raise RuntimeError('int8 needs torch.ao.quantization.quantize_dynamic, not available in torch %s' % torch.__version__) from e
+    # only exact torch.nn.Linear matches, MultiheadAttention's out_proj is a subclass and is skipped
+    return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def to_precision(model, precision):
+    """Convert an eval-mode fp32 SASRec in place to the given inference precision."""
+    assert precision in PRECISIONS, precision
+    if precision == 'bf16':
+        model.log2feats = _autocast_bf16(model.log2feats)
+        model.predict = _autocast_bf16(model.predict)
+    elif precision == 'int8':
+        for i, ffn in enumerate(model.forward_layers):
+            if hasattr(ffn, 'conv1'):
+                model.forward_layers[i] = LinearFeedForward.from_conv(ffn)
+        model.item_emb = QuantizedEmbedding(model.item_emb)
+        model = _quantize_linear(model)
+    model.eval()
+    return model
+
+
+def load_inference_model(args, precision='fp32'):
+    return to_precision(load_model(args), precision)
+
+
+def model_bytes(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
+
+
+def measure(args, precision):
+    """Accuracy, throughput, latency and memory of one precision; run in a fresh process."""
+    from utils import data_partition, evaluate_split, select_eval_users
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    model = load_inference_model(args, precision)
+    dataset = data_partition(args.dataset)
+
+    # same users and negatives for every precision
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+    t = time.time()
+    metrics = evaluate_split(model, dataset, args, split='test')
+    eval_time = time.time() - t
+    n_users = len(select_eval_users(dataset, args, 'test')) # the count evaluate_split scored
+
+    rng = np.random.RandomState(args.seed)
+    seq = rng.randint(1, dataset[4] + 1, size=(args.latency_batch, args.maxlen))
+    items = rng.randint(1, dataset[4] + 1, size=(args.latency_batch, 101))
+    latencies = []
+    with torch.no_grad():
+        for r in range(args.latency_reps + 3):
+            t = time.perf_counter()
+            model.predict(None, seq, items)
+            if r >= 3: # warm-up
+                latencies.append(time.perf_counter() - t)
+    latencies = np.array(latencies) * 1e3
+
+    return dict(metrics, precision=precision, eval_time=eval_time, users_per_s=n_users / eval_time,
+                latency_p50_ms=float(np.percentile(latencies, 50)), latency_p99_ms=float(np.percentile(latencies, 99)),
+                model_mb=model_bytes(model) / 2 ** 20,
+                peak_rss_mb=peak_rss_mb()) # None without the resource module (Windows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare fp32 / bf16 / int8 CPU inference of a checkpoint')
+    add_model_args(parser)
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--precisions', default='fp32,bf16,int8', type=str)
+    parser.add_argument('--eval_batch_size', default=256, type=int)
+    parser.add_argument('--eval_users', default=10000, type=int, help='users sampled per evaluation as in main.py, 0 evaluates all of them')
+    parser.add_argument('--latency_batch', default=1, type=int, help='users per predict call in the latency test')
+    parser.add_argument('--latency_reps', default=50, type=int)
+    parser.add_argument('--num_threads', default=None, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+    args.device = 'cpu'
+
+    results = []
+    ctx = multiprocessing.get_context('spawn') # separate processes so peak RSS is per precision
+    for precision in args.precisions.split(','):
+        with ctx.Pool(1) as pool:
+            results.append(pool.apply(measure, (args, precision)))
+        print()
+
+    base = next((r for r in results if r['precision'] == 'fp32'), results[0])
+    print('%-6s %16s %16s %10s %10s %10s %10s %12s' % ('prec', 'NDCG@10 (delta)', 'HR@10 (delta)', 'users/s', 'p50 ms', 'p99 ms', 'model MB', 'peak RSS MB'))
+    for r in results:
+        print('%-6s %7.4f (%+.4f) %7.4f (%+.4f) %10.1f %10.3f %10.3f %10.2f %12s'
+              % (r['precision'], r['NDCG@10'], r['NDCG@10'] - base['NDCG@10'], r['HR@10'], r['HR@10'] - base['HR@10'],
+                 r['users_per_s'], r['latency_p50_ms'], r['latency_p99_ms'], r['model_mb'],
+                 'n/a' if r['peak_rss_mb'] is None else '%.1f' % r['peak_rss_mb']))
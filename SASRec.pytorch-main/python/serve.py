@@ -0,0 +1,258 @@
+"""
+CPU recommendation server around SASRec with dynamic micro-batching.
+
+Concurrent requests are collected into one batch until --max_batch requests are waiting or the
+oldest has waited --max_wait_ms, then scored in a single forward pass.
+
+    POST /recommend  {"history": [item, ...], "k": 10}                   top-k over the catalog, history masked
+    POST /recommend  {"history": [item, ...], "candidates": [item, ...]}  scores of the given candidates
+    GET  /stats      latency percentiles, batch-size histogram, request counts
+
+usage:
+    python serve.py --state_dict_path=[YOUR_CKPT_PATH] --maxlen=200 --port=8080
+    python serve_loadgen.py --url=http://127.0.0.1:8080 --dataset=MIND
+"""
+
+import json
+import time
+import queue
+import numbers
+import argparse
+import threading
+import numpy as np
+import torch
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from model import add_model_args
+from quantize import PRECISIONS, load_inference_model
+from utils import full_catalog_topk, item_table
+
+
+def _as_ids(name, ids):
+    """List of int item ids; ValueError for anything that is not a list of integers (1.7 is not item 1)."""
+    if not isinstance(ids, (list, tuple)):
+        raise ValueError('%s must be a list of item ids' % name)
+    if not all(isinstance(i, numbers.Integral) and not isinstance(i, bool) for i in ids):
+        raise ValueError('%s item ids must be integers' % name)
+    return [int(i) for i in ids]
+
+
+class Request(object):
+    def __init__(self, history, k=10, candidates=None):
+        self.history = _as_ids('history', history)
+        if not isinstance(k, numbers.Integral) or isinstance(k, bool):
+            raise ValueError('k must be an integer')
+        self.k = int(k)
+        self.candidates = None if candidates is None else _as_ids('candidates', candidates)
+        self.t_arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def validate(self, item_num):
+        """ValueError for inputs that would fail inside the batched forward, answered with a 400."""
+        if self.k <= 0:
+            raise ValueError('k must be positive')
+        if self.candidates is not None and not self.candidates:
+            raise ValueError('candidates must not be empty; omit it for catalog top-k')
+        for name, ids in (('history', self.history), ('candidates', self.candidates or [])):
+            if ids and (min(ids) < 1 or max(ids) > item_num):
+                raise ValueError('%s item ids must be in 1..%d' % (name, item_num))
+
+
+class ServingStats(object):
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window) # seconds, most recent requests
+        self.batch_sizes = Counter()
+        self.requests, self.batches, self.errors = 0, 0, 0
+        self.t_start = time.time()
+
+    def record_batch(self, requests):
+        now = time.perf_counter()
+        with self.lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.batch_sizes[len(requests)] += 1
+            self.latencies.extend(now - r.t_arrival for r in requests)
+
+    def summary(self):
+        with self.lock:
+            lat = np.array(self.latencies) * 1e3
+            out = {
+                'requests': self.requests,
+                'batches': self.batches,
+                'errors': self.errors,
+                'uptime_s': time.time() - self.t_start,
+                'mean_batch_size': self.requests / max(self.batches, 1),
+                'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+            }
+            if len(lat):
+                for p in [50, 90, 95, 99]:
+                    out['latency_p%d_ms' % p] = float(np.percentile(lat, p))
+                out['latency_max_ms'] = float(lat.max())
+            return out
+
+
+class MicroBatcher(object):
+    """Single scoring thread that turns queued requests into batched predict calls."""
+
+    def __init__(self, model, max_batch=64, max_wait_ms=5.0, item_chunk=65536):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1e3
+        self.item_chunk = item_chunk
+        self.queue = queue.Queue()
+        self.stats = ServingStats()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, request, timeout=30.0):
+        self.queue.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError('request timed out')
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].t_arrival + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _windows(self, requests):
+        maxlen = self.model.maxlen
+        seqs = np.zeros((len(requests), maxlen), dtype=np.int32)
+        for row, r in enumerate(requests):
+            h = r.history[-maxlen:]
+            if h:
+                seqs[row, maxlen - len(h):] = h
+        return seqs
+
+    def _score_candidates(self, requests):
+        width = max(len(r.candidates) for r in requests)
+        cand = np.zeros((len(requests), width), dtype=np.int64)
+        for row, r in enumerate(requests):
+            cand[row, :len(r.candidates)] = r.candidates
+        logits = self.model.predict(None, self._windows(requests), cand).cpu().numpy()
+        for row, r in enumerate(requests):
+            scores = logits[row, :len(r.candidates)]
+            order = np.argsort(-scores, kind='stable')[:r.k]
+            r.result = {'items': [r.candidates[i] for i in order], 'scores': scores[order].tolist()}
+
+    def _score_catalog(self, requests):
+        feats = self.model.final_feats(self._windows(requests))
+        rows = np.concatenate([np.full(len(r.history), row) for row, r in enumerate(requests)]).astype(np.int64)
+        items = np.concatenate([np.asarray(r.history, dtype=np.int64) for r in requests])
+        k = max(r.k for r in requests)
+        scores, ids = full_catalog_topk(feats, item_table(self.model.item_emb), rows, items, k, self.item_chunk)
+        scores, ids = scores.cpu().numpy(), ids.cpu().numpy()
+        for row, r in enumerate(requests):
+            r.result = {'items': ids[row, :r.k].tolist(), 'scores': scores[row, :r.k].tolist()}
+
+    def _score(self, requests):
+        with torch.no_grad():
+            with_cand = [r for r in requests if r.candidates is not None]
+            catalog = [r for r in requests if r.candidates is None]
+            if with_cand:
+                self._score_candidates(with_cand)
+            if catalog:
+                self._score_catalog(catalog)
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._score(batch)
+            except Exception as e: # never the serving thread; rescore one by one so only the culprits fail
+                failed = 0
+                for r in batch:
+                    try:
+                        if len(batch) == 1:
+                            raise e
+                        self._score([r])
+                    except Exception as e_r:
+                        r.error = e_r
+                        failed += 1
+                with self.stats.lock:
+                    self.stats.errors += failed
+            self.stats.record_batch(batch)
+            for r in batch:
+                r.done.set()
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send(200, batcher.stats.summary())
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/recommend':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if not isinstance(req, dict):
+                    raise ValueError('request body must be a JSON object')
+                request = Request(req.get('history', []), req.get('k', 10), req.get('candidates'))
+                request.validate(batcher.model.item_num)
+            except (ValueError, TypeError) as e:
+                self._send(400, {'error': str(e)})
+                return
+            try:
+                self._send(200, batcher.submit(request))
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass # per-request access logs would dominate at load
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='micro-batching SASRec recommendation server (CPU)')
+    add_model_args(parser)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--max_batch', default=64, type=int)
+    parser.add_argument('--max_wait_ms', default=5.0, type=float)
+    parser.add_argument('--item_chunk', default=65536, type=int, help='items scored per chunk for catalog top-k')
+    parser.add_argument('--num_threads', default=None, type=int, help='torch intra-op threads')
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS, help='see quantize.py')
+    args = parser.parse_args()
+    args.device = 'cpu' # serving is CPU only
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    model = load_inference_model(args, args.precision)
+    batcher = MicroBatcher(model, args.max_batch, args.max_wait_ms, args.item_chunk)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+    server.daemon_threads = True
+    print('serving %d items on http://%s:%d (max_batch=%d, max_wait_ms=%.1f, precision=%s)'
+          % (model.item_num, args.host, args.port, args.max_batch, args.max_wait_ms, args.precision))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(batcher.stats.summary(), indent=2))
@@ -0,0 +1,72 @@
+"""
+Local load generator for serve.py: concurrent clients sending histories from a dataset.
+
+usage:
+    python serve_loadgen.py --url=http://127.0.0.1:8080 --dataset=MIND --concurrency=32 --duration=20
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.request
+import numpy as np
+
+from dataset import load_compiled
+
+
+def post(url, payload):
+    req = urllib.request.Request(url, data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req) as resp:
+        return json.loads(resp.read())
+
+
+def client(args, histories, itemnum, deadline, latencies, errors, seed):
+    rng = random.Random(seed)
+    while time.time() < deadline:
+        payload = {'history': rng.choice(histories), 'k': args.k}
+        if args.candidates > 0:
+            payload['candidates'] = [rng.randint(1, itemnum) for _ in range(args.candidates)]
+        t = time.perf_counter()
+        try:
+            post(args.url + '/recommend', payload)
+            latencies.append(time.perf_counter() - t)
+        except Exception:
+            errors.append(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--concurrency', default=32, type=int)
+    parser.add_argument('--duration', default=20.0, type=float, help='seconds')
+    parser.add_argument('--k', default=10, type=int)
+    parser.add_argument('--candidates', default=0, type=int, help='random candidates per request, 0 for catalog top-k')
+    parser.add_argument('--num_histories', default=1000, type=int)
+    args = parser.parse_args()
+
+    compiled = load_compiled(args.dataset)
+    u2i = compiled.u2i()
+    users = u2i.keys_array()[:args.num_histories]
+    histories = [u2i[u].tolist() for u in users]
+
+    latencies, errors = [], []
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=client, args=(args, histories, compiled.itemnum, deadline, latencies, errors, i))
+               for i in range(args.concurrency)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+
+    lat = np.array(latencies) * 1e3
+    print('requests: %d, errors: %d, throughput: %.1f req/s' % (len(lat), len(errors), len(lat) / elapsed))
+    if len(lat):
+        print('client latency ms - p50: %.2f, p90: %.2f, p99: %.2f, max: %.2f'
+              % tuple(np.percentile(lat, [50, 90, 99]).tolist() + [lat.max()]))
+    with urllib.request.urlopen(args.url + '/stats') as resp:
+        print('server stats: %s' % resp.read().decode())
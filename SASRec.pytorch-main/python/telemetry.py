@@ -0,0 +1,228 @@
+"""
+Training-loop telemetry: per-phase step timing, throughput, peak memory and loss, logged
+every N steps as JSON lines by a background thread, plus an optional torch.profiler window.
+
+    telemetry = TrainTelemetry(os.path.join(folder, 'telemetry.jsonl'), log_every=100, device=args.device)
+    for step in ...:
+        with telemetry.phase('sampler'):
+            u, seq, pos, neg = sampler.next_batch()
+        with telemetry.phase('forward'):
+            ...
+        telemetry.end_step(loss, samples=len(seq), tokens=np.count_nonzero(seq))
+    telemetry.event('compile', 'torch.compile fell back to eager')   # one-off records carry 'event'
+    telemetry.close()
+
+The loss is accumulated on its device and only read back when a record is written, so the
+loop no longer syncs on loss.item() every iteration. On CUDA, phase times measure host time
+(kernel launches) unless sync=True, which synchronizes at every phase boundary.
+"""
+
+import sys
+import json
+import time
+import queue
+import threading
+from collections import OrderedDict
+import torch
+
+try:
+    import resource
+except ImportError: # not on Windows, records then leave out peak_rss_mb
+    resource = None
+
+PHASES = ['sampler', 'h2d', 'forward', 'loss', 'backward', 'optimizer']
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, None where the resource module is missing."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2.0 ** 20 if sys.platform == 'darwin' else 1024.0)
+
+
+class JsonlWriter(object):
+    """Appends dict records to a JSONL file from a daemon thread, the caller never blocks on disk."""
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def _loop(self):
+        with open(self.path, 'a') as f:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                f.write(json.dumps(record) + '\n')
+                if self.queue.empty():
+                    f.flush()
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class ProfileWindow(object):
+    """torch.profiler capture of global steps [start, stop), exported as a chrome trace."""
+
+    def __init__(self, start, stop, trace_path):
+        self.start, self.stop, self.trace_path = start, stop, trace_path
+        self.prof = None
+
+    @classmethod
+    def parse(cls, spec, trace_path):
+        # 'a:b' -> steps a..b-1, '' or None -> no profiling
+        if not spec:
+            return None
+        start, stop = [int(x) for x in spec.split(':')]
+        return cls(start, stop, trace_path)
+
+    @property
+    def active(self):
+        return self.prof is not None
+
+    def step(self, global_step):
+        # call before running global_step
+        if global_step == self.start and self.prof is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.prof = torch.profiler.profile(activities=activities, profile_memory=True)
+            self.prof.start()
+        elif global_step == self.stop and self.prof is not None:
+            self.finish()
+
+    def finish(self):
+        if self.prof is None:
+            return
+        self.prof.stop()
+        self.prof.export_chrome_trace(self.trace_path)
+        print(self.prof.key_averages().table(sort_by='self_cpu_time_total', row_limit=20))
+        print('profiler trace of steps %d-%d written to %s' % (self.start, self.stop - 1, self.trace_path))
+        self.prof = None
+
+
+class TrainTelemetry(object):
+    def __init__(self, path=None, log_every=100, device='cpu', sync=False, profile=None, verbose=True):
+        self.writer = JsonlWriter(path) if path is not None else None
+        self.log_every = log_every
+        self.cuda = str(device).startswith('cuda')
+        self.sync = sync and self.cuda
+        self.profile = profile
+        self.verbose = verbose
+        self.global_step = 0
+        self.last = None # the most recent record
+        self._reset()
+        if self.profile is not None:
+            self.profile.step(self.global_step)
+
+    def _reset(self):
+        self.times = OrderedDict((p, 0.0) for p in PHASES)
+        self.steps, self.samples, self.tokens = 0, 0, 0
+        self.loss_sum = None
+        self.t_window = None # started by the next phase, so gaps between windows (evaluation) are not counted
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def end_step(self, loss, samples, tokens, **extra):
+        """Close one optimizer step; writes a record every log_every steps."""
+        loss = loss.detach()
+        self.loss_sum = loss if self.loss_sum is None else self.loss_sum + loss
+        self.steps += 1
+        self.samples += int(samples)
+        self.tokens += int(tokens)
+        self.global_step += 1
+        if self.profile is not None:
+            self.profile.step(self.global_step)
+        if self.steps >= self.log_every:
+            self.flush(**extra)
+
+    def flush(self, **extra):
+        if self.steps == 0:
+            return None
+        if self.cuda:
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - self.t_window
+        record = OrderedDict(extra)
+        record['global_step'] = self.global_step
+        record['steps'] = self.steps
+        record['loss'] = self.loss_sum.item() / self.steps # the only sync with the device per window
+        record['step_ms'] = 1e3 * elapsed / self.steps
+        for p, t in self.times.items():
+            record[p + '_ms'] = 1e3 * t / self.steps
+        record['other_ms'] = record['step_ms'] - sum(record[p + '_ms'] for p in PHASES)
+        record['samples_per_s'] = self.samples / elapsed
+        record['tokens_per_s'] = self.tokens / elapsed
+        rss = peak_rss_mb()
+        if rss is not None:
+            record['peak_rss_mb'] = rss
+        if self.cuda:
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        record['time'] = time.time()
+        if self.writer is not None:
+            self.writer.write(record)
+        if self.verbose:
+            print(self.format(record))
+        self.last = record
+        self._reset()
+        return record
+
+    def event(self, name, message, **fields):
+        """A one-off record between the step windows (e.g. compilation), printed when verbose."""
+        record = OrderedDict(fields)
+        record['event'] = name
+        record['message'] = message
+        record['global_step'] = self.global_step
+        record['time'] = time.time()
+        if self.writer is not None:
+            self.writer.write(record)
+        if self.verbose:
+            print(message)
+        return record
+
+    def format(self, record):
+        head = ' '.join('%s %s' % (k, v) for k, v in record.items() if k in ('epoch', 'step'))
+        return ('%s loss %.4f, %.1f samples/s, %.0f tokens/s, %.1f ms/step (%s)'
+                % (head, record['loss'], record['samples_per_s'], record['tokens_per_s'], record['step_ms'],
+                   ', '.join('%s %.1f' % (p, record[p + '_ms']) for p in PHASES)))
+
+    def close(self, **extra):
+        self.flush(**extra)
+        if self.profile is not None:
+            self.profile.finish()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class _Phase(object):
+    def __init__(self, telemetry, name):
+        self.telemetry, self.name = telemetry, name
+        self.record = None
+
+    def __enter__(self):
+        if self.telemetry.sync:
+            torch.cuda.synchronize()
+        if self.telemetry.t_window is None:
+            self.telemetry.t_window = time.perf_counter()
+        if self.telemetry.profile is not None and self.telemetry.profile.active:
+            self.record = torch.profiler.record_function(self.name) # phase ranges show up in the trace
+            self.record.__enter__()
+        self.t = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.telemetry.sync:
+            torch.cuda.synchronize()
+        self.telemetry.times[self.name] += time.perf_counter() - self.t
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        return False
@@ -0,0 +1,54 @@
+"""
+Model fixtures shared by the tests: small model args, random right-aligned batches and the
+legacy / fast engine parity checks.
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from model import SASRec, SASRecFast
+
+
+def make_args(maxlen, hidden, num_blocks, num_heads, norm_first, dropout_rate=0.2):
+    return argparse.Namespace(device='cpu', maxlen=maxlen, hidden_units=hidden, num_blocks=num_blocks,
+                              num_heads=num_heads, dropout_rate=dropout_rate, norm_first=norm_first)
+
+
+def random_batch(rng, batch_size, maxlen, itemnum):
+    # right-aligned histories of random length, like the sampler produces
+    lens = rng.randint(1, maxlen + 1, size=batch_size)
+    seq = rng.randint(1, itemnum + 1, size=(batch_size, maxlen))
+    seq[np.arange(maxlen)[None, :] < (maxlen - lens)[:, None]] = 0
+    pos = np.where(seq > 0, rng.randint(1, itemnum + 1, size=seq.shape), 0)
+    neg = np.where(seq > 0, rng.randint(1, itemnum + 1, size=seq.shape), 0)
+    return seq, pos, neg
+
+
+def parity(args, itemnum, batch_size, seed=0):
+    """max |legacy - fast| of log2feats and predict logits, both in eval mode."""
+    torch.manual_seed(seed)
+    legacy = SASRec(0, itemnum, args).eval()
+    fast = SASRecFast(0, itemnum, args).eval()
+    fast.load_state_dict(legacy.state_dict())
+    rng = np.random.RandomState(seed)
+    seq, _, _ = random_batch(rng, batch_size, args.maxlen, itemnum)
+    items = rng.randint(1, itemnum + 1, size=(batch_size, 101))
+    with torch.no_grad():
+        d_feats = (legacy.log2feats(seq) - fast.log2feats(seq)).abs().max().item()
+        d_logits = (legacy.predict(None, seq, items) - fast.predict(None, seq, items)).abs().max().item()
+    return d_feats, d_logits
+
+
+def last_only_parity(args, itemnum, batch_size, seed=0):
+    """max |log2feats(seq)[:, -1] - final_feats(seq)| per engine, in eval mode."""
+    rng = np.random.RandomState(seed)
+    seq, _, _ = random_batch(rng, batch_size, args.maxlen, itemnum)
+    out = []
+    for cls in [SASRec, SASRecFast]:
+        torch.manual_seed(seed)
+        model = cls(0, itemnum, args).eval()
+        with torch.no_grad():
+            out.append((model.log2feats(seq)[:, -1, :] - model.final_feats(seq)).abs().max().item())
+    return out
@@ -0,0 +1,92 @@
+"""
+prepare_new_dataset.py against the original in-memory converter (pd.read_csv, pd.to_datetime,
+sort by user and time) on numeric and string timestamps.
+
+usage (from python/):
+    python -m pytest -q tests/test_converters.py
+"""
+
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from prepare_new_dataset import convert_to_sasrec_format
+
+
+def reference_lines(path, time_format=None):
+    # the converter before streaming: everything in memory, ids in sorted order of the raw ids
+    df = pd.read_csv(path)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format=time_format)
+    df = df.sort_values(['user_id', 'timestamp'], kind='stable')
+    seqs = defaultdict(list)
+    for user, item in zip(df['user_id'], df['item_id']):
+        seqs[user].append(item)
+    users = sorted(seqs)
+    items = {old: new for new, old in enumerate(sorted(set(df['item_id'])), start=1)}
+    return ['%d %d' % (u, items[i]) for u, old in enumerate(users, start=1) for i in seqs[old]]
+
+
+def write_csv(path, rng, n, make_time):
+    users = rng.randint(1, 300, size=n)
+    items = rng.randint(1, 1000, size=n)
+    times = rng.permutation(n) # distinct, so the order within a user is unambiguous
+    with open(path, 'w') as f:
+        f.write('user_id,item_id,timestamp\n')
+        for u, i, t in zip(users, items, times):
+            f.write('%d,%d,%s\n' % (u, i, make_time(t)))
+
+
+def convert(tmp_path, src, **kwargs):
+    out = tmp_path / 'out.txt'
+    convert_to_sasrec_format(str(src), str(out), **kwargs)
+    return out.read_text().splitlines()
+
+
+@pytest.mark.parametrize('make_time', [
+    lambda t: str(1609459200 + int(t)),                                            # Unix epoch seconds
+    lambda t: str(1609459200000 + 1000 * int(t)),                                 # Unix epoch milliseconds
+    lambda t: str(pd.Timestamp(1609459200 + int(t), unit='s')),                   # 2021-01-01 00:00:00
+    lambda t: pd.Timestamp(1609459200 + 3600 * int(t), unit='s').strftime('%m/%d/%Y %H:%M'),
+], ids=['epoch_s', 'epoch_ms', 'iso', 'us_date'])
+def test_matches_in_memory_converter(tmp_path, make_time):
+    src = tmp_path / 'in.csv'
+    write_csv(src, np.random.RandomState(0), 2000, make_time)
+    assert convert(tmp_path, src) == reference_lines(src)
+
+
+def test_float_epoch_timestamps(tmp_path):
+    src = tmp_path / 'in.csv'
+    src.write_text('user_id,item_id,timestamp\n1,10,1609459300.5\n1,20,1609459300.25\n1,30,-2.5\n2,10,0.5\n')
+    assert convert(tmp_path, src) == ['1 3', '1 2', '1 1', '2 1']
+
+
+def test_blocks_parse_times_alike(tmp_path):
+    # several 1 MB blocks, the time format is taken from the first one and used for all of them
+    src = tmp_path / 'in.csv'
+    write_csv(src, np.random.RandomState(1), 100000,
+              lambda t: pd.Timestamp(1609459200 + 60 * int(t), unit='s').strftime('%d/%m/%Y %H:%M:%S'))
+    assert src.stat().st_size > 2 << 20 # at least three blocks
+    assert convert(tmp_path, src, block_mb=1, workers=2) == reference_lines(src, '%d/%m/%Y %H:%M:%S')
+
+
+def test_partitions_bounded_under_skew(tmp_path):
+    # a few heavy users at the low end of the id range: equal-width user ranges would put most
+    # of the records into the first partition
+    from convert_utils import InteractionSpill
+
+    rng = np.random.RandomState(2)
+    users = np.concatenate([rng.randint(1, 4, size=6000), rng.randint(4, 400, size=2000)])
+    users = users[rng.permutation(len(users))]
+    items = rng.randint(1, 50, size=len(users))
+    spill = InteractionSpill(str(tmp_path))
+    spill.append(users, items, rng.permutation(len(users)))
+    identity = np.arange(users.max() + 1)
+    heavy = np.bincount(users).max()
+    parts = list(spill.sorted_chunks(identity, np.arange(items.max() + 1), max_rows=1000))
+    assert len(parts) > 1
+    for part_users, _ in parts:
+        assert len(part_users) <= max(1000, heavy) and (len(part_users) <= 1000 or len(set(part_users)) == 1)
+    out_users = np.concatenate([u for u, _ in parts])
+    assert len(out_users) == len(users) and (np.diff(out_users) >= 0).all()
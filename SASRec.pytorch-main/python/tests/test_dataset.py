@@ -0,0 +1,90 @@
+"""
+Compiled dataset cache (dataset.py): data_partition and build_index over the cache against the
+text parsers they replaced, versioned publishing and readers across a rebuild.
+
+usage (from python/):
+    python -m pytest -q tests/test_dataset.py
+"""
+
+import os
+from collections import defaultdict
+
+import numpy as np
+
+from dataset import CompiledDataset, compile_arrays, published_dir, write_compiled
+from utils import build_index, data_partition
+
+
+def reference_partition(path):
+    # data_partition before the cache: a dict of lists per split, parsed line by line
+    usernum, itemnum, User = 0, 0, defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            u, i = [int(x) for x in line.rstrip().split(' ')]
+            usernum, itemnum = max(u, usernum), max(i, itemnum)
+            User[u].append(i)
+    train, valid, test = {}, {}, {}
+    for user, items in User.items():
+        if len(items) < 4:
+            train[user], valid[user], test[user] = items, [], []
+        else:
+            train[user], valid[user], test[user] = items[:-2], [items[-2]], [items[-1]]
+    return [train, valid, test, usernum, itemnum]
+
+
+def reference_index(path):
+    # build_index before the cache: lists of items per user id and of users per item id
+    ui_mat = np.loadtxt(path, dtype=np.int32)
+    u2i = [[] for _ in range(ui_mat[:, 0].max() + 1)]
+    i2u = [[] for _ in range(ui_mat[:, 1].max() + 1)]
+    for u, i in ui_mat:
+        u2i[u].append(i)
+        i2u[i].append(u)
+    return u2i, i2u
+
+
+def test_cache_matches_text_parser(tmp_path, monkeypatch):
+    # interleaved users (file order is the sequence order), missing user and item ids, users
+    # under 4 interactions that keep everything in train
+    rng = np.random.RandomState(0)
+    lengths = {u: rng.randint(1, 12) for u in range(1, 60) if u % 7 != 0}
+    lines = [(u, rng.choice(np.arange(2, 300, 3))) for u in lengths for _ in range(lengths[u])]
+    lines = [lines[j] for j in rng.permutation(len(lines))]
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    with open('data/toy.txt', 'w') as f:
+        f.writelines('%d %d\n' % (u, i) for u, i in lines)
+
+    ref, got = reference_partition('data/toy.txt'), data_partition('toy')
+    assert got[3:] == ref[3:] # usernum, itemnum
+    for split in range(3):
+        assert sorted(got[split]) == sorted(ref[split])
+        for u in ref[split]:
+            assert got[split][u].tolist() == ref[split][u], (split, u)
+
+    ref_u2i, ref_i2u = reference_index('data/toy.txt')
+    u2i, i2u = build_index('toy')
+    for ref_index, index in [(ref_u2i, u2i), (ref_i2u, i2u)]:
+        for key, values in enumerate(ref_index):
+            assert list(index.get(key, [])) == values, key
+
+
+def write_users(path, usernum):
+    users = np.repeat(np.arange(1, usernum + 1), 5)
+    items = np.tile(np.arange(1, 6), usernum)
+    arrays, _, _ = compile_arrays(users, items, usernum, 5)
+    write_compiled(path, arrays, usernum, 5)
+
+
+def test_rebuild_switches_versions(tmp_path):
+    path = str(tmp_path / 'x.csr')
+    os.makedirs(path)
+    for name in ['meta.json', 'user_ptr.npy']: # the flat layout before versions
+        open(os.path.join(path, name), 'w').close()
+    write_users(path, 7)
+    first = CompiledDataset(path)
+    write_users(path, 9)
+    second = CompiledDataset(path)
+    assert (first.usernum, len(first.user_ptr)) == (7, 9) # mapped before the switch, still intact
+    assert (second.usernum, len(second.user_ptr)) == (9, 11)
+    assert sorted(os.listdir(path)) == ['CURRENT', os.path.basename(published_dir(path))]
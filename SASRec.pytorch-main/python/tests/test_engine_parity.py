@@ -0,0 +1,138 @@
+"""
+Numerical parity checks of the model engines and inference paths, whose speed benchmark.py
+(--benches=engine) and incremental.py report. Shared fixtures are in helpers.py.
+
+usage (from python/):
+    python -m pytest -q tests
+"""
+
+import numpy as np
+import pytest
+import torch
+
+from helpers import last_only_parity, make_args, parity, random_batch
+from incremental import IncrementalSASRec, predict_feat, window_feat
+from model import SASRec, SASRecFast, build_model, convert_state_dict
+from utils import build_optimizers
+
+ITEMNUM = 500
+ATOL = 1e-5
+
+
+@pytest.mark.parametrize('norm_first', [False, True])
+@pytest.mark.parametrize('num_heads', [1, 2])
+def test_legacy_fast_parity(norm_first, num_heads):
+    # legacy state_dict loaded into the fast engine through the Conv1d -> Linear FFN conversion
+    d_feats, d_logits = parity(make_args(30, 16, 2, num_heads, norm_first), ITEMNUM, 16)
+    assert d_feats < ATOL
+    assert d_logits < ATOL
+
+
+@pytest.mark.parametrize('norm_first', [False, True])
+def test_last_only_parity(norm_first):
+    d_legacy, d_fast = last_only_parity(make_args(30, 16, 2, 2, norm_first), ITEMNUM, 16)
+    assert d_legacy < ATOL
+    assert d_fast < ATOL
+
+
+def test_convert_state_dict_roundtrip():
+    args = make_args(20, 16, 2, 1, False)
+    torch.manual_seed(0)
+    fast = SASRecFast(0, ITEMNUM, args).eval()
+    legacy = SASRec(0, ITEMNUM, args).eval()
+    legacy.load_state_dict(convert_state_dict(fast.state_dict(), 'legacy'))
+    back = convert_state_dict(convert_state_dict(fast.state_dict(), 'legacy'), 'fast')
+    assert back.keys() == fast.state_dict().keys()
+    for name, t in fast.state_dict().items():
+        assert torch.equal(back[name], t), name
+    seq, _, _ = random_batch(np.random.RandomState(0), 8, 20, ITEMNUM)
+    with torch.no_grad():
+        assert (legacy.log2feats(seq) - fast.log2feats(seq)).abs().max().item() < ATOL
+
+
+@pytest.mark.parametrize('engine', ['legacy', 'fast'])
+def test_checkpoint_activations_exact(engine):
+    args = make_args(20, 16, 2, 2, False)
+    args.engine = engine
+    torch.manual_seed(0)
+    model = build_model(0, ITEMNUM, args).train()
+    seq, pos, neg = random_batch(np.random.RandomState(0), 8, 20, ITEMNUM)
+    grads = []
+    for ckpt in [False, True]:
+        model.checkpoint_activations = ckpt
+        model.zero_grad()
+        torch.manual_seed(1) # same dropout masks
+        pos_logits, neg_logits = model(None, seq, pos, neg)
+        (pos_logits.sum() - neg_logits.sum()).backward()
+        grads.append([p.grad.clone() for p in model.parameters() if p.grad is not None])
+    for a, b in zip(*grads):
+        assert torch.equal(a, b)
+
+
+def test_sparse_embedding_first_step_matches_dense():
+    # from zero optimizer state Adam leaves untouched rows alone, so one SparseAdam + Adam step
+    # must land on the same weights as one dense Adam step (eps is made negligible, SparseAdam adds
+    # it before the bias correction and Adam after)
+    seq, pos, neg = random_batch(np.random.RandomState(0), 8, 20, ITEMNUM)
+    weights = []
+    for sparse in [False, True]:
+        args = make_args(20, 16, 2, 1, False)
+        args.sparse_emb, args.lr, args.l2_emb = sparse, 0.01, 0.0
+        torch.manual_seed(0)
+        model = build_model(0, ITEMNUM, args).train()
+        optimizers = build_optimizers(model, args)
+        for optimizer in optimizers:
+            for group in optimizer.param_groups:
+                group['eps'] = 1e-16
+        torch.manual_seed(1)
+        pos_logits, neg_logits = model(None, seq, pos, neg)
+        loss = torch.nn.functional.softplus(-pos_logits).sum() + torch.nn.functional.softplus(neg_logits).sum()
+        loss.backward()
+        assert model.item_emb.weight.grad.is_sparse == sparse
+        for optimizer in optimizers:
+            optimizer.step()
+        weights.append({name: p.detach().clone() for name, p in model.named_parameters()})
+    for name in weights[0]:
+        assert torch.allclose(weights[0][name], weights[1][name], atol=1e-6), name
+
+
+@pytest.mark.parametrize('norm_first', [False, True])
+def test_incremental_matches_full_recompute(norm_first):
+    # the default cache: single cached steps between resets, each equal to a recompute of its layout
+    args = make_args(16, 16, 2, 2, norm_first)
+    torch.manual_seed(0)
+    model = SASRec(0, ITEMNUM, args).eval()
+    cache = IncrementalSASRec(model)
+    rng = np.random.RandomState(0)
+    for user in range(3):
+        items = rng.randint(1, ITEMNUM + 1, size=30).tolist()
+        cache.start(user, items[:5])
+        for item in items[5:]: # crosses several window resets
+            feat = cache.append(user, item)
+            window, col = cache.layout(user)
+            assert (feat - window_feat(model, window, col)).abs().max().item() < 1e-4
+    assert cache.stats['resets'] > 0
+    assert cache.stats['cached'] > cache.stats['resets']
+
+
+@pytest.mark.parametrize('norm_first', [False, True])
+def test_incremental_recompute_mode_matches_predict(norm_first):
+    # headroom=0 recomputes every append: predict()'s scores, and no key/value buffers kept
+    args = make_args(16, 16, 2, 2, norm_first)
+    torch.manual_seed(0)
+    model = SASRec(0, ITEMNUM, args).eval()
+    cache = IncrementalSASRec(model, headroom=0)
+    rng = np.random.RandomState(0)
+    items = torch.arange(1, ITEMNUM + 1)
+    history = rng.randint(1, ITEMNUM + 1, size=30).tolist()
+    cache.start(0, history[:5])
+    for i in range(5, len(history)): # short and full windows
+        feat = cache.append(0, history[i])
+        window = np.zeros(args.maxlen, dtype=np.int32)
+        seq = history[:i + 1][-args.maxlen:]
+        window[args.maxlen - len(seq):] = seq
+        with torch.no_grad():
+            logits = model.predict(None, window[None, :], items[None, :])[0]
+        assert (cache.score(0, items) - logits).abs().max().item() < 1e-4
+        assert (feat - predict_feat(model, history[:i + 1])).abs().max().item() < 1e-4
+    assert cache.stats['cached'] == 0 and not cache.sessions[0].kv
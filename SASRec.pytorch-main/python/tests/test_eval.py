@@ -0,0 +1,130 @@
+"""
+The batched evaluation paths against the per-user evaluation they replaced.
+
+usage (from python/):
+    python -m pytest -q tests/test_eval.py
+"""
+
+import argparse
+
+import numpy as np
+import pytest
+import torch
+
+from helpers import make_args
+from model import SASRec
+from utils import evaluate_split
+
+MAXLEN = 20
+
+
+def reference_evaluate(model, dataset, args, split, users):
+    # the old per-user evaluate (test) / evaluate_valid: one predict per user, negatives by random_neq
+    [train, valid, test, usernum, itemnum] = dataset
+    target_of = test if split == 'test' else valid
+    sums = dict.fromkeys(['NDCG@5', 'NDCG@10', 'HR@5', 'HR@10', 'MRR'], 0.0)
+    for u in users:
+        seq = np.zeros([args.maxlen], dtype=np.int32)
+        idx = args.maxlen - 1
+        if split == 'test':
+            seq[idx] = valid[u][0]
+            idx -= 1
+        for i in reversed(train[u]):
+            seq[idx] = i
+            idx -= 1
+            if idx == -1: break
+        rated = set(train[u])
+        rated.add(0)
+        item_idx = [target_of[u][0]]
+        for _ in range(100):
+            t = np.random.randint(1, itemnum + 1)
+            while t in rated: t = np.random.randint(1, itemnum + 1)
+            item_idx.append(t)
+        with torch.no_grad():
+            predictions = -model.predict(np.array([u]), np.array([seq]), np.array([item_idx]))[0]
+        rank = predictions.argsort().argsort()[0].item()
+        if rank < 10:
+            sums['MRR'] += 1.0 / (rank + 1)
+            sums['NDCG@10'] += 1 / np.log2(rank + 2)
+            sums['HR@10'] += 1
+        if rank < 5:
+            sums['NDCG@5'] += 1 / np.log2(rank + 2)
+            sums['HR@5'] += 1
+    return {key: value / len(users) for key, value in sums.items()}
+
+
+def make_model(itemnum):
+    torch.manual_seed(0)
+    return SASRec(0, itemnum, make_args(MAXLEN, 16, 2, 1, False)).eval()
+
+
+def eval_args():
+    return argparse.Namespace(maxlen=MAXLEN, device='cpu', eval_users=0, eval_batch_size=64, eval_workers=1)
+
+
+@pytest.mark.parametrize('split', ['valid', 'test'])
+def test_evaluate_split_exact_with_one_candidate_negative(split):
+    # every train history holds all items but one, so both paths draw that item as all 100
+    # negatives and each rank is 0 or 100 whatever the random stream: metrics must match exactly
+    itemnum = 40
+    rng = np.random.RandomState(0)
+    train, valid, test = {}, {}, {}
+    for u in range(1, 151):
+        missing = rng.randint(1, itemnum + 1)
+        train[u] = rng.permutation([i for i in range(1, itemnum + 1) if i != missing]).tolist()
+        valid[u] = [int(rng.choice(train[u]))]
+        test[u] = [int(rng.choice(train[u]))]
+    dataset = [train, valid, test, 150, itemnum]
+    model = make_model(itemnum)
+
+    np.random.seed(0)
+    expected = reference_evaluate(model, dataset, eval_args(), split, list(train))
+    got = evaluate_split(model, dataset, eval_args(), split=split)
+    assert 0.0 < expected['HR@10'] < 1.0
+    for key in expected:
+        assert got[key] == pytest.approx(expected[key], abs=1e-9), key
+
+
+@pytest.mark.parametrize('split', ['valid', 'test'])
+def test_evaluate_split_matches_per_user_loop(split):
+    # real sampling: the negative streams differ, the metrics agree within sampling noise
+    itemnum = 300
+    rng = np.random.RandomState(1)
+    train, valid, test = {}, {}, {}
+    for u in range(1, 1501):
+        items = rng.randint(1, itemnum + 1, size=rng.randint(5, 40)).tolist()
+        train[u], valid[u], test[u] = items[:-2], items[-2:-1], items[-1:]
+    dataset = [train, valid, test, 1500, itemnum]
+    model = make_model(itemnum)
+
+    np.random.seed(0)
+    expected = reference_evaluate(model, dataset, eval_args(), split, list(train))
+    got = evaluate_split(model, dataset, eval_args(), split=split)
+    for key in expected:
+        assert abs(got[key] - expected[key]) < 0.04, (key, got[key], expected[key])
+
+
+def test_evaluate_all_scores_sampled_and_full_rank_on_the_same_users(monkeypatch):
+    import eval_worker
+
+    seen = {}
+    def record(name):
+        def fn(model, dataset, args, split='test', users=None, **kwargs):
+            seen[(name, split)] = users
+            return {}
+        return fn
+    monkeypatch.setattr(eval_worker, 'evaluate_split', record('sampled'))
+    monkeypatch.setattr(eval_worker, 'evaluate_full', record('full'))
+
+    itemnum = 50
+    rng = np.random.RandomState(2)
+    train, valid, test = {}, {}, {}
+    for u in range(1, 301):
+        items = rng.randint(1, itemnum + 1, size=10).tolist()
+        train[u], valid[u], test[u] = items[:-2], items[-2:-1], items[-1:]
+    args = eval_args()
+    args.eval_users, args.eval_full_rank, args.ann_nlist = 40, True, 0 # a sample of 40 of the 300 users
+    eval_worker.evaluate_all(make_model(itemnum), [train, valid, test, 300, itemnum], args)
+    for split in ['test', 'valid']:
+        assert len(seen[('sampled', split)]) == 40
+        assert np.array_equal(seen[('sampled', split)], seen[('full', split)])
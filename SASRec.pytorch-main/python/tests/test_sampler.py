@@ -0,0 +1,68 @@
+"""
+The vectorized batch builder (utils.build_batch) against the per-user loop sampler.
+
+usage (from python/):
+    python -m pytest -q tests/test_sampler.py
+"""
+
+import numpy as np
+import pytest
+
+from dataset import csr_layout, history_keys
+from utils import build_batch, random_neq
+
+ITEMNUM = 50
+
+
+def loop_sample(user_train, uid, maxlen, itemnum):
+    # sample(uid) of sample_function's loop sampler
+    seq = np.zeros([maxlen], dtype=np.int32)
+    pos = np.zeros([maxlen], dtype=np.int32)
+    neg = np.zeros([maxlen], dtype=np.int32)
+    nxt = user_train[uid][-1]
+    idx = maxlen - 1
+    ts = set(user_train[uid])
+    for i in reversed(user_train[uid][:-1]):
+        seq[idx] = i
+        pos[idx] = nxt
+        neg[idx] = random_neq(1, itemnum + 1, ts)
+        nxt = i
+        idx -= 1
+        if idx == -1: break
+    return seq, pos, neg
+
+
+@pytest.mark.parametrize('maxlen', [4, 16])
+def test_build_batch_matches_loop_sampler(maxlen):
+    rng = np.random.RandomState(0)
+    # lengths below, at and above maxlen; ITEMNUM is small so negatives often hit the history
+    user_train = {u: rng.randint(1, ITEMNUM + 1, size=rng.randint(2, 30)).tolist() for u in range(1, 200)}
+    data, starts, ends, _ = csr_layout(user_train)
+    keys = history_keys(data, starts, ends, ITEMNUM)
+    uids = rng.choice(list(user_train), size=128)
+
+    np.random.seed(0)
+    out_uids, seq, pos, neg = build_batch(uids, data, starts, ends, keys, ITEMNUM, maxlen)
+    assert np.array_equal(out_uids, uids)
+    assert seq.shape == pos.shape == neg.shape == (len(uids), maxlen)
+    for row, uid in enumerate(uids):
+        ref_seq, ref_pos, ref_neg = loop_sample(user_train, uid, maxlen, ITEMNUM)
+        assert np.array_equal(seq[row], ref_seq)
+        assert np.array_equal(pos[row], ref_pos)
+        assert np.array_equal(neg[row] != 0, ref_neg != 0) # negatives exactly on the real positions
+        drawn = neg[row][neg[row] != 0]
+        assert ((drawn >= 1) & (drawn <= ITEMNUM)).all()
+        assert not set(drawn.tolist()) & set(user_train[uid])
+
+
+def test_build_batch_negatives_cover_unseen_items():
+    # uniform over the items outside the history, like random_neq
+    user_train = {1: list(range(1, ITEMNUM - 4)) + [1]} # 5 unseen items
+    data, starts, ends, _ = csr_layout(user_train)
+    keys = history_keys(data, starts, ends, ITEMNUM)
+    np.random.seed(0)
+    _, _, _, neg = build_batch(np.ones(400, dtype=np.int64), data, starts, ends, keys, ITEMNUM, 8)
+    counts = np.bincount(neg.ravel(), minlength=ITEMNUM + 1)[1:]
+    assert set(np.flatnonzero(counts) + 1) == set(range(ITEMNUM - 4, ITEMNUM + 1))
+    mean = counts.sum() / 5.0
+    assert np.abs(counts[ITEMNUM - 5:] - mean).max() < 0.2 * mean
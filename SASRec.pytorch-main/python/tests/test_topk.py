@@ -0,0 +1,80 @@
+"""
+utils.full_catalog_topk against scoring the whole catalog at once: top-k ids, exact target ranks
+and seen-item masking, over several item chunk sizes and the int8 item table.
+
+usage (from python/):
+    python -m pytest -q tests/test_topk.py
+"""
+
+import numpy as np
+import pytest
+import torch
+
+from quantize import QuantizedEmbedding
+from utils import full_catalog_topk
+
+ITEMNUM = 500
+K = 10
+
+
+def make_case(dtype):
+    rng = np.random.RandomState(0)
+    torch.manual_seed(0)
+    feats = torch.randn(64, 16, dtype=dtype)
+    weight = torch.randn(ITEMNUM + 1, 16, dtype=dtype)
+    targets = rng.randint(1, ITEMNUM + 1, size=64)
+    # each row has seen 50 items, and every other row has seen its own target too
+    seen_rows = np.repeat(np.arange(64), 50)
+    seen_items = rng.randint(1, ITEMNUM + 1, size=64 * 50)
+    seen_items[::100] = targets[::2]
+    return feats, weight, seen_rows, seen_items, targets
+
+
+def reference(feats, weight, seen_rows, seen_items, targets=None):
+    # the dense (B, itemnum) score matrix, seen pairs set to -inf apart from each row's target
+    scores = feats @ weight[1:].t()
+    keep = np.ones(len(seen_rows), dtype=bool) if targets is None else seen_items != targets[seen_rows]
+    scores[torch.as_tensor(seen_rows[keep]), torch.as_tensor(seen_items[keep] - 1)] = -float('inf')
+    top_scores, top_ids = torch.topk(scores, K, dim=1)
+    if targets is None:
+        return top_scores, top_ids + 1, None
+    target_scores = scores[torch.arange(len(targets)), torch.as_tensor(targets - 1)]
+    return top_scores, top_ids + 1, (scores > target_scores[:, None]).sum(dim=1)
+
+
+@pytest.mark.parametrize('item_chunk', [7, 64, 65536]) # chunks not dividing the catalog, and one chunk
+def test_matches_dense_scoring(item_chunk):
+    feats, weight, seen_rows, seen_items, targets = make_case(torch.float64) # no ties, no rounding
+    ref_scores, ref_ids, ref_ranks = reference(feats, weight, seen_rows, seen_items, targets)
+    top_scores, top_ids, ranks = full_catalog_topk(feats, weight, seen_rows, seen_items, K, item_chunk, targets=targets)
+    assert torch.equal(top_ids, ref_ids)
+    assert torch.allclose(top_scores, ref_scores)
+    assert torch.equal(ranks, ref_ranks)
+
+    # a seen item never comes back, unless it is the row's own target
+    for row, ids in enumerate(top_ids.tolist()):
+        seen = set(seen_items[seen_rows == row].tolist()) - {targets[row]}
+        assert not seen & set(ids)
+    seen_target = np.zeros(len(targets), dtype=bool)
+    seen_target[seen_rows[seen_items == targets[seen_rows]]] = True
+    assert seen_target.any()
+    top1 = ranks == 0
+    assert torch.equal(top_ids[top1, 0], torch.as_tensor(targets)[top1])
+
+
+def test_without_targets_masks_every_seen_item():
+    feats, weight, seen_rows, seen_items, _ = make_case(torch.float64)
+    ref_scores, ref_ids, _ = reference(feats, weight, seen_rows, seen_items)
+    top_scores, top_ids = full_catalog_topk(feats, weight, seen_rows, seen_items, K, item_chunk=64)
+    assert torch.equal(top_ids, ref_ids)
+    assert torch.allclose(top_scores, ref_scores)
+
+
+def test_quantized_table_scores_dequantized_rows():
+    feats, weight, seen_rows, seen_items, targets = make_case(torch.float32)
+    table = QuantizedEmbedding(torch.nn.Embedding.from_pretrained(weight, padding_idx=0))
+    ref_scores, ref_ids, ref_ranks = reference(feats.double(), table.weight.double(), seen_rows, seen_items, targets)
+    top_scores, top_ids, ranks = full_catalog_topk(feats, table, seen_rows, seen_items, K, item_chunk=64, targets=targets)
+    assert torch.equal(top_ids, ref_ids)
+    assert torch.allclose(top_scores.double(), ref_scores, atol=1e-4)
+    assert torch.equal(ranks, ref_ranks)
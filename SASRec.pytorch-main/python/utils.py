@@ -1,26 +1,27 @@
 import sys
-import copy
+import time
+import contextlib
+import queue
 import torch
 import random
+import threading
 import numpy as np
-from collections import defaultdict
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, get_context, resource_tracker, shared_memory
 
-def build_index(dataset_name):
-
-    ui_mat = np.loadtxt('data/%s.txt' % dataset_name, dtype=np.int32)
+from ann_index import recall_at_k
+from dataset import CSRSequences, load_compiled, csr_layout, gather_ranges, history_keys, in_history
 
-    n_users = ui_mat[:, 0].max()
-    n_items = ui_mat[:, 1].max()
+def str2bool(s):
+    if s not in {'false', 'true'}:
+        raise ValueError('Not a valid boolean string')
+    return s == 'true'
 
-    u2i_index = [[] for _ in range(n_users + 1)]
-    i2u_index = [[] for _ in range(n_items + 1)]
+def build_index(dataset_name):
 
-    for ui_pair in ui_mat:
-        u2i_index[ui_pair[0]].append(ui_pair[1])
-        i2u_index[ui_pair[1]].append(ui_pair[0])
+    # u2i_index[u] / i2u_index[i] are array slices of the compiled CSR dataset
+    compiled = load_compiled(dataset_name)
 
-    return u2i_index, i2u_index
+    return compiled.u2i(), compiled.i2u()
 
 # sampler for batch generation
 def random_neq(l, r, s):
@@ -30,7 +31,90 @@ def random_neq(l, r, s):
     return t
 
 
-def sample_function(user_train, usernum, itemnum, batch_size, maxlen, result_queue, SEED):
+def sample_negatives(hist_keys, users, mask, itemnum, rng=np.random):
+    """Uniform negatives in [1, itemnum] outside each row's history, drawn where mask is set.
+
+    Rejection sampling like random_neq, but every rejected draw of the whole batch is redrawn at once.
+    """
+    neg = np.zeros(mask.shape, dtype=np.int32)
+    rows, cols = np.nonzero(mask)
+    row_users = users[rows]
+    while len(rows) > 0:
+        draw = rng.randint(1, itemnum + 1, size=len(rows))
+        neg[rows, cols] = draw
+        hit = in_history(hist_keys, row_users, draw, itemnum)
+        rows, cols, row_users = rows[hit], cols[hit], row_users[hit]
+    return neg
+
+
+def build_batch(uids, data, starts, ends, hist_keys, itemnum, maxlen):
+    """Vectorized equivalent of calling sample(uid) for every uid, returns (uid, seq, pos, neg) arrays."""
+    n = np.minimum(ends[uids] - starts[uids] - 1, maxlen)
+    offset = np.arange(maxlen)[None, :] - (maxlen - n)[:, None] # position inside the real (right-aligned) part
+    mask = offset >= 0
+    src = np.where(mask, (ends[uids] - 1 - n)[:, None] + offset, 0)
+    seq = np.where(mask, data[src], 0).astype(np.int32)
+    pos = np.where(mask, data[src + 1], 0).astype(np.int32)
+    neg = sample_negatives(hist_keys, uids, mask, itemnum)
+    return uids, seq, pos, neg
+
+
+def attach_shared_memory(name):
+    """Attach to an existing SharedMemory block without registering it with the resource tracker.
+
+    Only the creating process owns (and unlinks) a block; an attached registration would make the
+    tracker report it as leaked, or unlink it, when the attaching process exits.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedArrays(object):
+    """Numpy arrays packed into one SharedMemory block.
+
+    The creating process passes `arrays`; workers attach with the small picklable `spec` instead,
+    so the data itself is never pickled or copied per process. Only the creator unlinks.
+    """
+
+    def __init__(self, arrays=None, spec=None):
+        if arrays is not None:
+            layout, size = [], 0
+            for name, arr in arrays.items():
+                arr = np.asarray(arr)
+                size = (size + 63) // 64 * 64 # keep every array cache-line aligned
+                layout.append((name, arr.dtype.str, arr.shape, size))
+                size += arr.nbytes
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            self.spec = {'name': self.shm.name, 'layout': layout}
+        else:
+            self.shm = attach_shared_memory(spec['name'])
+            self.spec = spec
+        self.arrays = {name: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+                       for name, dtype, shape, offset in self.spec['layout']}
+        if arrays is not None:
+            for name, arr in arrays.items():
+                self.arrays[name][...] = arr
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self, unlink=False):
+        self.arrays = {}
+        try:
+            self.shm.close()
+        except BufferError: # a caller still holds a view, the mapping goes away with the process
+            pass
+        if unlink:
+            self.shm.unlink()
+
+
+def sample_function(data_spec, ring_spec, usernum, itemnum, batch_size, maxlen, free_slots, ready_slots, SEED, sampler='loop', bucket_pool=32, rank=0, world_size=1, bucket_widths=0):
     def sample(uid):
 
         # uid가 user_train에 없거나 시퀀스 길이가 1 이하인 경우 재선택
@@ -55,14 +139,65 @@ def sample_function(user_train, usernum, itemnum, batch_size, maxlen, result_que
 
         return (uid, seq, pos, neg)
 
+    def emit(uid, seq, pos, neg):
+        # write the batch straight into a free ring slot, only (slot, width) goes through the queue
+        slot = free_slots.get()
+        if slot is None: # WarpSampler.close: detach from the shared memory, the parent unlinks it
+            ring.close()
+            data.close()
+            sys.exit(0)
+        n = seq.size
+        ring['uid'][slot] = uid
+        ring['seq'][slot][:n] = seq.reshape(-1)
+        ring['pos'][slot][:n] = pos.reshape(-1)
+        ring['neg'][slot][:n] = neg.reshape(-1)
+        ready_slots.put((slot, seq.shape[1]))
+
+    data = SharedArrays(spec=data_spec)
+    ring = SharedArrays(spec=ring_spec)
+    user_train = CSRSequences(data['data'], data['starts'], data['ends'], data['present'])
+
     np.random.seed(SEED)
     # 실제 존재하는 사용자 ID만 사용 (시퀀스 길이가 2 이상인 사용자만)
-    valid_user_ids = np.array([uid for uid in user_train.keys() if len(user_train[uid]) > 1], dtype=np.int32)
+    valid_user_ids = user_train.keys_array()[user_train.lengths() > 1].astype(np.int32)
+    # distributed training: every rank draws from its own disjoint, strided shard of the users
+    valid_user_ids = valid_user_ids[rank::world_size]
     if len(valid_user_ids) == 0:
         raise ValueError("No valid users with sequence length > 1")
     
     uids = valid_user_ids.copy()
     counter = 0
+
+    if sampler == 'bucketed':
+        # shuffle, sort pools of bucket_pool batches by history length, cut them into batches and
+        # trim every batch to its longest real sequence; each user is still drawn once per pass.
+        # bucket_widths > 0 rounds the widths up to that many multiples of maxlen / bucket_widths,
+        # so a compiled forward only ever sees a few sequence lengths
+        width_step = -(-maxlen // bucket_widths) if bucket_widths > 0 else 1
+        lengths = np.minimum(data['ends'][uids] - data['starts'][uids] - 1, maxlen)
+        pool = batch_size * bucket_pool
+        while True:
+            order = np.random.permutation(len(uids))
+            # top up to whole batches the way the other samplers wrap around into the next shuffle
+            order = np.concatenate([order, np.resize(np.random.permutation(len(uids)), -len(order) % batch_size)])
+            batches = []
+            for p in range(0, len(order), pool):
+                chunk = order[p:p + pool]
+                chunk = chunk[np.argsort(lengths[chunk], kind='stable')]
+                batches += [chunk[i:i + batch_size] for i in range(0, len(chunk), batch_size)]
+            for i in np.random.permutation(len(batches)):
+                batch_uids = uids[batches[i]]
+                width = min(maxlen, -(-int(lengths[batches[i]].max()) // width_step) * width_step)
+                emit(*build_batch(batch_uids, data['data'], data['starts'], data['ends'], data['hist_keys'], itemnum, width))
+
+    if sampler == 'vectorized':
+        while True:
+            if counter % len(uids) == 0:
+                np.random.shuffle(uids)
+            batch_uids = uids[(counter + np.arange(batch_size)) % len(uids)]
+            counter += batch_size
+            emit(*build_batch(batch_uids, data['data'], data['starts'], data['ends'], data['hist_keys'], itemnum, maxlen))
+
     while True:
         if counter % len(uids) == 0:
             np.random.shuffle(uids)
@@ -70,205 +205,578 @@ def sample_function(user_train, usernum, itemnum, batch_size, maxlen, result_que
         for i in range(batch_size):
             one_batch.append(sample(uids[counter % len(uids)]))
             counter += 1
-        result_queue.put(zip(*one_batch))
+        emit(*[np.array(x) for x in zip(*one_batch)])
 
 
 class WarpSampler(object):
-    def __init__(self, User, usernum, itemnum, batch_size=64, maxlen=10, n_workers=1):
-        self.result_queue = Queue(maxsize=n_workers * 10)
+    """Sampler worker processes sharing the training sequences and a ring of batch slots.
+
+    user_train lives once in shared memory, every worker attaches to it. Finished batches are
+    written into preallocated shared-memory slots, so next_batch returns contiguous arrays
+    without unpickling; they stay valid until the following next_batch call.
+    With world_size > 1 the workers only sample users of shard rank (users[rank::world_size]).
+    """
+
+    def __init__(self, User, usernum, itemnum, batch_size=64, maxlen=10, n_workers=1, sampler='loop', bucket_pool=32, rank=0, world_size=1, seed=None, bucket_widths=0):
+        data, starts, ends, present = csr_layout(User)
+        arrays = {'data': data, 'starts': starts, 'ends': ends, 'present': present}
+        if sampler in ('vectorized', 'bucketed'):
+            arrays['hist_keys'] = history_keys(data, starts, ends, itemnum)
+        self.data = SharedArrays(arrays)
+
+        n_slots = n_workers * 10
+        self.batch_size, self.maxlen = batch_size, maxlen
+        self.ring = SharedArrays({
+            'uid': np.zeros((n_slots, batch_size), dtype=np.int32),
+            'seq': np.zeros((n_slots, batch_size * maxlen), dtype=np.int32),
+            'pos': np.zeros((n_slots, batch_size * maxlen), dtype=np.int32),
+            'neg': np.zeros((n_slots, batch_size * maxlen), dtype=np.int32),
+        })
+        self.free_slots, self.ready_slots = Queue(), Queue()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+        self.held_slot = None
+
+        # worker seeds: fresh from numpy's global state, or derived from seed to make a run reproducible
+        seeds = np.random.RandomState(seed).randint(2e9, size=n_workers) if seed is not None else [np.random.randint(2e9) for _ in range(n_workers)]
         self.processors = []
         for i in range(n_workers):
             self.processors.append(
-                Process(target=sample_function, args=(User,
+                Process(target=sample_function, args=(self.data.spec,
+                                                      self.ring.spec,
                                                       usernum,
                                                       itemnum,
                                                       batch_size,
                                                       maxlen,
-                                                      self.result_queue,
-                                                      np.random.randint(2e9)
+                                                      self.free_slots,
+                                                      self.ready_slots,
+                                                      seeds[i],
+                                                      sampler,
+                                                      bucket_pool,
+                                                      rank,
+                                                      world_size,
+                                                      bucket_widths
                                                       )))
             self.processors[-1].daemon = True
             self.processors[-1].start()
 
     def next_batch(self):
-        return self.result_queue.get()
+        # the previous batch is handed back to the workers only now, so its views stayed valid until here
+        if self.held_slot is not None:
+            self.free_slots.put(self.held_slot)
+        slot, width = self.ready_slots.get()
+        self.held_slot = slot
+        n, shape = self.batch_size * width, (self.batch_size, width)
+        return (self.ring['uid'][slot], self.ring['seq'][slot][:n].reshape(shape),
+                self.ring['pos'][slot][:n].reshape(shape), self.ring['neg'][slot][:n].reshape(shape))
 
     def close(self):
+        # a None slot tells a worker to detach and exit; terminate whoever does not within the timeout
+        for p in self.processors:
+            self.free_slots.put(None)
         for p in self.processors:
-            p.terminate()
-            p.join()
+            p.join(timeout=10.0)
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        self.ring.close(unlink=True)
+        self.data.close(unlink=True)
+
+
+class BatchPrefetcher(object):
+    """WarpSampler batches as tensors, staged one step ahead of the training loop.
+
+    A thread copies each batch out of the sampler's shared-memory slot into one of n_buffers
+    preallocated int32 host buffers (pinned on CUDA) and starts the host-to-device copy into
+    preallocated device buffers on a side stream, while the current step runs. next() returns the
+    staged host tensors, to_device() their device copies once the copy has finished. The buffers
+    of a batch are recycled at the following next() call, so nothing is allocated per step.
+    background=False stages synchronously inside next().
+    """
+
+    KEYS = ('uid', 'seq', 'pos', 'neg')
+
+    def __init__(self, sampler, device, n_buffers=3, background=True):
+        self.sampler, self.device = sampler, torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        B, T = sampler.batch_size, sampler.maxlen
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        self.buffers = []
+        for _ in range(n_buffers):
+            host = {k: torch.empty(B if k == 'uid' else B * T, dtype=torch.int32, pin_memory=self.cuda) for k in self.KEYS}
+            dev = {k: torch.empty_like(v, device=self.device) for k, v in host.items()} if self.cuda else host
+            events = (torch.cuda.Event(), torch.cuda.Event()) if self.cuda else None # (copied, released)
+            self.buffers.append((host, dev, events))
+        self.free, self.ready = queue.Queue(), queue.Queue()
+        for i in range(n_buffers):
+            self.free.put(i)
+        self.held = None
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def _stage(self, i):
+        u, seq, pos, neg = self.sampler.next_batch()
+        host, dev, events = self.buffers[i]
+        B, W = seq.shape
+        n = B * W
+        host['uid'].copy_(torch.from_numpy(u))
+        for k, arr in (('seq', seq), ('pos', pos), ('neg', neg)):
+            host[k][:n].copy_(torch.from_numpy(arr.reshape(-1)))
+        if self.cuda:
+            with torch.cuda.stream(self.stream):
+                self.stream.wait_event(events[1]) # the step that last read these device buffers is done
+                for k in self.KEYS:
+                    m = n if k != 'uid' else B
+                    dev[k][:m].copy_(host[k][:m], non_blocking=True)
+                events[0].record(self.stream)
+        return i, W
+
+    def _loop(self):
+        while True:
+            i = self.free.get()
+            if i is None:
+                break
+            try:
+                self.ready.put(self._stage(i))
+            except Exception as e: # re-raised on the training thread by next()
+                self.ready.put(e)
+                break
+
+    def _views(self, tensors, W):
+        B = len(tensors['uid'])
+        return (tensors['uid'],) + tuple(tensors[k][:B * W].view(B, W) for k in ('seq', 'pos', 'neg'))
+
+    def next(self):
+        """(uid, seq, pos, neg) int32 CPU tensors of the next batch, valid until the following next()."""
+        if self.held is not None:
+            if self.cuda:
+                self.buffers[self.held[0]][2][1].record() # released once the current stream got here
+            self.free.put(self.held[0])
+        out = self.ready.get() if self.thread is not None else self._stage(self.free.get())
+        if isinstance(out, Exception):
+            raise out
+        self.held = out
+        i, W = out
+        return self._views(self.buffers[i][0], W)
+
+    def to_device(self):
+        """The current batch on the device; on CUDA the current stream waits for its copy."""
+        i, W = self.held
+        host, dev, events = self.buffers[i]
+        if self.cuda:
+            torch.cuda.current_stream(self.device).wait_event(events[0])
+        return self._views(dev, W)
+
+    def close(self):
+        if self.thread is not None:
+            self.free.put(None)
+            self.thread.join(timeout=5.0)
+
+
+class PaddingStats(object):
+    """How much of the computed (B, T) grid holds real items, against always padding to maxlen."""
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.reset()
+
+    def reset(self):
+        self.real, self.cells, self.attn = 0, 0, 0
+        self.full_cells, self.full_attn = 0, 0
+
+    def update(self, seq):
+        B, T = seq.shape
+        # real (non-padded) tokens of this batch; pass host arrays/tensors, a device tensor would sync
+        self.last_real = int(torch.count_nonzero(seq)) if torch.is_tensor(seq) else int(np.count_nonzero(seq))
+        self.real += self.last_real
+        self.cells += B * T
+        self.attn += B * T * T # attention score entries, O(T^2) per sequence
+        self.full_cells += B * self.maxlen
+        self.full_attn += B * self.maxlen * self.maxlen
+
+    def summary(self):
+        return ('padding efficiency: %.1f%% real tokens (%.1f%% at maxlen), computed tokens %.1f%%, attention cells %.1f%% of maxlen padding'
+                % (100.0 * self.real / max(self.cells, 1), 100.0 * self.real / max(self.full_cells, 1),
+                   100.0 * self.cells / max(self.full_cells, 1), 100.0 * self.attn / max(self.full_attn, 1)))
+
+
+def build_optimizers(model, args):
+    """Adam over every parameter; with args.sparse_emb the item table (sparse gradients) gets
+    SparseAdam, which only updates the moments and weights of rows in the batch, and Adam keeps the rest."""
+    if not getattr(args, 'sparse_emb', False):
+        return [torch.optim.Adam(model.parameters(), lr=args.lr, betas=(0.9, 0.98))]
+    assert model.item_emb.sparse, 'build the model with args.sparse_emb set'
+    dense = [p for name, p in model.named_parameters() if name != 'item_emb.weight']
+    return [torch.optim.SparseAdam([model.item_emb.weight], lr=args.lr, betas=(0.9, 0.98)),
+            torch.optim.Adam(dense, lr=args.lr, betas=(0.9, 0.98))]
+
+
+def masked_bce_loss(pos_logits, neg_logits, mask):
+    """BCE of positives (label 1) and negatives (label 0) over the masked (real) positions in one
+    fused sum, no boolean-index gathers: sum((softplus(-pos) + softplus(neg)) * mask) / sum(mask),
+    which equals bce(pos[mask], 1) + bce(neg[mask], 0) of two BCEWithLogitsLoss calls. Computed in
+    fp32 whatever the logits' dtype."""
+    mask = mask.to(torch.float32)
+    loss = torch.nn.functional.softplus(-pos_logits.float()) + torch.nn.functional.softplus(neg_logits.float())
+    return (loss * mask).sum() / mask.sum().clamp(min=1.0)
+
+
+class CompiledOrEager(object):
+    """torch.compile(fn) that falls back to eager fn when compilation (or a recompile) fails.
+
+    AOTAutograd compiles the backward lazily, at the first backward. So when fn is a module, the
+    first call also runs a probe backward (zero output gradients, nothing accumulated into .grad)
+    and a failing backward compile falls back too. A backward that fails after a later recompile
+    (new input shapes) still raises in the caller's backward.
+
+    The first call, which triggers compilation, is timed into compile_time. log(message) reports
+    a fallback, e.g. TrainTelemetry.event.
+    """
+
+    def __init__(self, fn, log=print, **compile_kwargs):
+        self.eager = fn
+        self.log = log
+        self.fn = torch.compile(fn, **compile_kwargs)
+        self.compiled = True
+        self.compile_time = None
+
+    def _probe_backward(self, out):
+        if not isinstance(self.eager, torch.nn.Module) or not torch.is_grad_enabled():
+            return
+        outputs = [o for o in (out if isinstance(out, (tuple, list)) else [out]) if torch.is_tensor(o) and o.requires_grad]
+        params = [p for p in self.eager.parameters() if p.requires_grad]
+        if outputs and params:
+            torch.autograd.grad(outputs, params, grad_outputs=[torch.zeros_like(o) for o in outputs],
+                                retain_graph=True, allow_unused=True)
+
+    def __call__(self, *args, **kwargs):
+        if not self.compiled:
+            return self.fn(*args, **kwargs)
+        t = time.perf_counter()
+        try:
+            out = self.fn(*args, **kwargs)
+            if self.compile_time is None:
+                self._probe_backward(out)
+        except Exception as e:
+            msg = str(e).strip().splitlines()
+            self.log('torch.compile failed (%s: %s), falling back to eager' % (type(e).__name__, msg[0] if msg else ''))
+            self.fn, self.compiled = self.eager, False
+            out = self.fn(*args, **kwargs)
+        if self.compile_time is None:
+            self.compile_time = time.perf_counter() - t
+        return out
+
+
+def l2_emb_loss(model, seq, pos, neg, args):
+    """args.l2_emb * squared norm of the item table, or with args.sparse_emb of the rows the batch touches."""
+    if args.l2_emb == 0:
+        return 0.0
+    if getattr(args, 'sparse_emb', False):
+        if torch.is_tensor(seq): # batches from BatchPrefetcher, deduplicated where they are
+            ids = torch.unique(torch.cat([seq.reshape(-1), pos.reshape(-1), neg.reshape(-1)]))
+        else:
+            ids = np.unique(np.concatenate([seq.ravel(), pos.ravel(), neg.ravel()]))
+        rows = model.item_emb(torch.as_tensor(ids, dtype=torch.long, device=model.item_emb.weight.device))
+        return args.l2_emb * torch.sum(rows ** 2)
+    return args.l2_emb * torch.sum(model.item_emb.weight ** 2)
 
 
 # train/val/test data generation
 def data_partition(fname):
-    usernum = 0
-    itemnum = 0
-    User = defaultdict(list)
-    user_train = {}
-    user_valid = {}
-    user_test = {}
     # assume user/item index starting from 1
-    f = open('data/%s.txt' % fname, 'r')
-    for line in f:
-        u, i = line.rstrip().split(' ')
-        u = int(u)
-        i = int(i)
-        usernum = max(u, usernum)
-        itemnum = max(i, itemnum)
-        User[u].append(i)
-
-    for user in User:
-        nfeedback = len(User[user])
-        if nfeedback < 4:                          # To be rigorous, the training set needs at least two data points to learn
-            user_train[user] = User[user]
-            user_valid[user] = []
-            user_test[user] = []
+    compiled = load_compiled(fname)
+    user_train, user_valid, user_test = compiled.splits()
+    return [user_train, user_valid, user_test, compiled.usernum, compiled.itemnum]
+
+def right_aligned(data, starts, ends, users, width):
+    """(len(users), width) int32 windows of each user's last `width` items, left-padded with 0."""
+    n = np.minimum(ends[users] - starts[users], width)
+    offset = np.arange(width)[None, :] - (width - n)[:, None]
+    mask = offset >= 0
+    src = np.where(mask, (ends[users] - n)[:, None] + offset, 0)
+    return np.where(mask, data[src], 0).astype(np.int32)
+
+
+def eval_inputs(dataset, users, maxlen, split):
+    """Input windows and target items for `users`: train history for valid, train + valid item for test."""
+    [train, valid, test, usernum, itemnum] = dataset
+    tr_data, tr_starts, tr_ends, _ = csr_layout(train)
+    va_data, va_starts, _, _ = csr_layout(valid)
+    if split == 'valid':
+        seq = right_aligned(tr_data, tr_starts, tr_ends, users, maxlen)
+        target = va_data[va_starts[users]]
+    else:
+        te_data, te_starts, _, _ = csr_layout(test)
+        seq = np.zeros((len(users), maxlen), dtype=np.int32)
+        seq[:, :-1] = right_aligned(tr_data, tr_starts, tr_ends, users, maxlen - 1)
+        seq[:, -1] = va_data[va_starts[users]]
+        target = te_data[te_starts[users]]
+    return seq, target.astype(np.int64)
+
+
+def eval_users(dataset, split):
+    """Users with at least one train item and an item in the evaluated split."""
+    [train, valid, test, usernum, itemnum] = dataset
+    held_out = test if split == 'test' else valid
+    _, tr_starts, tr_ends, tr_present = csr_layout(train)
+    _, ho_starts, ho_ends, ho_present = csr_layout(held_out)
+    users = np.flatnonzero(tr_present)
+    users = users[users < len(ho_present)]
+    ok = ho_present[users] & (tr_ends[users] > tr_starts[users]) & (ho_ends[users] > ho_starts[users])
+    return users[ok]
+
+
+def rank_metrics(ranks, ks):
+    """Sums of NDCG@k / HR@k and MRR (cut at max(ks), as before) over a batch of 0-based ranks."""
+    ranks = ranks.double()
+    gains = 1.0 / torch.log2(ranks + 2)
+    sums = {}
+    for k in ks:
+        hit = ranks < k
+        sums['NDCG@%d' % k] = (gains * hit).sum().item()
+        sums['HR@%d' % k] = hit.sum().item()
+    sums['MRR'] = ((1.0 / (ranks + 1)) * (ranks < max(ks))).sum().item()
+    return sums
+
+
+def select_eval_users(dataset, args, split):
+    """eval_users of the split, a random sample of args.eval_users of them if there are more (0: all)."""
+    users = eval_users(dataset, split)
+    cap = getattr(args, 'eval_users', 10000)
+    if cap and len(users) > cap:
+        users = np.array(random.sample(users.tolist(), cap))
+    return users
+
+
+# (block function, its leading arguments) of the running forked_blocks, inherited by forked workers
+_BLOCK_JOB = None
+
+
+def _init_block_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _run_block(b):
+    fn, fn_args = _BLOCK_JOB
+    return b, fn(*fn_args, b)
+
+
+def fork_workers(workers, device):
+    """workers, or 1 on CUDA: CUDA contexts do not survive fork, the GPU is fast enough in-process."""
+    if workers > 1 and str(device).startswith('cuda'):
+        return 1
+    return workers
+
+
+@contextlib.contextmanager
+def forked_blocks(fn, fn_args, blocks, workers=1, ordered=True, chunksize=None):
+    """Iterator over (b, fn(*fn_args, b)) for b in blocks.
+
+    With workers > 1 the blocks are spread over forked processes, which inherit fn_args (the
+    model, memory-mapped data) through fork and split this process's torch threads; only b and
+    the results are pickled. ordered=False yields results as they finish; chunksize defaults to
+    about four chunks per worker. The pool is terminated and joined when the with block exits,
+    also on an error.
+    """
+    global _BLOCK_JOB
+    workers = min(workers, len(blocks))
+    pool = None
+    try:
+        if workers > 1:
+            _BLOCK_JOB = (fn, fn_args)
+            pool = get_context('fork').Pool(workers, initializer=_init_block_worker, initargs=(max(1, torch.get_num_threads() // workers),))
+            chunksize = chunksize or max(1, len(blocks) // (4 * workers))
+            yield (pool.imap if ordered else pool.imap_unordered)(_run_block, blocks, chunksize=chunksize)
         else:
-            user_train[user] = User[user][:-2]
-            user_valid[user] = []
-            user_valid[user].append(User[user][-2])
-            user_test[user] = []
-            user_test[user].append(User[user][-1])
-    return [user_train, user_valid, user_test, usernum, itemnum]
-
-# TODO: merge evaluate functions for test and val set
+            yield ((b, fn(*fn_args, b)) for b in blocks)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _BLOCK_JOB = None
+
+
+def map_eval_blocks(fn, fn_args, n_users, batch_size, workers=1):
+    """Sums of fn(*fn_args, b) over the user blocks b = 0, batch_size, 2 * batch_size, ...
+
+    With workers > 1 the blocks are spread over forked processes (forked_blocks). Block results
+    are added in block order, so the sums do not depend on the number of workers. Prints a
+    progress dot per 100 users.
+    """
+    sums = {}
+    done = 0
+    with forked_blocks(fn, fn_args, list(range(0, n_users, batch_size)), workers) as results:
+        for b, block_sums in results:
+            for key, value in block_sums.items():
+                sums[key] = sums.get(key, 0.0) + value
+            n = min(batch_size, n_users - b)
+            if (done + n) // 100 > done // 100:
+                print('.' * ((done + n) // 100 - done // 100), end="")
+                sys.stdout.flush()
+            done += n
+    return sums
+
+
+def eval_workers(args):
+    return fork_workers(getattr(args, 'eval_workers', 1), getattr(args, 'device', 'cpu'))
+
+
+def _sampled_block(model, dataset, args, split, users, batch_size, hist_keys, seed, ks, num_neg, b):
+    [train, valid, test, usernum, itemnum] = dataset
+    batch = users[b:b + batch_size]
+    seq, target = eval_inputs(dataset, batch, args.maxlen, split)
+    rng = np.random.RandomState([seed, b]) # seeded per block, whichever process evaluates it
+    neg = sample_negatives(hist_keys, batch, np.ones((len(batch), num_neg), dtype=bool), itemnum, rng)
+    item_idx = np.concatenate([target[:, None], neg], axis=1)
+
+    with torch.no_grad():
+        logits = model.predict(batch, seq, item_idx)
+    ranks = (logits[:, 1:] > logits[:, :1]).sum(dim=1)
+    return rank_metrics(ranks, ks)
+
+
+def evaluate_split(model, dataset, args, split='test', ks=(5, 10), num_neg=100, users=None):
+    """Rank each user's held-out item against num_neg sampled negatives, users scored in batches.
+
+    Negatives are uniform over items outside the user's train history (like the old per-user loop),
+    drawn for the whole batch at once from a generator seeded by the batch's position. At most
+    args.eval_users users are evaluated (default 10000, 0 for all), sharded over args.eval_workers
+    processes. users (from select_eval_users) fixes the sample, e.g. to share it with evaluate_full.
+    """
+    [train, valid, test, usernum, itemnum] = dataset
+    batch_size = getattr(args, 'eval_batch_size', 256)
+
+    if users is None:
+        users = select_eval_users(dataset, args, split)
+
+    # membership keys only for the evaluated users' train histories
+    tr_data, tr_starts, tr_ends, _ = csr_layout(train)
+    selected = np.zeros(len(tr_starts), dtype=bool)
+    selected[users] = True
+    hist_keys = history_keys(tr_data, tr_starts, np.where(selected, tr_ends, tr_starts), itemnum)
+
+    seed = np.random.randint(2 ** 31 - 1) # one draw per evaluation, the blocks derive their streams from it
+    sums = map_eval_blocks(_sampled_block, (model, dataset, args, split, users, batch_size, hist_keys, seed, ks, num_neg),
+                           len(users), batch_size, eval_workers(args))
+    return {key: value / max(len(users), 1) for key, value in sums.items()}
+
+
+def seen_pairs(dataset, users, split):
+    """(row, item) pairs of the items each user has already seen when predicting the split item."""
+    [train, valid, test, usernum, itemnum] = dataset
+    parts = [csr_layout(train)] if split == 'valid' else [csr_layout(train), csr_layout(valid)]
+    rows, items = [], []
+    for data, starts, ends, _ in parts:
+        lens = ends[users] - starts[users]
+        rows.append(np.repeat(np.arange(len(users)), lens))
+        items.append(data[gather_ranges(starts[users], ends[users])].astype(np.int64))
+    return np.concatenate(rows), np.concatenate(items)
+
+
+def item_table(embedding):
+    """The item table full_catalog_topk scores: an Embedding's weight, or a quantized embedding itself."""
+    return embedding if hasattr(embedding, 'rows') else embedding.weight
+
+
+def full_catalog_topk(feats, item_weight, seen_rows, seen_items, k, item_chunk=65536, targets=None):
+    """Stream the whole catalog in item chunks, keeping a running top-k per row.
+
+    feats (B, C) user features, item_weight (itemnum + 1, C) with the padding row 0 skipped, or
+    an embedding with rows(lo, hi) (quantize.QuantizedEmbedding, see item_table) that is
+    dequantized one chunk at a time.
+    (seen_rows, seen_items) pairs are masked out. If targets are given, also returns the exact
+    0-based rank of each target among the unmasked items; the target itself is never masked.
+    Peak memory is O(B * item_chunk) whatever the catalog size.
+    """
+    B, dev = feats.shape[0], feats.device
+    rows_idx = torch.arange(B, device=dev)
+    chunked = not torch.is_tensor(item_weight)
+    if targets is not None:
+        keep = seen_items != targets[seen_rows]
+        seen_rows, seen_items = seen_rows[keep], seen_items[keep]
+        targets_t = torch.as_tensor(targets, device=dev)
+        target_scores = (feats * (item_weight(targets_t) if chunked else item_weight[targets_t])).sum(-1)
+        above = torch.zeros(B, dtype=torch.long, device=dev)
+    order = np.argsort(seen_items, kind='stable')
+    seen_rows, seen_items = seen_rows[order], seen_items[order]
+
+    top_scores = torch.empty((B, 0), dtype=feats.dtype, device=dev)
+    top_ids = torch.empty((B, 0), dtype=torch.long, device=dev)
+    n_items = item_weight.num_embeddings if chunked else item_weight.shape[0]
+    for lo in range(1, n_items, item_chunk):
+        hi = min(lo + item_chunk, n_items)
+        scores = feats @ (item_weight.rows(lo, hi) if chunked else item_weight[lo:hi]).t() # (B, chunk)
+        a, b = np.searchsorted(seen_items, [lo, hi])
+        if b > a:
+            scores[torch.as_tensor(seen_rows[a:b], device=dev), torch.as_tensor(seen_items[a:b] - lo, device=dev)] = -float('inf')
+
+        if targets is not None:
+            above += (scores > target_scores[:, None]).sum(dim=1)
+            # don't count the target against itself if rounding put its chunk score above target_scores
+            in_chunk = (targets_t >= lo) & (targets_t < hi)
+            own = scores[rows_idx, (targets_t - lo).clamp(0, hi - lo - 1)]
+            above -= (in_chunk & (own > target_scores)).long()
+
+        chunk_scores, chunk_ids = torch.topk(scores, min(k, hi - lo), dim=1)
+        top_scores, merged = torch.topk(torch.cat([top_scores, chunk_scores], dim=1), min(k, top_scores.shape[1] + chunk_scores.shape[1]), dim=1)
+        top_ids = torch.gather(torch.cat([top_ids, chunk_ids + lo], dim=1), 1, merged)
+
+    if targets is not None:
+        return top_scores, top_ids, above
+    return top_scores, top_ids
+
+
+def _full_block(model, dataset, args, split, users, batch_size, ks, ann_index, ann_k, b):
+    batch = users[b:b + batch_size]
+    item_chunk = getattr(args, 'eval_item_chunk', 65536)
+    seq, target = eval_inputs(dataset, batch, args.maxlen, split)
+    sums = {}
+    with torch.no_grad():
+        item_weight = item_table(model.item_emb)
+        feats = model.final_feats(seq)
+        seen_rows, seen_items = seen_pairs(dataset, batch, split)
+        _, _, ranks = full_catalog_topk(feats, item_weight, seen_rows, seen_items, max(ks), item_chunk, targets=target)
+        sums.update(rank_metrics(ranks, ks))
+
+        if ann_index is not None:
+            t = time.time()
+            _, exact_ids = full_catalog_topk(feats, item_weight, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), ann_k, item_chunk)
+            sums['exact_time'] = time.time() - t
+            t = time.time()
+            _, ann_ids = ann_index.search(feats.float().cpu().numpy(), ann_k)
+            sums['ann_time'] = time.time() - t
+            sums['ANN_Recall@%d' % ann_k] = recall_at_k(ann_ids, exact_ids.cpu().numpy()) * len(batch)
+    return sums
+
+
+def evaluate_full(model, dataset, args, split='test', ks=(5, 10), ann_index=None, ann_k=10, users=None):
+    """Rank each user's held-out item against the whole catalog, already-seen items masked.
+
+    Same metrics dict as evaluate_split. Users are sampled like there, but independently unless
+    the same users array is passed to both. The catalog is scored in chunks of
+    args.eval_item_chunk items so memory is bounded by eval_batch_size * eval_item_chunk.
+    With an ann_index (ann_index.IVFIndex) the same user features are also searched approximately
+    and 'ANN_Recall@k' against exact unmasked top-k is reported, with the time of both searches
+    (summed over the evaluation workers).
+    """
+    batch_size = getattr(args, 'eval_batch_size', 256)
+    if users is None:
+        users = select_eval_users(dataset, args, split)
+    sums = map_eval_blocks(_full_block, (model, dataset, args, split, users, batch_size, ks, ann_index, ann_k),
+                           len(users), batch_size, eval_workers(args))
+    times = {key: sums.pop(key) for key in ('ann_time', 'exact_time') if key in sums}
+    metrics = {key: value / max(len(users), 1) for key, value in sums.items()}
+    metrics.update(times)
+    return metrics
+
+
 # evaluate on test set
 def evaluate(model, dataset, args):
-    [train, valid, test, usernum, itemnum] = copy.deepcopy(dataset)
-
-    # Metrics for different K values
-    NDCG_5 = 0.0
-    NDCG_10 = 0.0
-    HR_5 = 0.0
-    HR_10 = 0.0
-    MRR = 0.0
-    valid_user = 0.0
-
-    # 실제 존재하는 사용자 ID만 사용
-    valid_users = [u for u in train.keys() if u in test and len(train[u]) >= 1 and len(test[u]) >= 1]
-    
-    if len(valid_users) > 10000:
-        users = random.sample(valid_users, 10000)
-    else:
-        users = valid_users
-    
-    for u in users:
-
-        seq = np.zeros([args.maxlen], dtype=np.int32)
-        idx = args.maxlen - 1
-        seq[idx] = valid[u][0]
-        idx -= 1
-        for i in reversed(train[u]):
-            seq[idx] = i
-            idx -= 1
-            if idx == -1: break
-        rated = set(train[u])
-        rated.add(0)
-        item_idx = [test[u][0]]
-        for _ in range(100):
-            t = np.random.randint(1, itemnum + 1)
-            while t in rated: t = np.random.randint(1, itemnum + 1)
-            item_idx.append(t)
-
-        predictions = -model.predict(*[np.array(l) for l in [[u], [seq], item_idx]])
-        predictions = predictions[0] # - for 1st argsort DESC
-
-        rank = predictions.argsort().argsort()[0].item()
-
-        valid_user += 1
-
-        # MRR: Mean Reciprocal Rank (1 / rank, 0 if rank >= K)
-        if rank < 10:
-            MRR += 1.0 / (rank + 1)
-        
-        # NDCG@5
-        if rank < 5:
-            NDCG_5 += 1 / np.log2(rank + 2)
-            HR_5 += 1
-        
-        # NDCG@10 and HR@10
-        if rank < 10:
-            NDCG_10 += 1 / np.log2(rank + 2)
-            HR_10 += 1
-        
-        if valid_user % 100 == 0:
-            print('.', end="")
-            sys.stdout.flush()
-
-    return {
-        'NDCG@5': NDCG_5 / valid_user,
-        'NDCG@10': NDCG_10 / valid_user,
-        'HR@5': HR_5 / valid_user,
-        'HR@10': HR_10 / valid_user,
-        'MRR': MRR / valid_user
-    }
+    return evaluate_split(model, dataset, args, split='test')
 
 
 # evaluate on val set
 def evaluate_valid(model, dataset, args):
-    [train, valid, test, usernum, itemnum] = copy.deepcopy(dataset)
-
-    # Metrics for different K values
-    NDCG_5 = 0.0
-    NDCG_10 = 0.0
-    HR_5 = 0.0
-    HR_10 = 0.0
-    MRR = 0.0
-    valid_user = 0.0
-    # 실제 존재하는 사용자 ID만 사용
-    valid_users = [u for u in train.keys() if u in valid and len(train[u]) >= 1 and len(valid[u]) >= 1]
-    
-    if len(valid_users) > 10000:
-        users = random.sample(valid_users, 10000)
-    else:
-        users = valid_users
-    
-    for u in users:
-
-        seq = np.zeros([args.maxlen], dtype=np.int32)
-        idx = args.maxlen - 1
-        for i in reversed(train[u]):
-            seq[idx] = i
-            idx -= 1
-            if idx == -1: break
-
-        rated = set(train[u])
-        rated.add(0)
-        item_idx = [valid[u][0]]
-        for _ in range(100):
-            t = np.random.randint(1, itemnum + 1)
-            while t in rated: t = np.random.randint(1, itemnum + 1)
-            item_idx.append(t)
-
-        predictions = -model.predict(*[np.array(l) for l in [[u], [seq], item_idx]])
-        predictions = predictions[0]
-
-        rank = predictions.argsort().argsort()[0].item()
-
-        valid_user += 1
-
-        # MRR: Mean Reciprocal Rank (1 / rank, 0 if rank >= K)
-        if rank < 10:
-            MRR += 1.0 / (rank + 1)
-        
-        # NDCG@5
-        if rank < 5:
-            NDCG_5 += 1 / np.log2(rank + 2)
-            HR_5 += 1
-        
-        # NDCG@10 and HR@10
-        if rank < 10:
-            NDCG_10 += 1 / np.log2(rank + 2)
-            HR_10 += 1
-        
-        if valid_user % 100 == 0:
-            print('.', end="")
-            sys.stdout.flush()
-
-    return {
-        'NDCG@5': NDCG_5 / valid_user,
-        'NDCG@10': NDCG_10 / valid_user,
-        'HR@5': HR_5 / valid_user,
-        'HR@10': HR_10 / valid_user,
-        'MRR': MRR / valid_user
-    }
+    return evaluate_split(model, dataset, args, split='valid')